@@ -5,6 +5,7 @@ versus gate voltage.
 import matplotlib.pyplot as plt, numpy as np
 from ..Measurements.spectrum import ZurichSpectrum
 from ..Utilities.save import Saver
+from ..Utilities.spectral import fit_one_over_f
 
 class SpectrumSeries(Saver):
     def __init__(self, Vtgs, Vbias, paths, gain=1):
@@ -21,6 +22,17 @@ class SpectrumSeries(Saver):
         self.gain = gain
 
 
+    @staticmethod
+    def _mean_voltage(zs):
+        '''
+        Mean voltage of a spectrum, from its time traces for spectra taken
+        before the mean voltage was recorded (Vmean).
+        '''
+        if hasattr(zs, 'Vmean'):
+            return zs.Vmean
+        return np.array(zs.timetraces_V).mean()
+
+
     def get_averages(self, fmin=0, fmax=None):
         '''
         Averages the spectrum over frequency range (fmin, fmax) (Hz) to obtain
@@ -39,7 +51,7 @@ class SpectrumSeries(Saver):
             self.zs = ZurichSpectrum.load(self.paths[j])
             zs = self.zs
             zs.Vn /= self.gain
-            Vav.append(np.array(zs.timetraces_V).mean() / self.gain)
+            Vav.append(self._mean_voltage(zs) / self.gain)
             try:
                 Ibias.append(zs.kbias.input_current)
                 Vbias.append(zs.kbias.input_voltage)
@@ -74,7 +86,7 @@ class SpectrumSeries(Saver):
             self.zs = ZurichSpectrum.load(self.paths[j])
             zs = self.zs
             zs.Vn /= self.gain
-            Vav.append(np.array(zs.timetraces_V).mean() / self.gain)
+            Vav.append(self._mean_voltage(zs) / self.gain)
             try:
                 Ibias.append(zs.kbias.input_current)
                 Vbias.append(zs.kbias.input_voltage)
@@ -94,22 +106,25 @@ class SpectrumSeries(Saver):
 
     def get_one_over_f(self, fmin=.1, fmax=None, filters=[60], filters_bw=[10]):
         '''
-        Gets the fit parameters to A/f^alpha (using fit_one_over_f in ZurichSpectrum)
-        over the frequency range (fmin, fmax) (Hz).
+        Gets the fit parameters to A/f^alpha (see fit_one_over_f in
+        Utilities/spectral.py) over the frequency range (fmin, fmax) (Hz),
+        with the harmonics of filters removed. All spectra are fit at once.
         '''
-        As = []
-        alphas = []
-
+        f = []
+        Vn = []
         for j, Vtg in enumerate(self.Vtgs):
             self.zs = ZurichSpectrum.load(self.paths[j])
-            zs = self.zs
-            zs.Vn /= self.gain
-            A, alpha = zs.fit_one_over_f(fmin, fmax, filters=[60], filters_bw=[10])
-            As.append(A)
-            alphas.append(alpha)
-
-        self.As = np.array(As)
-        self.alphas = np.array(alphas)
+            f.append(self.zs.f)
+            Vn.append(self.zs.Vn / self.gain)
+
+        if all(np.array_equal(fj, f[0]) for fj in f):
+            self.As, self.alphas = fit_one_over_f(f[0], np.array(Vn), fmin,
+                                                  fmax, filters, filters_bw)
+        else:  # spectra with different frequencies
+            fits = np.array([fit_one_over_f(fj, Vnj, fmin, fmax, filters,
+                                            filters_bw)
+                             for fj, Vnj in zip(f, Vn)])
+            self.As, self.alphas = fits[:, 0], fits[:, 1]
 
 
     def plot(self):
@@ -54,6 +54,21 @@ class NIDAQ(Instrument):
 
         return self._save_dict
 
+    def close(self):
+        '''
+        Release the Instrumental device and the channel objects, e.g. before
+        creating the DAQ again after it was unplugged. Does not change the
+        outputs. The object cannot be used afterwards.
+        '''
+        try:
+            self._daq.close()  # not in every version of Instrumental
+        except AttributeError:
+            pass
+        for chan in self._ins + self._outs:
+            delattr(self, chan)
+        del self._daq
+
+
     def all(self):
         '''
         Returns a dictionary of all channel voltages.
@@ -218,6 +218,59 @@ class Piezos(Instrument):
 
         return output_data, received
 
+    def sweep_path(self, voltages, chan_in=None, sweep_rate=None, meas_rate=None):
+        '''
+        Sweeps piezos along an arbitrary path given as a dictionary of
+        equal-length voltage arrays (e.g. {'x': [...], 'y': [...], 'z': [...]}).
+        The path is checked against the voltage limits once, then resampled
+        linearly so that no piezo steps more than the step size demanded by
+        sweep_rate and meas_rate. The piezos are first swept to the start of
+        the path.
+        Specify the channels you want to monitor as a list.
+        Returns (output voltage dictionary, input voltage dictionary)
+        '''
+        if sweep_rate is None:
+            sweep_rate = self._max_sweep_rate
+        if meas_rate is None:
+            meas_rate = sweep_rate/self._max_step_size
+
+        if sweep_rate > self._max_sweep_rate:
+            raise Exception('Sweeping piezos too fast! Max is %i V/s!' %self._max_sweep_rate)
+
+        step_size = sweep_rate/meas_rate # default: 0.2 V
+        if step_size > self._max_step_size:
+            raise Exception('Sweeping piezos too choppily! Decrease sweep_rate or increase meas_rate to increase the step size!')
+
+        voltages = {k: np.array(v, dtype=float) for k, v in voltages.items()}
+
+        # Check voltage limits on the whole path at once
+        for k, v in voltages.items():
+            getattr(self,k).check_lim(v)
+
+        # Sweep to the start of the path
+        self.V = {k: v[0] for k, v in voltages.items()}
+
+        # Parametrize the path by the largest distance moved by any piezo
+        # and resample with equal steps along that parameter.
+        steps = np.max([abs(np.diff(v)) for v in voltages.values()], axis=0)
+        s = np.concatenate([[0], np.cumsum(steps)])
+        numsteps = int(s[-1]/step_size)+1
+        s_new = np.linspace(0, s[-1], numsteps)
+
+        output_data = {}
+        for k, v in voltages.items():
+            output_data[k] = np.interp(s_new, s, v)
+            voltages[k] = getattr(self,k).remove_gain(output_data[k])
+
+        received = self._daq.send_receive(voltages, chan_in=chan_in,
+                                          sample_rate=meas_rate)
+
+        # Keep track of current voltage
+        for k in output_data:
+            self._V[k] = output_data[k][-1]
+
+        return output_data, received
+
     # def sweep_surface(self, voltages, chan_in=None, sweep_rate=180, meas_rate=900):
     #     '''
     #     Sweeps piezos using arrays given in a voltage dictionary.
@@ -1,9 +1,20 @@
 from .instrument import VISAInstrument
-import numpy as np
+import numpy as np, time
 
 class SR760(VISAInstrument):
+    '''
+    SR760 FFT spectrum analyzer.
+    Spectra are read in binary (SPEB?, 400 bins in one transfer) rather than
+    bin by bin. With averaging on, a spectrum is read once the instrument
+    reports that averaging is complete:
+        >> sr760.setup_psd()
+        >> sr760.set_averaging(30)
+        >> f, V = sr760.acquire()  # restart averaging, wait, read
+        >> for f, V in sr760.spectra(10):  # re-triggers after each spectrum
+    '''
     _idn = 'SR760'
     _NUM_BINS = 400
+    _AVG_DONE_BIT = 1  # "averaging complete" bit of the FFT status byte
 
     def __init__(self, gpib_address=''):
         if type(gpib_address) is int:
@@ -21,17 +32,100 @@ class SR760(VISAInstrument):
         return super().query(cmd+'\n', timeout)
 
 
-    def get_spectrum(self):
-        trace = 0
+    def acquire(self, trace=0, timeout=None):
+        '''
+        Restart averaging, wait until it is complete and read the spectrum.
+        timeout: s to wait for averaging (None: forever)
+        Returns f, V (see get_spectrum)
+        '''
+        self.start()
+        self.wait_for_average(timeout)
+        return self.get_spectrum(trace)
+
 
-        self.f = np.full(self._NUM_BINS, np.nan)
-        self.V = np.full(self._NUM_BINS, np.nan)
+    def averaging_done(self):
+        '''
+        True if averaging has completed since the status was last read.
+        '''
+        return bool(int(self.query('FFTS? %i' %self._AVG_DONE_BIT)))
+
+
+    def get_frequencies(self, trace=0):
+        '''
+        Frequencies (Hz) of the bins of a trace. The bins are evenly spaced,
+        so only the first and last are queried.
+        '''
+        f0 = float(self.query('BVAL? %i, %i' %(trace, 0)))
+        f1 = float(self.query('BVAL? %i, %i' %(trace, self._NUM_BINS-1)))
+        return np.linspace(f0, f1, self._NUM_BINS)
+
+
+    def get_spectrum(self, trace=0, binary=True):
+        '''
+        Read a trace, in the units shown on the instrument (see setup_psd).
+        binary: transfer the trace as 400 4-byte floats (SPEB?) instead of
+            one ASCII query per bin (SPEC?).
+        Returns:
+        f (np.ndarray): frequencies (Hz)
+        V (np.ndarray): value of each bin
+        '''
+        if binary:
+            self._visa_handle.write('SPEB? %i' %trace)
+            data = self._visa_handle.read_bytes(4*self._NUM_BINS)
+            V = np.frombuffer(data, dtype='<f4').astype(float)
+            return self.get_frequencies(trace), V
+
+        f = np.full(self._NUM_BINS, np.nan)
+        V = np.full(self._NUM_BINS, np.nan)
 
         for nbin in range(self._NUM_BINS):
-            f = self.query('BVAL? %i, %i' % (trace, nbin))
-            V = self.query('SPEC? %i, %i' % (trace, nbin))
+            f[nbin] = float(self.query('BVAL? %i, %i' % (trace, nbin)))
+            V[nbin] = float(self.query('SPEC? %i, %i' % (trace, nbin)))
+
+        return f, V
 
-            self.f[nbin] = float(f)
-            self.V[nbin] = float(V)
 
-        return self.f, self.V
+    def set_averaging(self, averages, on=True):
+        '''
+        Set the number of averages and turn averaging on or off.
+        '''
+        self.write('NAVG %i' %averages)
+        self.write('AVGO %i' %int(on))
+
+
+    def setup_psd(self, trace=0):
+        '''
+        Show a trace as power spectral density in Vrms/sqrt(Hz).
+        '''
+        self.write('MEAS %i, 1' %trace)  # PSD
+        self.write('UNIT %i, 1' %trace)  # Vrms
+
+
+    def spectra(self, num=None, trace=0, timeout=None):
+        '''
+        Generator of spectra (f, V): averaging is restarted after each
+        spectrum is read. Stops after num spectra (None: never).
+        '''
+        n = 0
+        while num is None or n < num:
+            yield self.acquire(trace, timeout)
+            n += 1
+
+
+    def start(self):
+        '''
+        Start (restart) the measurement and averaging.
+        '''
+        self.averaging_done()  # clear a stale status bit
+        self.write('STRT')
+
+
+    def wait_for_average(self, timeout=None, wait=0.05):
+        '''
+        Wait until averaging is complete, polling the status every wait s.
+        '''
+        tstart = time.time()
+        while not self.averaging_done():
+            if timeout is not None and time.time() - tstart > timeout:
+                raise Exception('SR760 averaging did not complete!')
+            time.sleep(wait)
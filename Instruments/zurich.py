@@ -2,6 +2,7 @@
 
 import time, numpy as np
 from .instrument import Instrument
+from ..Utilities.utilities import AttrDict, RingBuffer
 try:
     import zhinst.ziPython as ziP
     import zhinst.utils as utils
@@ -16,6 +17,7 @@ class Zurich(Instrument):
 
     _label = 'Zurich'
     device_id = None
+    _clockbase = None
 
     def __init__(self, device_serial, in_channel = 1, meas_type='V'):
             '''
@@ -112,6 +114,17 @@ class Zurich(Instrument):
             time.sleep(sleep_time-.5)  # wait for autoranging to complete
 
 
+    @property
+    def clockbase(self):
+        '''
+        Clock frequency of the timestamps (read once).
+        '''
+        if self._clockbase is None:
+            self._clockbase = float(self.daq.getInt(
+                                    "/{}/clockbase".format(self.device_id)))
+        return self._clockbase
+
+
     def get(self, param):
         '''
         Get a parameter from the lockin.
@@ -141,6 +154,17 @@ class Zurich(Instrument):
         return self.daq.get(param, True)[param]['value'][0]
 
 
+    def stream(self, demods=None, rate=None, buffer_size=2**20):
+        '''
+        Returns a DemodStream of demodulator samples from this lockin.
+        demods: demodulator numbers. None: the one read by X and Y.
+        rate: demodulator sample rate (Hz); None: leave as is.
+        '''
+        if demods is None:
+            demods = [(self.in_channel-1)*3]
+        return DemodStream(self.daq, self.device_id, demods, rate, buffer_size)
+
+
     def setup_OL_detect(self):
         '''
         Use the threshold unit to send a binary 1 to digital input if detect an overload on the input.
@@ -166,12 +190,20 @@ class MFLI(Zurich):
 
     '''
     MFLI - additional functionality for scope that may be different from HF2LI
+
+    The scope and data acquisition modules are configured once and reused for
+    repeated traces with the same settings (see get_scope_trace and
+    get_demod_continuous). close_modules() stops them.
     '''
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
         self.scope = self.daq.scopeModule()
         self.scope.subscribe('/%s/scopes/0/wave' %self.device_id)
+        self._scope_config = None
+        self._scope_running = False
+        self._daq_module = None
+        self._daq_module_config = None
 
     def _setup_scope(self, freq=60e6, N=16384, input_ch=0):
         '''
@@ -206,18 +238,21 @@ class MFLI(Zurich):
         daq.sync()
 
         scope.set('scopeModule/clearhistory', 1)
+        self._scope_config = (freq, N, input_ch)
 
-
-    def get_demod_continuous(self, freq=60e6, N=16384, demod=0):
+    def _setup_daq_module(self, freq, N, demod):
         '''
-        Returns arrays of time values, X components, and Y components.
-
-        freq - sampling rate (Hz). Arbitrary value.
-        N - length (pts). 2^14 = 16384 by default.
-        demod - Demod number. 0 by default.
+        Create (once) and configure the data acquisition module for
+        get_demod_continuous.
         '''
-        h = self.daq.dataAcquisitionModule()
-        h.set("dataAcquisitionModule/device", self.device_id)
+        h = self._daq_module
+        if h is None:
+            h = self.daq.dataAcquisitionModule()
+            h.set("dataAcquisitionModule/device", self.device_id)
+            self._daq_module = h
+        elif self._daq_module_config is not None:
+            h.unsubscribe('*')
+
         h.set("dataAcquisitionModule/type", 0) # continuous acquisition
         h.set("dataAcquisitionModule/grid/mode", 2) # linear interpolation between samples if sampling rate does not match
         h.set("dataAcquisitionModule/count", 1) # get all data in one shot
@@ -228,49 +263,88 @@ class MFLI(Zurich):
         py = '/%s/demods/%i/sample.y' %(self.device_id, demod)
         h.subscribe(px)
         h.subscribe(py)
+        self._daq_module_config = (freq, N, demod)
+
+    def get_demod_continuous(self, freq=60e6, N=16384, demod=0, timeout=None):
+        '''
+        Returns arrays of time values, X components, and Y components.
+
+        freq - sampling rate (Hz). Arbitrary value.
+        N - length (pts). 2^14 = 16384 by default.
+        demod - Demod number. 0 by default.
+        timeout - time (s) to wait for the data. None: 10 s plus the
+            acquisition time.
+
+        The data acquisition module is kept between calls and only
+        reconfigured when freq, N or demod change.
+        '''
+        px = '/%s/demods/%i/sample.x' %(self.device_id, demod)
+        py = '/%s/demods/%i/sample.y' %(self.device_id, demod)
+        if self._daq_module_config != (freq, N, demod):
+            self._setup_daq_module(freq, N, demod)
+        h = self._daq_module
+
+        if timeout is None:
+            timeout = 10 + N/freq
 
         # Start recording data.
         h.execute()
-        while not h.finished():
-            time.sleep(.1)
-        data = h.read(True)
-        # Destroy the instance of the module.
-        h.clear()
+        try:
+            _wait_for(h.finished, timeout)
+            data = h.read(True)
+        except:
+            self.close_modules()
+            raise
 
-        clockbase = float(self.daq.getInt("/{}/clockbase".format(self.device_id)))
         timestamps = data[px][0]['timestamp'][0]
-        ts = (timestamps-timestamps[0])/clockbase
+        ts = (timestamps-timestamps[0])/self.clockbase
         xs = data[px][0]['value'][0]
         ys = data[py][0]['value'][0]
 
         return ts, xs, ys
 
-    def get_scope_trace(self, freq=60e6, N=16384, input_ch=0):
+    def get_scope_trace(self, freq=60e6, N=16384, input_ch=0, timeout=None):
         '''
         Returns a tuple (array of time values, array of scope input values)
         Parameters:
         freq - sampling rate (Hz). Must be in MFLI.freq_opts.
         N - Length (pts).  2^14 = 16384 by default.
         input_ch - Input channel. 0 = "Signal Input 1"; 9 = "Aux Input 2"
+        timeout - time (s) to wait for the trace. None: 10 s plus the
+            trace length.
+
+        The scope is only configured when the parameters change, and the
+        scope module keeps running between traces, so repeated traces
+        (e.g. averaging in ZurichSpectrum) run at the scope's rate.
         '''
-        self._setup_scope(freq, N, input_ch)
+        if self._scope_config != (freq, N, input_ch):
+            self._setup_scope(freq, N, input_ch)
 
         scope = self.scope
         daq = self.daq
 
-        try:  # In a try block so scope.finish() runs in finally
+        if timeout is None:
+            timeout = 10 + N/freq
+
+        try:
+            scope.set('scopeModule/clearhistory', 1)
+            if not self._scope_running:
+                scope.execute()
+                self._scope_running = True
+
             daq.setInt('/%s/scopes/0/enable' %self.device_id, 1)
             daq.sync()
 
-            scope.execute()
-
-            while scope.progress() < 1:
-                time.sleep(0.01)
+            # The module keeps running, so wait for a new record rather
+            # than on progress; clearhistory resets the record count.
+            _wait_for(lambda: scope.getInt('scopeModule/records') >= 1,
+                      timeout)
 
             daq.setInt('/%s/scopes/0/enable' %self.device_id, 0)
             rawdata=scope.read()
-        finally:
-            scope.finish()
+        except:
+            self.close_modules()
+            raise
 
         data = rawdata[self.device_id]['scopes']['0']['wave'][0][0]
 
@@ -287,3 +361,285 @@ class MFLI(Zurich):
         time_array = np.linspace(0, dt*N, N)
 
         return time_array, data_array
+
+    def close_modules(self):
+        '''
+        Stop the scope module and clear the data acquisition module.
+        They are set up again by the next trace.
+        '''
+        if self._scope_running:
+            try:
+                self.daq.setInt('/%s/scopes/0/enable' %self.device_id, 0)
+                self.scope.finish()
+            except Exception as e:
+                print('Could not stop the scope module: %s' %e)
+            self._scope_running = False
+        self._scope_config = None
+        if self._daq_module is not None:
+            try:
+                self._daq_module.clear()
+            except Exception as e:
+                print('Could not clear the data acquisition module: %s' %e)
+            self._daq_module = None
+            self._daq_module_config = None
+
+
+def _wait_for(done, timeout, wait=1e-3, max_wait=20e-3):
+    '''
+    Poll done() until it returns True, starting with short waits (wait)
+    that grow up to max_wait, so fast acquisitions return quickly without
+    busy waiting on slow ones. Raises an Exception after timeout seconds.
+    '''
+    tstart = time.time()
+    while not done():
+        if time.time() - tstart > timeout:
+            raise Exception('Zurich acquisition timed out after %g s!' %timeout)
+        time.sleep(wait)
+        wait = min(2 * wait, max_wait)
+
+
+class DemodStream(object):
+    '''
+    Streams demodulator samples from a Zurich lockin (HF2LI or MFLI).
+    The sample nodes are subscribed once and polled. The timestamped samples
+    (t in s since the first sample, x and y) go into a RingBuffer for each
+    demodulator, so high-rate demod data can be used like DAQ inputs.
+        >> with zurich.stream(demods=[0], rate=1e3) as s:
+        >>     data = s.monitor(1)  # like daq.monitor: t, x0, y0
+        >>     for chunk in s.chunks(1000, num_chunks=10):
+        >>         chunk[0].t, chunk[0].x, chunk[0].y
+    '''
+    def __init__(self, daq, device_id, demods=[0], rate=None,
+                 buffer_size=2**20, poll_time=0.05):
+        '''
+        daq: ziDAQServer session (Zurich.daq), or a FakeDemodServer
+        device_id: e.g. 'dev3447'
+        demods: demodulator numbers
+        rate: demodulator sample rate (Hz) to set; None: leave as is
+        buffer_size: number of samples kept for each demodulator
+        poll_time: time (s) each poll collects data for
+        '''
+        self.daq = daq
+        self.device_id = device_id.lower()
+        self.demods = list(demods)
+        self.rate = rate
+        self.poll_time = poll_time
+        self.buffers = {d: RingBuffer(buffer_size, ['t', 'x', 'y'])
+                        for d in self.demods}
+        self.running = False
+        self._t0 = None
+        self._clockbase = None
+
+
+    def __enter__(self):
+        return self.start()
+
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+    def __iter__(self):
+        '''
+        Poll forever (until stopped), yielding the new samples of each
+        demodulator (see read).
+        '''
+        while self.running:
+            self.poll()
+            yield self.read()
+
+
+    def _path(self, demod):
+        return '/%s/demods/%i/sample' %(self.device_id, demod)
+
+
+    def start(self):
+        '''
+        Enable the demodulators, set their rate and subscribe to them.
+        '''
+        for d in self.demods:
+            if self.rate is not None:
+                self.daq.setDouble('/%s/demods/%i/rate' %(self.device_id, d),
+                                   self.rate)
+            self.daq.setInt('/%s/demods/%i/enable' %(self.device_id, d), 1)
+            self.daq.subscribe(self._path(d))
+        self.daq.sync()  # discard data from before
+        self._clockbase = float(self.daq.getInt('/%s/clockbase'
+                                                %self.device_id))
+        self.running = True
+        return self
+
+
+    def stop(self):
+        '''
+        Unsubscribe from the demodulators. Buffered samples can still be read.
+        '''
+        for d in self.demods:
+            self.daq.unsubscribe(self._path(d))
+        self.running = False
+
+
+    def poll(self, poll_time=None):
+        '''
+        Collect data for poll_time seconds (self.poll_time if None) and add
+        the samples to the buffers.
+        Returns a dictionary of the number of new samples per demodulator.
+        '''
+        if not self.running:
+            raise Exception('Demod stream not started!')
+        if poll_time is None:
+            poll_time = self.poll_time
+        data = self.daq.poll(poll_time, int(1000*poll_time) + 100, 0, True)
+
+        new = {}
+        for d in self.demods:
+            sample = data.get(self._path(d))
+            if sample is None or len(sample['timestamp']) == 0:
+                new[d] = 0
+                continue
+            ts = np.asarray(sample['timestamp'], dtype=float)
+            if self._t0 is None:
+                self._t0 = ts[0]
+            self.buffers[d].extend(t=(ts - self._t0) / self._clockbase,
+                                   x=sample['x'], y=sample['y'])
+            new[d] = len(ts)
+        return new
+
+
+    def read(self):
+        '''
+        Returns the samples not read yet: a dictionary with an AttrDict
+        (t, x, y) for each demodulator.
+        '''
+        return {d: self.buffers[d].read() for d in self.demods}
+
+
+    def chunks(self, size, num_chunks=None, timeout=10):
+        '''
+        Generator of chunks of exactly size new samples of each demodulator
+        (dictionaries as returned by read). Stops after num_chunks chunks
+        (None: never). Raises an Exception if a chunk is not complete after
+        timeout seconds.
+        '''
+        n = 0
+        while num_chunks is None or n < num_chunks:
+            tstart = time.time()
+            while any(self.buffers[d].unread < size for d in self.demods):
+                if time.time() - tstart > timeout:
+                    raise Exception('Demod stream timed out!')
+                self.poll()
+            yield {d: self.buffers[d].read(size) for d in self.demods}
+            n += 1
+
+
+    def monitor(self, duration, timeout=None):
+        '''
+        Collect samples for duration seconds, like NIDAQ.monitor.
+        Samples buffered (here or on the data server) from before the call
+        are discarded, and the samples are cut to duration by timestamp.
+        Returns an AttrDict with t (times of the first demodulator) and
+        x<n>, y<n> for each demodulator n (and t<n> for the others, whose
+        samples may not line up with the first).
+        timeout: s to wait for the data (None: 10 * duration + 1)
+        '''
+        if timeout is None:
+            timeout = 10 * duration + 1
+
+        # Discard older samples
+        self.daq.sync()
+        self.poll(0)
+        self.read()
+
+        pieces = {d: [] for d in self.demods}
+        t0 = None
+        tlast = {d: -np.inf for d in self.demods}
+        tstart = time.time()
+        while t0 is None or min(tlast.values()) < t0 + duration:
+            if time.time() - tstart > timeout:
+                raise Exception('Demod stream timed out!')
+            self.poll(min(self.poll_time, duration))
+            for d, new in self.read().items():
+                if len(new.t) == 0:
+                    continue
+                pieces[d].append(new)
+                tlast[d] = new.t[-1]
+                if t0 is None and d == self.demods[0]:
+                    t0 = new.t[0]
+
+        received = AttrDict()
+        for d in self.demods:
+            t, x, y = [np.concatenate([p[k] for p in pieces[d]])
+                       for k in ('t', 'x', 'y')]
+            keep = (t >= t0) & (t < t0 + duration)
+            received['t' if d == self.demods[0] else 't%i' %d] = t[keep]
+            received['x%i' %d] = x[keep]
+            received['y%i' %d] = y[keep]
+        return received
+
+
+class FakeDemodServer(object):
+    '''
+    Stand-in for a ziDAQServer session, to test DemodStream (and code using
+    it) without an instrument. Subscribed demodulators produce samples at
+    their rate (1 kHz unless set) with a 60 MHz timestamp clock:
+    x = amplitude + noise, y = noise.
+        >> s = DemodStream(FakeDemodServer(), 'dev0', demods=[0], rate=1e4)
+    '''
+    clockbase = 60e6
+
+    def __init__(self, amplitude=1e-3, noise=1e-5, seed=0):
+        self.amplitude = amplitude
+        self.noise = noise
+        self.settings = {}
+        self.subscribed = {}  # path: time of the last sample (s)
+        self._rng = np.random.RandomState(seed)
+        self._tstart = time.time()
+
+
+    def _now(self):
+        return time.time() - self._tstart
+
+
+    def setInt(self, path, value):
+        self.settings[path.lower()] = value
+
+
+    def setDouble(self, path, value):
+        self.settings[path.lower()] = value
+
+
+    def getInt(self, path):
+        if path.lower().endswith('clockbase'):
+            return int(self.clockbase)
+        return int(self.settings.get(path.lower(), 0))
+
+
+    def subscribe(self, path):
+        self.subscribed[path.lower()] = self._now()
+
+
+    def unsubscribe(self, path):
+        self.subscribed.pop(path.lower(), None)
+
+
+    def sync(self):
+        now = self._now()
+        for path in self.subscribed:
+            self.subscribed[path] = now
+
+
+    def poll(self, recording_time, timeout, flags=0, flat=False):
+        time.sleep(recording_time)
+        now = self._now()
+        data = {}
+        for path, last in self.subscribed.items():
+            rate = self.settings.get(path.rsplit('/', 1)[0] + '/rate', 1e3)
+            n = int((now - last) * rate)
+            t = last + np.arange(1, n + 1) / rate
+            self.subscribed[path] = last + n / rate
+            data[path] = {
+                'timestamp': np.round(t * self.clockbase).astype(np.uint64),
+                'x': self.amplitude + self.noise * self._rng.randn(n),
+                'y': self.noise * self._rng.randn(n),
+            }
+        return data
@@ -1,10 +1,14 @@
 from .spectrum import DaqSpectrum
+from .noisemonitor import NoiseMonitor
 from .squidIV import SquidIV
 from .mod2D import Mod2D
 from .mutual_inductance import MutualInductance
 from .planefit import Planefit
 from .scanline import Scanline
 from .scanplane import Scanplane
+from .scanpath import Scanpath
+from .scanaverage import ScanplaneAverage
+from .adaptivescan import AdaptiveScanplane
 from .touchdown import Touchdown
 from .heightsweep import Heightsweep
 from .scanspectra import Scanspectra
@@ -0,0 +1,245 @@
+import time, matplotlib, matplotlib.pyplot as plt, numpy as np
+from scipy import ndimage
+from scipy.interpolate import RegularGridInterpolator
+
+from .measurement import Measurement
+from .scanplane import Scanplane, setup_scan_images
+from ..Utilities.utilities import AttrDict
+
+
+class AdaptiveScanplane(Measurement):
+    '''
+    Two-pass scan: a coarse Scanplane maps the whole area, then regions
+    where the signal changes (large local gradient or variance) are
+    rescanned refine times more densely with Scanplanes over just those
+    regions. Both passes use the plane for z, so every line is checked
+    against the piezo limits as in Scanplane.
+
+    The results are merged on one grid with the fine spacing:
+        V (AttrDict): merged data. Pixels outside the rescanned regions are
+            linearly interpolated from the coarse scan.
+        level (array): 1 where the pixel was rescanned, 0 where it comes
+            from the coarse scan.
+        Vcoarse (AttrDict): the coarse scan
+        regions (array): (num_regions, 4) [Vx1, Vx2, Vy1, Vy2] of each
+            rescanned region
+    '''
+    _daq_inputs = Scanplane._daq_inputs
+    _conversions = Scanplane._conversions
+    _units = Scanplane._units
+    instrument_list = Scanplane.instrument_list
+
+
+    def __init__(self, instruments={}, plane=None, span=[800, 800],
+                 center=[0, 0], numpts=[20, 20], scanheight=15, scan_rate=60,
+                 refine=4, metric='gradient', chans=['dc'], threshold=None,
+                 fraction=0.2, pad=1, max_regions=10):
+        '''
+        span, center, numpts: coarse scan (as for Scanplane).
+        refine: ratio of the coarse to the fine pixel spacing.
+        metric: 'gradient' (magnitude of the local gradient) or 'variance'
+            (variance in a 3x3 neighborhood) of the coarse scan, used to
+            pick the regions to rescan.
+        chans: channels used to compute the metric. Each channel is
+            normalized by its (robust) standard deviation and the metrics
+            of all channels are summed.
+        threshold: rescan pixels where the metric exceeds this value
+            (in units of the normalized channels). If None, rescan the
+            given fraction of the coarse pixels with the largest metric.
+        pad: number of coarse pixels added around each region.
+        max_regions: largest number of regions rescanned (largest first).
+        '''
+        super().__init__(instruments=instruments)
+
+        self.plane = plane
+        self.span = span
+        self.center = center
+        self.numpts = numpts
+        self.scanheight = scanheight
+        self.scan_rate = scan_rate
+        self.refine = refine
+        self.metric = metric
+        self.chans = chans
+        self.threshold = threshold
+        self.fraction = fraction
+        self.pad = pad
+        self.max_regions = max_regions
+
+        # Coarse grid
+        x = np.linspace(center[0] - span[0] / 2,
+                        center[0] + span[0] / 2,
+                        numpts[0])
+        y = np.linspace(center[1] - span[1] / 2,
+                        center[1] + span[1] / 2,
+                        numpts[1])
+        self.Xcoarse, self.Ycoarse = np.meshgrid(x, y)
+
+        # Fine grid; includes every point of the coarse grid
+        x = np.linspace(x[0], x[-1], (numpts[0] - 1) * refine + 1)
+        y = np.linspace(y[0], y[-1], (numpts[1] - 1) * refine + 1)
+        self.X, self.Y = np.meshgrid(x, y)
+
+        self.Vcoarse = AttrDict()
+        self.V = AttrDict()
+        for chan in self._daq_inputs:
+            self.Vcoarse[chan] = np.full(self.Xcoarse.shape, np.nan)
+            self.V[chan] = np.full(self.X.shape, np.nan)
+        self.level = np.zeros(self.X.shape)
+        self.score = np.full(self.Xcoarse.shape, np.nan)
+        self.regions = np.zeros((0, 4))
+
+
+    def do(self, plot=True, **kwargs):
+        '''
+        Coarse scan, then rescan the selected regions.
+        Additional kwargs are passed to Scanplane.do
+        (e.g. pipeline=True, fast_axis='y').
+        '''
+        # Coarse pass
+        tstart = time.time()
+        scan = self._scan(self.span, self.center, self.numpts, **kwargs)
+        self.time_coarse = time.time() - tstart
+        for chan in self._daq_inputs:
+            self.Vcoarse[chan] = scan.V[chan]
+        self._merge_coarse()
+        self.plot(plot=plot)
+
+        # Pick the regions to rescan
+        boxes = self.find_regions()
+        r = self.refine
+        tstart = time.time()
+        for (r0, r1), (c0, c1) in boxes:
+            if self.interrupt:
+                break
+            x0, x1 = self.Xcoarse[0, c0], self.Xcoarse[0, c1]
+            y0, y1 = self.Ycoarse[r0, 0], self.Ycoarse[r1, 0]
+            self.regions = np.vstack([self.regions, [x0, x1, y0, y1]])
+
+            # The fine scan points coincide with the merged grid
+            scan = self._scan(span=[x1 - x0, y1 - y0],
+                              center=[(x0 + x1) / 2, (y0 + y1) / 2],
+                              numpts=[(c1 - c0) * r + 1, (r1 - r0) * r + 1],
+                              **kwargs)
+            index = (slice(r0 * r, r1 * r + 1), slice(c0 * r, c1 * r + 1))
+            for chan in self._daq_inputs:
+                self.V[chan][index] = scan.V[chan]
+            self.level[index] = 1
+            self.plot(plot=plot)
+        self.time_fine = time.time() - tstart
+
+        # A uniform fine scan takes about refine times as many lines
+        uniform = self.time_coarse * self.refine
+        print('Rescanned %i regions (%.0f%% of the area). '
+              'Estimated speedup vs. a uniform fine scan: %.1fx' %(
+               len(self.regions), 100 * np.mean(self.level),
+               uniform / (self.time_coarse + self.time_fine)))
+
+
+    def _scan(self, span, center, numpts, **kwargs):
+        '''
+        Take one Scanplane and close its figures.
+        '''
+        scan = Scanplane(self.instruments, plane=self.plane, span=span,
+                         center=center, numpts=numpts,
+                         scanheight=self.scanheight, scan_rate=self.scan_rate)
+        try:
+            scan.do(**kwargs)
+        finally:
+            for fig in scan.fig, getattr(scan, 'fig_cuts', None):
+                if fig is not None:
+                    plt.close(fig)
+        return scan
+
+
+    def _merge_coarse(self):
+        '''
+        Fill the merged grid by linear interpolation of the coarse scan.
+        '''
+        y, x = self.Ycoarse[:, 0], self.Xcoarse[0, :]
+        points = np.stack([self.Y.ravel(), self.X.ravel()], axis=-1)
+        for chan in self._daq_inputs:
+            if len(x) < 2 or len(y) < 2:
+                self.V[chan] = np.array(self.Vcoarse[chan], dtype=float)
+                continue
+            interp = RegularGridInterpolator((y, x), self.Vcoarse[chan])
+            self.V[chan] = interp(points).reshape(self.X.shape)
+
+
+    def find_regions(self):
+        '''
+        Compute the metric on the coarse scan, threshold it and return
+        bounding boxes ((r0, r1), (c0, c1)) of the selected regions
+        (inclusive coarse pixel indices), largest first.
+        '''
+        score = np.zeros(self.Xcoarse.shape)
+        for chan in self.chans:
+            data = np.array(self.Vcoarse[chan], dtype=float)
+            data = data - np.nanmedian(data)
+            mad = np.nanmedian(np.abs(data))  # robust standard deviation
+            if mad > 0:
+                data /= 1.4826 * mad
+            data[np.isnan(data)] = 0
+
+            if self.metric == 'gradient':
+                gy, gx = np.gradient(data)
+                score += np.sqrt(gx ** 2 + gy ** 2)
+            elif self.metric == 'variance':
+                mean = ndimage.uniform_filter(data, 3)
+                score += ndimage.uniform_filter(data ** 2, 3) - mean ** 2
+            else:
+                raise Exception('Metric must be gradient or variance!')
+        self.score = score
+
+        threshold = self.threshold
+        if threshold is None:
+            threshold = np.quantile(score, 1 - self.fraction)
+        mask = score > threshold
+        if self.pad > 0:
+            mask = ndimage.binary_dilation(mask, iterations=self.pad)
+
+        labels, num = ndimage.label(mask)
+        boxes = []
+        for s in ndimage.find_objects(labels):
+            r0, r1 = s[0].start, s[0].stop - 1
+            c0, c1 = s[1].start, s[1].stop - 1
+            if r1 == r0:  # need at least two lines
+                r1 = min(r1 + 1, mask.shape[0] - 1)
+                r0 = r1 - 1
+            if c1 == c0:
+                c1 = min(c1 + 1, mask.shape[1] - 1)
+                c0 = c1 - 1
+            boxes.append(((r0, r1), (c0, c1)))
+
+        # Largest regions first
+        boxes.sort(key=lambda b: (b[0][1] - b[0][0]) * (b[1][1] - b[1][0]),
+                   reverse=True)
+        return boxes[:self.max_regions]
+
+
+    def plot_update(self):
+        '''
+        Update the data for all plots.
+        '''
+        for chan in self._daq_inputs:
+            data = np.array(self.V[chan] * self._conversions[chan],
+                            dtype=float)
+            self.update_image(self.im[chan], data)
+
+            # Outline the rescanned regions
+            ax = self.ax[chan]
+            for p in list(ax.patches):
+                p.remove()
+            for x0, x1, y0, y1 in self.regions:
+                ax.add_patch(matplotlib.patches.Rectangle(
+                    (x0, y0), x1 - x0, y1 - y0, fill=False, ec='k', lw=0.5))
+
+
+    def setup_plots(self):
+        '''
+        Set up all plots.
+        '''
+        self.fig = plt.figure(figsize=(12, 10))
+        setup_scan_images(self, self.fig,
+                          [(2, 2, i+1) for i in range(len(self._daq_inputs))])
+
+        self.fig.tight_layout()
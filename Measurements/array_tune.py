@@ -25,6 +25,8 @@ import Nowack_Lab.Measurements.spectrum
 reload(Nowack_Lab.Measurements.spectrum)
 from Nowack_Lab.Measurements.spectrum import SQUIDSpectrum
 
+from Nowack_Lab.Utilities.spectral import fit_one_over_f, LogBinnedSpectrum
+
 import Nowack_Lab.Measurements.mutual_inductance
 reload(Nowack_Lab.Measurements.mutual_inductance)
 from Nowack_Lab.Measurements.mutual_inductance import MutualInductance2
@@ -883,6 +885,7 @@ class ArrayTuneBatch(Measurement):
                  sbias_ex = 100,
                  aflux_ex = 0,
                  conversion=1/1.44,
+                 bins_per_decade=20,
                  debug=False):
         '''
         Test a squid automatically with a SAA
@@ -891,6 +894,9 @@ class ArrayTuneBatch(Measurement):
 
         live plotting only plots the first element of sflux, all of
         sbias and aflux
+
+        bins_per_decade: spectra are stored log-binned with this many bins
+        per decade (see LogBinnedSpectrum); None stores the full spectra.
         '''
 
         super(ArrayTuneBatch, self).__init__(instruments=instruments)
@@ -904,6 +910,7 @@ class ArrayTuneBatch(Measurement):
         self.sbias_ex = sbias_ex
         self.aflux_ex = aflux_ex
         self.conversion = conversion
+        self.bins_per_decade = bins_per_decade
 
         self.cmap = matplotlib.cm.viridis
         self.cmap.set_bad('white', 1.)
@@ -918,6 +925,7 @@ class ArrayTuneBatch(Measurement):
     def _initialize(self):
 
         self.spectrum_f = np.array([])
+        self.spectrum_counts = np.array([])  # frequencies in each bin
 
         # X axis (0th axis) = array flux (where on the characteristic to lock)
         # Y axis (1th axis) = squid bias
@@ -947,7 +955,7 @@ class ArrayTuneBatch(Measurement):
                                              len(self.sflux),
                                              1), np.nan)
 
-        self.savenames = ['spectrum_psd',  # psdave * conversion (phi_0)
+        self.savenames = ['spectrum_psd',  # Vn * conversion (phi_0/rtHz)
                           'sweep_fcIsrc',  # Vsrc / Rbias (amps)
                           'sweep_sresp',   # Vmeas * conversion (phi_0)
                           'char_testsig',  # squid char, test signal (V)
@@ -978,10 +986,24 @@ class ArrayTuneBatch(Measurement):
                 print(plottingindex)
                 sys.stdout.flush()
 
+        self.fit_one_over_f()
         self.plot()
         self.print_highlights()
 
 
+    def fit_one_over_f(self, fmin=.1, fmax=None, filters=[60], filters_bw=[10]):
+        '''
+        Fit A/f^alpha to all spectra at once (see fit_one_over_f in
+        Utilities/spectral.py) over the frequency range (fmin, fmax) (Hz),
+        with the harmonics of filters removed.
+        Stores spectrum_A (phi_0/rtHz at 1 Hz) and spectrum_alpha, with the
+        shape (sbias, aflux, sflux). NaN where the SQUID did not lock.
+        '''
+        self.spectrum_A, self.spectrum_alpha = fit_one_over_f(
+                                        self.spectrum_f, self.spectrum_psd,
+                                        fmin, fmax, filters, filters_bw)
+
+
 
     def _tunesave(self, index_sb, index_af, index_sf,
                   sbias, aflux, sflux, first=False):
@@ -1000,9 +1022,14 @@ class ArrayTuneBatch(Measurement):
         locked = at.run()
 
         try:
+            f = np.array(at.spectrum.f)
+            Vn = np.array(at.spectrum.Vn * at.spectrum.conversion)
+            if self.bins_per_decade is not None:
+                binned = LogBinnedSpectrum(f, Vn**2, self.bins_per_decade)
+                f, Vn = binned.f, binned.Vn
+                self.spectrum_counts = binned.counts
         # what to save
-            tosave = [np.array(at.spectrum.psdAve *
-                               at.spectrum.conversion).flatten(),
+            tosave = [Vn.flatten(),
                       np.array(at.sweep.Vsrc /
                                at.sweep.Rbias).flatten(),
                       np.array(at.sweep.Vmeas *
@@ -1022,7 +1049,7 @@ class ArrayTuneBatch(Measurement):
                                        tosave,
                                        self.savenames,
                                        self.success.shape[0:3])
-            self.spectrum_f = np.array(at.spectrum.f)
+            self.spectrum_f = f
             return
 
         # did ArrayTune lock?
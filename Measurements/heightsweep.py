@@ -61,7 +61,8 @@ class Heightsweep(Measurement):
         Vstart = {'z': self.zstart}
         Vend = {'z': self.zend}
 
-        self.piezos.V = {'x':self.x, 'y':self.y, 'z': Vstart['z']}
+        self.plane.move_to(self.piezos,
+                           {'x':self.x, 'y':self.y, 'z': Vstart['z']})
         self.squidarray.reset()
         time.sleep(10) # wait at the surface
 
@@ -0,0 +1,385 @@
+import numpy as np, h5py, time, matplotlib.pyplot as plt
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from .measurement import Measurement
+from ..Utilities.utilities import AttrDict
+from ..Utilities.spectral import PSDAccumulator, band_rms
+
+
+class NoiseMonitor(Measurement):
+    '''
+    Long-running spectrogram of a DAQ channel, to catch noise drifts.
+
+    Time traces are acquired back to back and their Welch PSDs averaged in a
+    worker thread while the next trace is acquired. Every interval seconds
+    the averaged PSD (log-binned if bins_per_decade is given) and the RMS
+    spectral density in each band are appended to a separate HDF5 file
+    (self.noise_filename), so memory use does not grow however long it runs:
+        t (N,): time of each PSD (s since epoch, middle of the interval)
+        psd (N, Nf): PSD (V^2/Hz), f (Nf,): frequencies
+        band_rms (N, num_bands): RMS spectral density in each band (V/rtHz)
+        num_traces (N,): number of time traces averaged in each PSD
+        dropouts (M,): times when the DAQ could not be read
+
+    An alert is given when the noise in a band goes above its threshold
+    (see alert). If reading the DAQ fails (e.g. it was disconnected), the
+    current PSD is discarded, the DAQ is reconnected (see reconnect) and
+    monitoring goes on.
+
+    The last history PSD times and band values are kept in t_recent and
+    band_recent for plotting; psd_latest is the last PSD.
+        >> nm = NoiseMonitor(instruments, interval=60, thresholds=[1e-5, None, None])
+        >> nm.run()  # until interrupted
+        >> nm.load_trends()
+    '''
+    _daq_inputs = ['dc']
+    instrument_list = ['daq'] # 'preamp' optional
+    units = 'V'
+    conversion = 1
+    num_psds = 0
+    num_dropouts = 0
+    num_alerts = 0
+
+    def __init__(self, instruments={}, interval=10, measure_time=1,
+                 sample_rate=10000, window='hann', nperseg=None,
+                 bands=[[0.5, 2], [5, 20], [500, 2000]], thresholds=None,
+                 bins_per_decade=20, duration=None, history=8640,
+                 retry_wait=10, preamp_gain=1):
+        '''
+        Args:
+        instruments (dict): instruments used to collect data
+        interval (float): time (s) over which time traces are averaged into
+            each PSD
+        measure_time (float): length (s) of each time trace
+        sample_rate (float): DAQ sample rate (Hz)
+        window (str), nperseg (int): window and segment length of Welch's
+            method. nperseg None: a whole time trace.
+        bands (list): [[fmin, fmax], ...] (Hz) bands whose noise is tracked;
+            by default around 1 Hz, 10 Hz and 1 kHz
+        thresholds (list): alert when the RMS spectral density in a band
+            exceeds its threshold (V/rtHz). None (for all or one band):
+            no alerts.
+        bins_per_decade (int): PSDs are saved log-binned with this many
+            bins per decade; None saves the full PSDs.
+        duration (float): how long (s) to monitor. None: until interrupted.
+        history (int): number of PSDs whose band values are kept in memory
+            for plotting (8640: one day at 10 s intervals)
+        retry_wait (float): time (s) to wait before reconnecting after the
+            DAQ could not be read
+        preamp_gain (float): gain factor from preamp (if no preamp loaded)
+        '''
+        super().__init__(instruments=instruments)
+
+        for arg in ['interval', 'measure_time', 'sample_rate', 'window',
+                    'nperseg', 'bands', 'bins_per_decade', 'duration',
+                    'history', 'retry_wait', 'preamp_gain']:
+            setattr(self, arg, eval(arg))
+        if thresholds is None:
+            thresholds = [None] * len(bands)
+        if len(thresholds) != len(bands):
+            raise Exception('Need one threshold for each band!')
+        self.thresholds = thresholds
+
+        self.t_recent = np.full(history, np.nan)
+        self.band_recent = np.full((history, len(bands)), np.nan)
+        self.above = np.zeros(len(bands), dtype=bool)
+        self.f = np.array([])
+        self.psd_latest = np.array([])
+
+
+    def do(self, plot=True, **kwargs):
+        '''
+        Monitor until interrupted or for duration seconds.
+        '''
+        self.setup_preamp()
+        localpath, remotepath = self._make_paths(None)
+        self.noise_filename = localpath + '_noise.h5'
+        self.tstart = time.time()
+        self.num_psds = 0
+        self.num_dropouts = 0
+        self.num_alerts = 0
+
+        gain = self.get_gain()
+        acc = self._new_accumulator()
+        tinterval = time.time()
+        future = None
+        with ThreadPoolExecutor(1) as pool:
+            while not self.interrupt:
+                if self.duration is not None \
+                        and time.time() - self.tstart > self.duration:
+                    break
+                try:
+                    t, V = self.get_time_trace()
+                except Exception as e:
+                    if future is not None:
+                        future.result()
+                        future = None
+                    self._dropout(e)
+                    # The PSD would contain a gap; start a new one
+                    acc = self._new_accumulator()
+                    tinterval = time.time()
+                    continue
+
+                # Wait for the PSD of the previous trace
+                if future is not None:
+                    future.result()
+                future = pool.submit(acc.add, V / gain)
+
+                now = time.time()
+                if now - tinterval >= self.interval:
+                    future.result()
+                    future = None
+                    self._append_psd(acc, (tinterval + now) / 2)
+                    acc = self._new_accumulator()
+                    tinterval = now
+                    self.plot(plot=plot)
+
+            if future is not None:
+                future.result()
+        if acc.count:  # last, partial interval
+            self._append_psd(acc, (tinterval + time.time()) / 2)
+        self.plot(plot=plot)
+
+
+    def _new_accumulator(self):
+        '''
+        Welch PSD accumulator for the next interval.
+        '''
+        nperseg = self.nperseg or int(self.measure_time * self.sample_rate)
+        return PSDAccumulator(self.sample_rate, 'welch', self.window, nperseg)
+
+
+    def _append_psd(self, acc, t):
+        '''
+        Append the PSD of an interval and its band values to the file,
+        update the recent history and check for alerts.
+        '''
+        f, psd = acc.f, acc.mean
+        bands = band_rms(f, psd, self.bands)
+        if self.bins_per_decade is not None:
+            binned = acc.engine.log_binned(f, psd, self.bins_per_decade,
+                                           self.units)
+            f, psd = binned.f, binned.psd
+        self.f = f
+        self.psd_latest = psd
+
+        with h5py.File(self.noise_filename, 'a') as fh:
+            if 'psd' not in fh:
+                fh.create_dataset('f', data=f)
+                for name, shape in [('t', ()), ('psd', (len(f),)),
+                                    ('band_rms', (len(self.bands),)),
+                                    ('num_traces', ())]:
+                    fh.create_dataset(name, (0,) + shape,
+                                      maxshape=(None,) + shape,
+                                      dtype=np.dtype('float64'),
+                                      chunks=(64,) + shape)
+                fh['band_rms'].attrs['bands'] = np.array(self.bands,
+                                                         dtype=float)
+            for name, value in [('t', t), ('psd', psd), ('band_rms', bands),
+                                ('num_traces', acc.count)]:
+                _append(fh, name, value)
+        self.num_psds += 1
+
+        # Keep the last history values
+        self.t_recent = np.roll(self.t_recent, -1)
+        self.t_recent[-1] = t
+        self.band_recent = np.roll(self.band_recent, -1, axis=0)
+        self.band_recent[-1] = bands
+
+        self._check_thresholds(bands, t)
+
+
+    def _check_thresholds(self, bands, t):
+        '''
+        Give an alert when a band goes above its threshold, and a message
+        when it comes back below.
+        '''
+        for k, (value, threshold) in enumerate(zip(bands, self.thresholds)):
+            if threshold is None or np.isnan(value):
+                continue
+            if value > threshold and not self.above[k]:
+                self.above[k] = True
+                self.num_alerts += 1
+                self.alert(k, value, t)
+            elif value <= threshold and self.above[k]:
+                self.above[k] = False
+                print('%s: %g-%g Hz noise back below threshold (%.3g %s/rtHz).'
+                      %(_timestamp(t), *self.bands[k], value, self.units))
+
+
+    def alert(self, band, value, t):
+        '''
+        Called when the noise in bands[band] goes above its threshold.
+        Prints a message; overwrite (or assign) for other notifications.
+        '''
+        print('%s: ALERT! %g-%g Hz noise %.3g %s/rtHz is above threshold %.3g'
+              %(_timestamp(t), *self.bands[band], value, self.units,
+                self.thresholds[band]))
+
+
+    def _dropout(self, e):
+        '''
+        Record a failed DAQ read, wait and try to reconnect.
+        '''
+        t = time.time()
+        self.num_dropouts += 1
+        print('%s: could not read the DAQ (%s). Reconnecting in %g s.'
+              %(_timestamp(t), e, self.retry_wait))
+        with h5py.File(self.noise_filename, 'a') as fh:
+            if 'dropouts' not in fh:
+                fh.create_dataset('dropouts', (0,), maxshape=(None,),
+                                  dtype=np.dtype('float64'), chunks=(64,))
+            _append(fh, 'dropouts', t)
+        time.sleep(self.retry_wait)
+        try:
+            self.reconnect()
+        except Exception as e:
+            print('Reconnecting failed: %s' %e)
+
+
+    def reconnect(self):
+        '''
+        Close the DAQ and create it again (e.g. after it was unplugged),
+        keeping its input and output labels.
+        '''
+        old = self.daq
+        cls = old.__class__
+        inputs, outputs = old.input_names, old.output_names
+        kwargs = dict(dev_name=old._dev_name, input_range=old._input_range,
+                      output_range=old._output_range)
+        try:
+            old.close()
+        except Exception as e:
+            print('Could not close the DAQ: %s' %e)
+        del old, self.daq
+        self.daq = cls(**kwargs)
+        self.daq.inputs = inputs
+        self.daq.outputs = outputs
+        self.instruments['daq'] = self.daq
+
+
+    def get_gain(self):
+        '''
+        Gain of the preamp (or preamp_gain if there is no preamp).
+        '''
+        if hasattr(self, 'preamp'):
+            return self.preamp.gain
+        return self.preamp_gain
+
+
+    def get_time_trace(self):
+        '''
+        Collect a single time trace from the DAQ.
+        '''
+        received = self.daq.monitor('dc', self.measure_time,
+                                    sample_rate=self.sample_rate)
+        return received['t'], received['dc']
+
+
+    def load_trends(self):
+        '''
+        Returns the times (s since epoch) and (N, num_bands) band values of
+        all PSDs saved so far.
+        '''
+        with h5py.File(self.noise_filename, 'r') as fh:
+            return fh['t'][:], fh['band_rms'][:]
+
+
+    def load_spectrogram(self):
+        '''
+        Returns the times (s since epoch), frequencies and (N, Nf) PSDs
+        saved so far.
+        '''
+        with h5py.File(self.noise_filename, 'r') as fh:
+            return fh['t'][:], fh['f'][:], fh['psd'][:]
+
+
+    def save(self, filename=None, **kwargs):
+        '''
+        Save, and copy the file of PSDs to the data server.
+        '''
+        super().save(filename, **kwargs)
+        if hasattr(self, 'noise_filename'):
+            localpath, remotepath = self._make_paths(filename)
+            if remotepath is not None:
+                self._copy_to_remote(localpath + '_noise',
+                                     remotepath + '_noise')
+
+
+    def setup_plots(self):
+        '''
+        Band trends (left) and latest spectral density (right).
+        '''
+        self.fig = plt.figure(figsize=(12, 5))
+        self.ax = AttrDict()
+        self.ax['trend'] = self.fig.add_subplot(121)
+        self.ax['psd'] = self.fig.add_subplot(122)
+        self.lines = AttrDict(trend=[])
+
+        ax = self.ax['trend']
+        for k, (fmin, fmax) in enumerate(self.bands):
+            line, = ax.semilogy([], [], '.-', color='C%i' %k,
+                                label='%g-%g Hz' %(fmin, fmax))
+            self.lines['trend'].append(line)
+            if self.thresholds[k] is not None:
+                ax.axhline(self.thresholds[k] * self.conversion,
+                           color='C%i' %k, ls='--')
+        ax.set_xlabel('Time (h)')
+        ax.set_ylabel(r'Spectral Density ($\mathrm{%s/\sqrt{Hz}}$)'
+                      %self.units)
+        ax.legend(loc='upper left', fontsize=8)
+
+        ax = self.ax['psd']
+        self.lines['psd'], = ax.loglog([], [])
+        ax.set_xlabel('Frequency (Hz)')
+        ax.set_ylabel(r'Spectral Density ($\mathrm{%s/\sqrt{Hz}}$)'
+                      %self.units)
+
+        for ax in self.ax.values():
+            ax.annotate(self.timestamp, xy=(0.02, .02),
+                        xycoords='axes fraction', fontsize=10, ha='left',
+                        va='bottom', family='monospace')
+        self.fig.tight_layout()
+
+
+    def plot_update(self):
+        '''
+        Update the band trends and the latest spectral density.
+        '''
+        hours = (self.t_recent - getattr(self, 'tstart', 0)) / 3600
+        for k, line in enumerate(self.lines['trend']):
+            line.set_data(hours, self.band_recent[:, k] * self.conversion)
+        if len(self.psd_latest):
+            self.lines['psd'].set_data(self.f,
+                                np.sqrt(self.psd_latest) * self.conversion)
+        for ax in self.ax.values():
+            ax.relim()
+            ax.autoscale_view()
+
+
+    def setup_preamp(self):
+        '''
+        Set preamplifier settings appropriate for taking spectra
+        '''
+        if not hasattr(self, 'preamp') or self.preamp is None:
+            print('No preamp!')
+            return
+        self.preamp.dc_coupling()
+        self.preamp.diff_input(False)
+
+
+def _append(fh, name, value):
+    '''
+    Append one row to a resizable dataset.
+    '''
+    d = fh[name]
+    n = d.shape[0]
+    d.resize(n + 1, axis=0)
+    d[n] = value
+
+
+def _timestamp(t):
+    '''
+    Time t (s since epoch) formatted like Saver timestamps.
+    '''
+    return datetime.fromtimestamp(t).strftime('%Y-%m-%d %I:%M:%S %p')
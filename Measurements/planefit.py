@@ -3,7 +3,10 @@ from IPython import display
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 
 from .touchdown import Touchdown
-from ..Utilities.utilities import reject_outliers_plane, fit_plane
+from ..Utilities.utilities import reject_outliers_plane, fit_plane, \
+                                   PlaneEstimator
+from ..Utilities import surface
+from ..Utilities.touchdown_history import TouchdownHistory, atto_position
 from .measurement import Measurement
 from ..Utilities.plotting.plot_mpl import extents
 from ..Utilities.plotting.plotter import using_notebook_backend
@@ -18,8 +21,25 @@ class Planefit(Measurement):
     b = np.nan
     c = np.nan
 
+    td_kwargs = {}
+    center_Vtd = None
+    tolerance = None
+    warm_start = False
+    use_history = False
+
+    # Surface beyond the plane (see Utilities.surface)
+    model = 'plane'
+    robust = None
+    smoothing = 0
+    quad = np.zeros(3)
+    tps_centers = np.zeros((0, 2))
+    tps_w = np.zeros(0)
+
     def __init__(self, instruments={}, span=[400, 400], center=[0, 0],
-                 numpts=[4, 4], Vz_max=None, first_td=None, gridplot=False):
+                 numpts=[4, 4], Vz_max=None, first_td=None, gridplot=False,
+                 td_kwargs={}, warm_start=False, start_window=20,
+                 tolerance=None, model='plane', robust=None, smoothing=0,
+                 use_history=False):
         '''
         Take touchdowns in a grid to determine the slope of the sample
         surface.
@@ -45,6 +65,39 @@ class Planefit(Measurement):
 
         gridplot (bool): Whether or not to plot touchdowns in compact grid
 
+        td_kwargs (dict): Additional keyword arguments for every Touchdown,
+        e.g. {'continuous': True, 'sweep_rate': 20} for continuous sweeps.
+
+        warm_start (bool): Start each touchdown just below the touchdown
+        voltage predicted from the previous touchdowns, instead of at
+        -Vz_max. If no touchdown is found, the window below the prediction
+        is widened (see Touchdown.do). Off by default: the Z piezo moves
+        to the predicted start without monitoring the capacitance.
+
+        start_window (float): Distance (V) below the predicted touchdown
+        voltage to start the touchdown. Increased to three times the
+        rms deviation of the touchdowns from the plane, if larger.
+
+        tolerance (float): If given, stop taking touchdowns once the
+        standard error of the fit plane is below tolerance (V) everywhere
+        on the grid. The corners of the grid are then done first.
+
+        model (str): Surface fit to the touchdowns: 'plane', 'quadratic'
+        or 'tps' (thin-plate spline). The scans use it through plane(x, y),
+        and sweep along curved surfaces with sweep_surface and move_to.
+
+        robust (str): None (least squares), 'huber' or 'ransac' to reduce
+        the influence of bad touchdowns. See Utilities.surface.
+
+        smoothing (float): Smoothing of the thin-plate spline; 0 goes
+        through every touchdown.
+
+        use_history (bool): Start touchdowns below the touchdown voltage
+        expected from past touchdowns at the same place on the sample (see
+        Utilities.touchdown_history) until the plane can predict it.
+        Off by default: the history may come from another cooldown or
+        sample.
+
         Required instruments:
         daq, lockin_cap, atto, piezos, montana
 
@@ -67,6 +120,18 @@ class Planefit(Measurement):
         self.numpts = numpts
         self.first_td = first_td
         self.gridplot = gridplot
+        self.td_kwargs = td_kwargs
+        self.warm_start = warm_start
+        self.start_window = start_window
+        self.tolerance = tolerance
+        if model not in surface.MODELS:
+            raise Exception('Surface model must be one of %s!' %surface.MODELS)
+        if robust not in surface.ROBUST:
+            raise Exception('Robust fit must be one of %s!' %surface.ROBUST)
+        self.model = model
+        self.robust = robust
+        self.smoothing = smoothing
+        self.use_history = use_history
 
         if Vz_max == None:
             if hasattr(self, 'piezos'):
@@ -82,11 +147,17 @@ class Planefit(Measurement):
         self.Z = np.nan * self.X  # makes array of nans same size as grid
         self.Zdiff = np.nan * self.X  # makes array of nans same size as grid
 
+        # Start and total approach distance of each touchdown
+        self.starts = np.nan * self.X
+        self.approach = np.nan * self.X
+
 
     def calculate_plane(self, no_outliers=False): # disabled 7/21/2017
         '''
         Calculates the plane parameters a, b, and c.
         z = ax + by + c
+        For other models or robust fits, also calculates the correction to
+        the plane (see plane) and the weight of each touchdown in the fit.
         '''
         # Remove outliers
         if no_outliers:
@@ -94,7 +165,76 @@ class Planefit(Measurement):
         else:
             Z = self.Z
 
-        self.a, self.b, self.c = fit_plane(self.X, self.Y, Z)
+        if self.model == 'plane' and self.robust is None:
+            self.a, self.b, self.c = fit_plane(self.X, self.Y, Z)
+            return
+
+        # Drop masked points (edges only or rejected outliers)
+        mask = np.ma.getmaskarray(self.X) | np.ma.getmaskarray(Z)
+        X, Y = np.ma.getdata(self.X)[~mask], np.ma.getdata(self.Y)[~mask]
+        fit = surface.fit_surface(X, Y, np.ma.getdata(Z)[~mask],
+                                  self.model, self.robust, self.smoothing)
+        self.a, self.b, self.c = fit.abc
+        self.quad = fit.quad
+        self.tps_centers = fit.centers
+        self.tps_w = fit.w
+        self.weights = np.full(self.X.shape, np.nan)
+        self.weights[~mask] = fit.weights
+
+
+    def _open_history(self):
+        '''
+        Load the touchdown history and read the attocube position.
+        Returns None, None if not using or not able to use the history.
+        '''
+        if not self.use_history:
+            return None, None
+        try:
+            return TouchdownHistory(), atto_position(self.atto)
+        except Exception as e:
+            print('Touchdown history not available: %s' %e)
+            return None, None
+
+
+    def _history_start(self, x, y, history, atto):
+        '''
+        Start of the touchdown at (x, y) from the touchdown history.
+        Returns None, None if there are no touchdowns nearby.
+        '''
+        if history is None:
+            return None, None
+        Vtd, err, n = history.query(x, y, atto, radius=50)
+        if n == 0:
+            return None, None
+        window = max(self.start_window, 3 * err)
+        return max(Vtd - window, -self.Vz_max), window
+
+
+    def _predict_start(self, x, y, estimator, history=None, atto=None):
+        '''
+        Predict where to start the touchdown at (x, y) from the touchdowns
+        taken so far (a PlaneEstimator including the center touchdown), or
+        from the touchdown history if there are none.
+
+        Returns:
+        start (float): Z piezo voltage to start the touchdown,
+            None to start at -Vz_max.
+        window (float): distance of start below the predicted touchdown
+        '''
+        if estimator.n == 0:
+            return self._history_start(x, y, history, atto)
+
+        if not estimator.determined:
+            # Not enough points for a plane yet: allow for a large tilt
+            window = 4 * self.start_window
+            Z = np.ma.filled(np.ma.asarray(self.Z, dtype=float), np.nan)
+            if self.center_Vtd is not None:
+                Z = np.append(Z, self.center_Vtd)
+            return max(np.nanmin(Z) - window, -self.Vz_max), window
+
+        window = max(self.start_window, 3 * estimator.rms)
+        return max(estimator.predict(x, y)[0] - window, -self.Vz_max), window
+
 
     def do(self, edges_only=False, **kwargs):
         '''
@@ -108,6 +248,8 @@ class Planefit(Measurement):
         self.piezos.x.check_lim(self.X)
         self.piezos.y.check_lim(self.Y)
 
+        history, atto = self._open_history()
+
         # Initial touchdown at center of plane
         # Skipped if a first touchdown was given or if doing edges only.
         if not edges_only:
@@ -116,14 +258,20 @@ class Planefit(Measurement):
                                  'y': self.center[1],
                                  'z': -self.Vz_max
                              }
-                self.td = Touchdown(self.instruments, Vz_max=self.Vz_max, disable_atto=True)
-                self.td.run()
+                start, window = None, None
+                if self.warm_start:
+                    start, window = self._history_start(*self.center,
+                                                        history, atto)
+                self.td = Touchdown(self.instruments, Vz_max=self.Vz_max, disable_atto=True,
+                                    **self.td_kwargs)
+                self.td.run(start=start, window=window)
 
                 # If the initial touchdown generates a poor fit, try again
                 n = 0
                 while self.td.error_flag and n < 5:
-                    self.td = Touchdown(self.instruments, Vz_max=self.Vz_max, disable_atto=True)
-                    self.td.run()
+                    self.td = Touchdown(self.instruments, Vz_max=self.Vz_max, disable_atto=True,
+                                        **self.td_kwargs)
+                    self.td.run(start=start, window=window)
                     n = n + 1
             else:
                 if type(self.first_td) in (int, float):
@@ -134,6 +282,7 @@ class Planefit(Measurement):
 
             if self.td.error_flag:
                 raise Exception(r'Can\'t fit capacitance signal.')
+            self.center_Vtd = self.td.Vtd
 
         # If only taking plane from edges, make masked array
         if edges_only:
@@ -146,48 +295,90 @@ class Planefit(Measurement):
             self.X = np.ma.masked_array(self.X, mask)
             self.Y = np.ma.masked_array(self.Y, mask)
 
+        # Order of points sampled from plane.
+        # Corners first if we may stop early; they constrain the plane most.
+        points = [(i, j) for i in range(self.X.shape[0])
+                         for j in range(self.X.shape[1])]
+        if self.tolerance is not None:
+            corners = [(i, j) for i in (0, self.X.shape[0] - 1)
+                              for j in (0, self.X.shape[1] - 1)]
+            corners = sorted(set(corners), key=corners.index)
+            points = corners + [p for p in points if p not in corners]
+        estimator = PlaneEstimator()
+        # Also includes the center touchdown, to predict where to start
+        guess = PlaneEstimator()
+        if self.center_Vtd is not None:
+            guess.add(self.center[0], self.center[1], self.center_Vtd)
+
         # Loop over points sampled from plane.
         counter = 0
-        for i in range(self.X.shape[0]):
-            for j in range(self.X.shape[1]):
-                # If this point is masked, like in edges only, skip it
-                if np.ma.is_masked(self.X[i, j]):
-                    continue
-
-                counter = counter + 1
-
-                # Go to location of next touchdown
-                self.piezos.V = {'x': self.X[i, j],
-                                 'y': self.Y[i, j],
-                                 'z': 0}
-
-                # New touchdown at this point
-                # Take touchdowns until the fitting algorithm gives a
-                # good result, up to 5 touchdowns
-                self.td = Touchdown(self.instruments,
-                               Vz_max=self.Vz_max, disable_atto=True)
-                self.td.error_flag = True # to force the following while loop
+        for i, j in points:
+            # If this point is masked, like in edges only, skip it
+            if np.ma.is_masked(self.X[i, j]):
+                continue
+
+            counter = counter + 1
+
+            # Go to location of next touchdown
+            self.piezos.V = {'x': self.X[i, j],
+                             'y': self.Y[i, j],
+                             'z': 0}
+
+            # New touchdown at this point
+            # Take touchdowns until the fitting algorithm gives a
+            # good result, up to 5 touchdowns
+            self.td = Touchdown(self.instruments,
+                           Vz_max=self.Vz_max, disable_atto=True,
+                           **self.td_kwargs)
+            self.td.error_flag = True # to force the following while loop
+
+            start, window = None, None
+            if self.warm_start:
+                start, window = self._predict_start(self.X[i, j],
+                                                    self.Y[i, j], guess,
+                                                    history, atto)
+
+            n = 0
+            approach = 0
+            while self.td.error_flag is True and n < 5:
+                if n > 0:
+                    print('Redo')
 
-                n = 0
-                while self.td.error_flag is True and n < 5:
-                    if n > 0:
-                        print('Redo')
-
-                    self.td = Touchdown(self.instruments,
-                                   Vz_max = self.Vz_max, disable_atto=True)
-                    self.td._set_title('(%.2f, %.2f). TD# %i' % (self.X[i, j], self.Y[i, j], counter))
-                    self.td.run()
-                    n = i + 1
-                    plt.close(self.td.fig)
-
-                # Record the touchdown voltage and update the plots
-                self.Z[i, j] = self.td.Vtd
-                self.calculate_plane()
-                self.Zdiff = self.Z - self.plane(self.X, self.Y)
-                self.plot(i,j)
-
-                # Return to zero between points.
-                self.piezos.V = 0
+                self.td = Touchdown(self.instruments,
+                               Vz_max = self.Vz_max, disable_atto=True,
+                               **self.td_kwargs)
+                self.td._set_title('(%.2f, %.2f). TD# %i' % (self.X[i, j], self.Y[i, j], counter))
+                self.td.run(start=start, window=window)
+                approach += self.td.approach
+                n = n + 1
+                plt.close(self.td.fig)
+
+            # Record the touchdown voltage and update the plots
+            self.Z[i, j] = self.td.Vtd
+            self.starts[i, j] = self.td.start
+            self.approach[i, j] = approach
+            estimator.add(self.X[i, j], self.Y[i, j], self.td.Vtd)
+            guess.add(self.X[i, j], self.Y[i, j], self.td.Vtd)
+            self.a, self.b, self.c = estimator.params
+            self.plane_std = estimator.std
+            self.Zdiff = self.Z - self.plane(self.X, self.Y)
+            self.plot(i,j)
+
+            # Return to zero between points.
+            self.piezos.V = 0
+
+            # Stop once the plane is known well enough. Require a few
+            # degrees of freedom so the noise estimate is meaningful.
+            if self.tolerance is not None and estimator.n >= 6:
+                corners = np.array([[self.X.min(), self.Y.min()],
+                                    [self.X.min(), self.Y.max()],
+                                    [self.X.max(), self.Y.min()],
+                                    [self.X.max(), self.Y.max()]])
+                err = estimator.predict(corners[:, 0], corners[:, 1])[1]
+                if err.max() < self.tolerance:
+                    print('Plane known to within %.2f V after %i '
+                          'touchdowns.' %(err.max(), counter))
+                    break
 
         if edges_only:
             # to prepare it for lstsq
@@ -195,6 +386,18 @@ class Planefit(Measurement):
 
         self.piezos.V = 0
         self.calculate_plane()
+        self.Zdiff = self.Z - self.plane(self.X, self.Y)
+        if not self.check_limits():
+            print('Warning: %s extends outside the range of the Z piezo '
+                  'within the range of the X and Y piezos!' %self.model)
+
+        # Compare to starting every touchdown at -Vz_max
+        cold = np.nansum(np.ma.filled(self.Z, np.nan) + self.Vz_max)
+        total = np.nansum(self.approach)
+        if total > 0:
+            self.approach_saving = cold / total
+            print('Total approach: %.0f V (%.1fx less than from -Vz_max)'
+                  %(total, self.approach_saving))
 
 
     def move_and_update(self, x=0, y=0, z=0, ux=0, uy=0, disable_atto=True,
@@ -222,8 +425,80 @@ class Planefit(Measurement):
     def plane(self, x, y):
         '''
         Given points x and y, calculates a point z on the plane.
+        For quadratic and thin-plate spline models, this is the fit surface.
+        Works on arrays of any shape.
+        '''
+        z = self.a * x + self.b * y + self.c
+        if self.model != 'plane':
+            z = z + surface.correction(x, y, self.quad, self.tps_centers,
+                                       self.tps_w)
+        return z
+
+
+    def path(self, Vstart, Vend, offset=0, step=1):
+        '''
+        Straight line in x and y from Vstart to Vend (dictionaries of piezo
+        voltages) that follows the surface offset piezo volts below it
+        (z = plane(x, y) - offset). The surface is evaluated at points at
+        most step V apart in x and y.
+        Returns a dictionary of x, y and z arrays for Piezos.sweep_path.
+        '''
+        dist = max(abs(Vend['x'] - Vstart['x']), abs(Vend['y'] - Vstart['y']))
+        numpts = max(int(np.ceil(dist / step)) + 1, 2)
+        x = np.linspace(Vstart['x'], Vend['x'], numpts)
+        y = np.linspace(Vstart['y'], Vend['y'], numpts)
+        return {'x': x, 'y': y, 'z': self.plane(x, y) - offset}
+
+
+    def sweep_surface(self, piezos, Vstart, Vend, offset, chan_in=None,
+                      sweep_rate=None):
+        '''
+        Sweep the piezos from Vstart to Vend (dictionaries of x, y and z
+        piezo voltages) offset piezo volts below the surface.
+        A plane is followed by a straight sweep between the end points.
+        Piezos.sweep would cut straight through a curved surface between
+        the end points, so quadratic and thin-plate spline surfaces are
+        followed with Piezos.sweep_path along path.
+        Returns (output voltage dictionary, input voltage dictionary).
+        '''
+        if self.model == 'plane':
+            return piezos.sweep(Vstart, Vend, chan_in=chan_in,
+                                sweep_rate=sweep_rate)
+        return piezos.sweep_path(self.path(Vstart, Vend, offset),
+                                 chan_in=chan_in, sweep_rate=sweep_rate)
+
+
+    def move_to(self, piezos, V):
+        '''
+        Move the piezos to V (dictionary of x, y and z piezo voltages)
+        without crossing the surface. For a plane this is a straight move.
+        A straight move between two points above a curved surface may cut
+        through it, so the z piezo is first backed off to 0 (below the whole
+        surface, see check_limits), then x and y move, then z.
+        '''
+        if self.model == 'plane':
+            piezos.V = V
+            return
+        piezos.z.V = 0
+        piezos.V = {'x': V['x'], 'y': V['y']}
+        piezos.V = {'z': V['z']}
+
+
+    def check_limits(self, numpts=50):
+        '''
+        Checks whether the surface lies within the range of the Z piezo
+        (0 to Vmax) everywhere within the range of the X and Y piezos.
+        Curved surfaces are checked on a numpts x numpts grid, since their
+        extremes need not be at the corners.
+
+        Returns True if the surface is within range.
         '''
-        return self.a * x + self.b * y + self.c
+        if self.model == 'plane':
+            numpts = 2  # extremes of a plane are at the corners
+        x = np.linspace(-self.piezos.x.Vmax, self.piezos.x.Vmax, numpts)
+        y = np.linspace(-self.piezos.y.Vmax, self.piezos.y.Vmax, numpts)
+        Z = self.plane(*np.meshgrid(x, y))
+        return Z.max() <= self.piezos.z.Vmax and Z.min() >= 0
 
     def plot(self, i=None, j=None):
         '''
@@ -351,25 +626,28 @@ class Planefit(Measurement):
 
         old_c = self.c
         self.piezos.V = {'x': Vx, 'y': Vy, 'z': 0}
+        window = None
+        if start is None and self.use_history:
+            history, atto = self._open_history()
+            start, window = self._history_start(Vx, Vy, history, atto)
         self.td = Touchdown(self.instruments,
                        disable_atto = disable_atto,
                        Vz_max = self.Vz_max,
+                       **self.td_kwargs
                        )
-        self.td.run(start=start)
+        self.td.run(start=start, window=window)
         center_z_value = self.td.Vtd
-        self.c = center_z_value - self.a * Vx - self.b * Vy
+        # Shift the surface (plane or curved) through the new touchdown
+        self.c = center_z_value - (self.plane(Vx, Vy) - self.c)
 
         # Check that no points within the scan range exceed the limits
         # set on the voltage over the piezos.
         if check_plane:
-            for x in [-self.piezos.x.Vmax, self.piezos.x.Vmax]:
-                for y in [-self.piezos.y.Vmax, self.piezos.y.Vmax]:
-                    z_maxormin = self.plane(x, y)
-                    if z_maxormin > self.piezos.z.Vmax or z_maxormin < 0:
-                        self.c = old_c
-                        raise Exception(
-                            'Plane now extends outside positive range of Z piezo! '+
-                            'Move the attocubes and try again.')
+            if not self.check_limits():
+                self.c = old_c
+                raise Exception(
+                    'Plane now extends outside positive range of Z piezo! '+
+                    'Move the attocubes and try again.')
         # Subtract old c, add new c
         self.Z -= (old_c - self.c)
         self.save()
@@ -0,0 +1,195 @@
+import time, matplotlib.pyplot as plt, numpy as np
+from scipy.ndimage import shift as nd_shift
+
+from .measurement import Measurement
+from .scanplane import Scanplane, setup_scan_images
+from ..Utilities.utilities import AttrDict, welford_update
+from ..Utilities.registration import phase_correlation
+
+
+class ScanplaneAverage(Measurement):
+    '''
+    Take the same Scanplane many times, register each frame to the running
+    average with subpixel phase correlation and average the registered
+    frames.
+
+    Only running (Welford) accumulators are kept, so memory use and the
+    saved file do not grow with the number of frames. Saved results:
+        mean (AttrDict): average of each channel (DAQ V)
+        std (AttrDict): standard deviation over frames of each channel
+        counts (AttrDict): number of frames averaged in each pixel
+        offsets (array): (num_frames, 2) x, y shift of each frame with
+            respect to the running average (piezo V)
+        peaks (array): correlation peak height of each registration
+    '''
+    _daq_inputs = Scanplane._daq_inputs
+    _conversions = Scanplane._conversions
+    _units = Scanplane._units
+    instrument_list = Scanplane.instrument_list
+
+
+    def __init__(self, instruments={}, plane=None, span=[800, 800],
+                 center=[0, 0], numpts=[20, 20], scanheight=15, scan_rate=60,
+                 raster=False, fly=False, num_frames=10,
+                 register_chans=['cap', 'dc'], register=True,
+                 save_frames=False):
+        '''
+        Scan parameters are the same as for Scanplane.
+        num_frames: number of frames to average.
+        register_chans: channels used to register frames.
+        register: if False, frames are averaged without shifting.
+        save_frames: if True, also save every frame as a Scanplane.
+        '''
+        super().__init__(instruments=instruments)
+
+        self.plane = plane
+        self.span = span
+        self.center = center
+        self.numpts = numpts
+        self.scanheight = scanheight
+        self.scan_rate = scan_rate
+        self.raster = raster
+        self.fly = fly
+        self.num_frames = num_frames
+        self.register_chans = register_chans
+        self.register = register
+        self.save_frames = save_frames
+
+        x = np.linspace(center[0] - span[0] / 2,
+                        center[0] + span[0] / 2,
+                        numpts[0])
+        y = np.linspace(center[1] - span[1] / 2,
+                        center[1] + span[1] / 2,
+                        numpts[1])
+        self.X, self.Y = np.meshgrid(x, y)
+
+        shape = self.X.shape
+        self.counts = AttrDict()
+        self.mean = AttrDict()
+        self.std = AttrDict()
+        self._M2 = AttrDict()
+        for chan in self._daq_inputs:
+            self.counts[chan] = np.zeros(shape)
+            self.mean[chan] = np.zeros(shape)
+            self.std[chan] = np.full(shape, np.nan)
+            self._M2[chan] = np.zeros(shape)
+
+        self.offsets = np.full((num_frames, 2), np.nan)
+        self.peaks = np.full(num_frames, np.nan)
+        self.frame_times = np.full(num_frames, np.nan)
+        self.frame_filenames = []
+        self.num_averaged = 0
+
+
+    def do(self, plot=True, **kwargs):
+        '''
+        Take and average num_frames frames.
+        Additional kwargs are passed to Scanplane.do
+        (e.g. pipeline=True, fast_axis='y').
+        '''
+        for n in range(self.num_frames):
+            if self.interrupt:
+                break
+
+            frame = Scanplane(self.instruments, plane=self.plane,
+                              span=self.span, center=self.center,
+                              numpts=self.numpts, scanheight=self.scanheight,
+                              scan_rate=self.scan_rate, raster=self.raster,
+                              fly=self.fly)
+            self.frame_times[n] = time.time()
+            frame.do(**kwargs)
+            if self.save_frames:
+                frame.save()
+                self.frame_filenames.append(frame.filename)
+
+            self.add_frame(n, frame.V)
+
+            # Only keep the figures of the current frame
+            for fig in frame.fig, getattr(frame, 'fig_cuts', None):
+                if fig is not None:
+                    plt.close(fig)
+            del frame
+
+            self.plot(plot=plot)
+
+
+    def add_frame(self, n, V):
+        '''
+        Register frame n (dictionary V of 2D arrays, one per channel) to the
+        running average and add it to the accumulators.
+        '''
+        shift = np.zeros(2)  # pixels along (y, x)
+        if self.register and self.num_averaged > 0:
+            frame = np.array([V[chan] for chan in self.register_chans])
+            ref = np.array([self._mean_nan(chan)
+                            for chan in self.register_chans])
+            shift, self.peaks[n] = phase_correlation(frame, ref)
+
+        step_x = self.X[0, 1] - self.X[0, 0] if self.X.shape[1] > 1 else 0
+        step_y = self.Y[1, 0] - self.Y[0, 0] if self.X.shape[0] > 1 else 0
+        self.offsets[n] = [shift[1] * step_x, shift[0] * step_y]
+
+        for chan in self._daq_inputs:
+            data = np.array(V[chan], dtype=float)
+            if np.any(shift != 0):
+                # Shift back onto the reference; pixels shifted in from
+                # outside the frame (or next to missing data) are NaN
+                data = nd_shift(data, -shift, order=1, mode='constant',
+                                cval=np.nan)
+            welford_update(self.counts[chan], self.mean[chan],
+                           self._M2[chan], data)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                self.std[chan] = np.sqrt(self._M2[chan]
+                                         / (self.counts[chan] - 1))
+        self.num_averaged += 1
+
+
+    def _mean_nan(self, chan):
+        '''
+        Running mean of a channel with NaN where no frames were averaged.
+        '''
+        mean = self.mean[chan].copy()
+        mean[self.counts[chan] == 0] = np.nan
+        return mean
+
+
+    def plot_update(self):
+        '''
+        Update the data for all plots.
+        '''
+        for chan in self._daq_inputs:
+            data = self._mean_nan(chan) * self._conversions[chan]
+            self.update_image(self.im[chan], data)
+            self.ax[chan].set_title('%s: %i frames' %(self.timestamp,
+                                                      self.num_averaged),
+                                    size=10)
+        self.lines_offsets[0].set_data(np.arange(self.num_frames),
+                                       self.offsets[:, 0])
+        self.lines_offsets[1].set_data(np.arange(self.num_frames),
+                                       self.offsets[:, 1])
+        self.ax_offsets.relim()
+        self.ax_offsets.autoscale_view()
+
+
+    def setup_plots(self):
+        '''
+        Set up all plots.
+        '''
+        # Images in the first two columns, offsets in the third
+        self.fig = plt.figure(figsize=(14, 8))
+        setup_scan_images(self, self.fig,
+                          [(2, 3, i + 1 + i // 2)
+                           for i in range(len(self._daq_inputs))],
+                          data=self._mean_nan)
+
+        # Registration offsets of each frame
+        self.ax_offsets = self.fig.add_subplot(2, 3, 3)
+        self.lines_offsets = [
+            self.ax_offsets.plot(np.nan, np.nan, 'o-', label='x')[0],
+            self.ax_offsets.plot(np.nan, np.nan, 'o-', label='y')[0]
+        ]
+        self.ax_offsets.set_xlabel('Frame')
+        self.ax_offsets.set_ylabel('Offset (V)')
+        self.ax_offsets.legend()
+
+        self.fig.tight_layout()
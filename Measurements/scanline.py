@@ -83,12 +83,14 @@ class Scanline(Measurement):
                 }
 
         # Explicitly go to first point of scan
-        self.piezos.V = Vstart
+        self.plane.move_to(self.piezos, Vstart)
         self.squidarray.reset()
         time.sleep(3*self.lockin_squid.time_constant)
 
-        # Do the sweep
-        output_data, received = self.piezos.sweep(Vstart, Vend,
+        # Do the sweep, following the surface
+        output_data, received = self.plane.sweep_surface(self.piezos,
+                                                  Vstart, Vend,
+                                                  self.scanheight,
                                                   chan_in=self._daq_inputs,
                                                   sweep_rate=self.scan_rate
                                                   ) # sweep over Y
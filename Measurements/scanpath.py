@@ -0,0 +1,299 @@
+import time, matplotlib.pyplot as plt, numpy as np
+from scipy.interpolate import griddata
+
+from ..Utilities import conversions
+from .measurement import Measurement
+from .scanplane import check_montana, setup_scan_images
+from ..Utilities.utilities import AttrDict
+
+
+def lissajous_path(center=[0, 0], span=[800, 800], a=3, b=4, cycles=10):
+    '''
+    Returns a path f(t) (t from 0 to 1, see Scanpath) of a Lissajous figure
+    filling the given span: x = sin(a*s + pi/2), y = sin(b*s) for s over
+    the given number of cycles. Use nearly equal, coprime a and b for a
+    dense figure.
+        >> Scanpath(instruments, plane, path=lissajous_path(a=9, b=10))
+    '''
+    def path(t):
+        s = 2 * np.pi * cycles * np.asarray(t, dtype=float)
+        x = center[0] + span[0] / 2 * np.sin(a * s + np.pi / 2)
+        y = center[1] + span[1] / 2 * np.sin(b * s)
+        return x, y
+    return path
+
+
+def spiral_path(center=[0, 0], span=[800, 800], turns=20):
+    '''
+    Returns a path f(t) (t from 0 to 1, see Scanpath) of an Archimedean
+    spiral from the center out to the edges of the given span. Evenly
+    spaced t give points evenly spaced in arc length.
+    '''
+    def path(t):
+        # Arc length of an Archimedean spiral goes as theta^2
+        r = np.sqrt(np.asarray(t, dtype=float))  # 0 to 1
+        theta = 2 * np.pi * turns * r
+        x = center[0] + span[0] / 2 * r * np.cos(theta)
+        y = center[1] + span[1] / 2 * r * np.sin(theta)
+        return x, y
+    return path
+
+
+class Scanpath(Measurement):
+    '''
+    Scan along an arbitrary path while monitoring signal on DAQ.
+    The data are resampled onto a rectangular grid afterwards.
+
+    Attributes:
+        _daq_inputs (list): list of channel names for DAQ to monitor
+        _conversions (AttrDict): mapping from DAQ voltages to real units
+        instrument_list (list): instrument names that Scanpath needs in
+            order to be initialized.
+    '''
+    _daq_inputs = ['dc', 'cap', 'acx', 'acy']
+    _conversions = AttrDict({
+        # Assume high; changed in init when array loaded
+        'dc': conversions.Vsquid_to_phi0['High'],
+        'cap': conversions.V_to_C,
+        'acx': conversions.Vsquid_to_phi0['High'],
+        'acy': conversions.Vsquid_to_phi0['High'],
+        'x': conversions.Vx_to_um,
+        'y': conversions.Vy_to_um
+    })
+    _units = AttrDict({
+        'dc': 'phi0',
+        'cap': 'C',
+        'acx': 'phi0',
+        'acy': 'phi0',
+        'x': '~um',
+        'y': '~um',
+    })
+    instrument_list = ['piezos',
+                       'montana',
+                       'squidarray',
+                       'preamp',
+                       'lockin_squid',
+                       'lockin_cap',
+                       'atto',
+                       'daq']
+
+
+    def __init__(self, instruments={}, plane=None, path=None, span=[800, 800],
+                 center=[0, 0], numpts=[20, 20], scanheight=15, scan_rate=60,
+                 num_segments=20, num_path_pts=10000, plot_interval=10):
+        '''
+        path: The (x, y) path of the scan in piezo voltage. Options:
+            - None: an Archimedean spiral covering span (see spiral_path)
+            - an (N, 2) array-like of (x, y) points. The piezos move along
+              straight lines between points, so sparse point lists work.
+            - a callable f(t) returning x, y arrays for t from 0 to 1
+              (a parametric path, e.g. lissajous_path or spiral_path),
+              evaluated at num_path_pts points.
+        span, center, numpts: define the grid the data are resampled onto.
+        num_segments: number of pieces the path is acquired in.
+        plot_interval: the data are resampled onto the grid and plotted
+            after a piece if at least this many seconds passed since the
+            last update (resampling triangulates the whole path so far),
+            and once at the end.
+        '''
+        super().__init__(instruments=instruments)
+
+        # Load the correct SAA sensitivity based on the SAA feedback
+        # resistor
+        try:  # try block enables creating object without instruments
+            Vsquid_to_phi0 = conversions.Vsquid_to_phi0[self.squidarray.sensitivity]
+            self._conversions['acx'] = Vsquid_to_phi0
+            self._conversions['acy'] = Vsquid_to_phi0
+            # doesn't consider preamp gain. If preamp communication fails, then
+            # this will be recorded
+            self._conversions['dc'] = Vsquid_to_phi0
+            # Divide out the preamp gain for the DC channel
+            self._conversions['dc'] /= self.preamp.gain
+        except:
+            pass
+
+        self.plane = plane
+        self.span = span
+        self.center = center
+        self.numpts = numpts
+        self.scanheight = scanheight
+        self.scan_rate = scan_rate
+        self.num_segments = num_segments
+        self.plot_interval = plot_interval
+
+        if plane is None:
+            raise Exception('Scanpath needs a plane to know where the '
+                            'surface is!')
+
+        # Path points
+        if path is None:
+            path = spiral_path(center, span)
+        if callable(path):
+            x, y = path(np.linspace(0, 1, num_path_pts))
+        else:
+            path = np.array(path, dtype=float)
+            x, y = path[:, 0], path[:, 1]
+        self.path = AttrDict(x=np.array(x, dtype=float),
+                             y=np.array(y, dtype=float))
+        self.path['z'] = self.plane.plane(self.path.x, self.path.y) \
+                            - self.scanheight
+
+        # Target grid
+        x = np.linspace(center[0] - span[0] / 2,
+                        center[0] + span[0] / 2,
+                        numpts[0])
+        y = np.linspace(center[1] - span[1] / 2,
+                        center[1] + span[1] / 2,
+                        numpts[1])
+        self.X, self.Y = np.meshgrid(x, y)
+
+        # Data acquired along the path
+        self.Vpath = AttrDict({
+            chan: np.array([]) for chan in self._daq_inputs + ['x', 'y', 'z']
+        })
+        # Data resampled on the grid
+        self.V = AttrDict()
+        for chan in self._daq_inputs:
+            self.V[chan] = np.full(self.X.shape, np.nan)
+            # If no conversion factor is given then directly record the
+            # voltage by setting conversion = 1
+            if chan not in self._conversions.keys():
+                self._conversions[chan] = 1
+            if chan not in self._units.keys():
+                self._units[chan] = 'V'
+
+
+    def do(self, wait=None, **kwargs):
+        '''
+        Routine to scan along the path.
+
+        Keyword arguments:
+            wait: Time in seconds to wait at the beginning of a scan.
+            If wait == None, will wait 3 * time const of lockin.
+        '''
+        # Check the whole path against the voltage limits of the piezos
+        for axis in ['x', 'y', 'z']:
+            getattr(self.piezos, axis).check_lim(self.path[axis])
+
+        # Measure capacitance offset
+        Vcap_offset = []
+        for i in range(5):
+            time.sleep(0.5)
+            Vcap_offset.append(
+                self.lockin_cap.convert_output(self.daq.inputs['cap'].V)
+            )
+        Vcap_offset = np.mean(Vcap_offset)
+
+        # Go to first point of scan
+        self.plane.move_to(self.piezos,
+                           {axis: self.path[axis][0] for axis in ['x', 'y', 'z']})
+        self.squidarray.reset()
+        if wait is None:
+            wait = 3*self.lockin_squid.time_constant
+        time.sleep(wait)
+
+        # Split the path into overlapping segments (they share end points)
+        N = len(self.path.x)
+        bounds = np.linspace(0, N - 1, self.num_segments + 1).astype(int)
+        bounds = np.unique(bounds)
+        # Pieces of the data; joined when plotting and at the end
+        pieces = {chan: [] for chan in self.Vpath}
+        tplot = time.time()
+        try:
+            for i in range(len(bounds) - 1):
+                check_montana(self)
+
+                # If we detected a keyboard interrupt stop the scan here
+                if self.interrupt:
+                    break
+
+                self._acquire_segment(slice(bounds[i], bounds[i+1] + 1),
+                                      Vcap_offset, pieces)
+
+                if time.time() - tplot > self.plot_interval:
+                    self._join_pieces(pieces)
+                    self.resample()
+                    self.plot()
+                    tplot = time.time()
+        finally:
+            self._join_pieces(pieces)
+        self.resample()
+        self.plot()
+
+        self.piezos.V = 0
+
+
+    def _acquire_segment(self, s, Vcap_offset, pieces):
+        '''
+        Sweep the piezos along the part s (a slice) of the path and add
+        the output voltages and converted data to pieces (lists of arrays).
+        '''
+        output_data, received = self.piezos.sweep_path(
+            {axis: self.path[axis][s] for axis in ['x', 'y', 'z']},
+            chan_in=self._daq_inputs,
+            sweep_rate=self.scan_rate
+        )
+
+        # Convert from DAQ volts to lockin volts where applicable
+        for chan in ['acx', 'acy']:
+            received[chan] = self.lockin_squid.convert_output(
+                received[chan])
+        received['cap'] = self.lockin_cap.convert_output(
+            received['cap']) - Vcap_offset
+
+        for axis in ['x', 'y', 'z']:
+            pieces[axis].append(np.asarray(output_data[axis]))
+        for chan in self._daq_inputs:
+            pieces[chan].append(np.asarray(received[chan]))
+
+
+    def _join_pieces(self, pieces):
+        '''
+        Join the pieces acquired so far into Vpath.
+        '''
+        for chan, p in pieces.items():
+            if len(p):
+                self.Vpath[chan] = np.concatenate(p)
+                p[:] = [self.Vpath[chan]]
+
+
+    def resample(self, method='linear'):
+        '''
+        Resample the data acquired along the path onto the grid (self.X,
+        self.Y). Grid points outside the area covered by the path are NaN.
+
+        Arguments:
+            method: interpolation method for scipy.interpolate.griddata
+        '''
+        if len(self.Vpath.x) < 4:  # not enough points to triangulate
+            return
+        points = np.vstack([self.Vpath.x, self.Vpath.y]).T
+        for chan in self._daq_inputs:
+            self.V[chan] = griddata(points, self.Vpath[chan],
+                                    (self.X, self.Y), method=method)
+
+
+    def plot_update(self):
+        '''
+        Update the data for all plots.
+        '''
+        for chan in self._daq_inputs:
+            data = np.array(self.V[chan] * self._conversions[chan],
+                            dtype=float)
+            self.update_image(self.im[chan], data)
+        self.line_path.set_data(self.Vpath.x, self.Vpath.y)
+
+
+    def setup_plots(self):
+        '''
+        Set up all plots.
+        '''
+        self.fig = plt.figure(figsize=(12, 10))
+        setup_scan_images(self, self.fig,
+                          [(2, 2, i+1) for i in range(len(self._daq_inputs))])
+
+        # Show the path covered so far on the first plot
+        ax = self.ax[self._daq_inputs[0]]
+        self.line_path = ax.plot(np.nan, np.nan, '-k', lw=0.5, alpha=0.3)[0]
+
+        self.fig.tight_layout()
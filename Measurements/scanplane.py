@@ -1,11 +1,74 @@
 import time, os, matplotlib, matplotlib.pyplot as plt, numpy as np, winsound
-from scipy.interpolate import interp1d
+import queue, threading
 
 from ..Utilities import conversions
 from .measurement import Measurement
-from ..Utilities.utilities import AttrDict
+from ..Utilities.utilities import AttrDict, Pixelizer
+from ..Utilities.registration import (xcorr_lag, line_shift,
+                                      phase_correlation, DriftEstimator)
 from ..Utilities.plotting.plot_mpl import extents
 
+# Colormap and colorbar label of each DAQ channel in scan images
+scan_cmaps = AttrDict(dc='RdBu', cap='afmhot', acx='magma', acy='magma')
+scan_clabels = AttrDict(
+    dc = 'DC Flux ($\Phi_0$)',
+    cap = 'Capacitance (fF)',
+    acx = 'AC X ($\Phi_0$)',
+    acy = 'AC Y ($\Phi_0$)',
+)
+
+
+def setup_scan_images(measurement, fig, positions, data=None):
+    '''
+    Add an image of each DAQ channel of a scanning measurement to fig,
+    with its colormap, colorbar, axis labels and the timestamp as title.
+    The axes and images are stored in measurement.ax and measurement.im.
+
+    Arguments:
+    positions (list): subplot position of each channel, as for
+        fig.add_subplot (e.g. [(2, 2, 1), (2, 2, 2), ...])
+    data: function of the channel name that returns the image to show.
+        Default: measurement.V[chan] on the grid measurement.X, .Y
+    '''
+    if data is None:
+        data = lambda chan: measurement.V[chan]
+    measurement.ax = AttrDict()
+    measurement.im = AttrDict()
+    for chan, position in zip(measurement._daq_inputs, positions):
+        ax = fig.add_subplot(*position)
+        measurement.ax[chan] = ax
+        measurement.im[chan] = ax.imshow(data(chan), cmap=scan_cmaps[chan],
+                                         origin='lower',
+                                         extent=extents(measurement.X,
+                                                        measurement.Y))
+        measurement.add_colorbar(ax, label=scan_clabels[chan])
+        ax.set_xlabel('X Position (V)')
+        ax.set_ylabel('Y Position (V)')
+        ax.set_title(measurement.timestamp, size=10, y=1.02)
+
+
+def check_montana(measurement):
+    '''
+    Check the cryostat of a scanning measurement. If there is a problem,
+    zero the piezos and SQUID array, beep for 10 minutes (unless the kernel
+    is interrupted), back off the z attocube and raise an Exception.
+    '''
+    if not measurement.montana.check_status(): # returns False if problem
+        measurement.piezos.zero()
+        measurement.squidarray.zero()
+
+        tstart = time.time()
+        # play annoying sounds for 10 minutes
+        print ('Montana error! Will back off attocubes in 10 minutes \
+               unless kernel interrupted')
+        while time.time()-tstart < 10*60:
+            winsound.Beep(int(440*2**(1/2)),200) # play a tone
+            winsound.Beep(440,200) # play a tone
+
+        measurement.atto.z.move(-1000)
+        raise Exception('Montana error!')
+
+
 class Scanplane(Measurement):
     '''
     Scan over a plane while monitoring signal on DAQ
@@ -44,17 +107,29 @@ class Scanplane(Measurement):
                        'atto',
                        'daq']
     fast_axis = 'x'
+    # Lines waiting in an unbounded pipeline queue above which we warn
+    queue_warning = 50
 
 
     def __init__(self, instruments={}, plane=None, span=[800, 800],
                  center=[0, 0], numpts=[20, 20],
                  scanheight=15, scan_rate=60, raster=False,
-                 direction=['+','+'], ROI=None):
+                 direction=['+','+'], ROI=None, fly=False, reset_threshold=9,
+                 pyramid=False):
         '''
         direction: +/- to sweep each axis forwards or backwards.
         Flips scan image. TODO: don't flip
         ROI: List of [Vx1, Vx2, Vy1, Vy2] to specify a region of interest.
             Will draw a box from Vx1 < Vx < Vx2 and Vy1 < Vy < Vy2.
+        fly: If True, do a continuous serpentine (fly) scan. The SQUID stays
+            at scan height between lines, there is no wait between lines,
+            and the SQUID array is only reset when the DC signal approaches
+            the rails. Implies raster=True.
+        reset_threshold: DAQ voltage on the dc channel above which the SQUID
+            array is reset after a line in fly mode.
+        pyramid: If True, also save the images as multi-resolution tiled
+            pyramids for browsing large scans and mosaics with
+            Utilities.pyramid.PyramidViewer.
         '''
 
 
@@ -81,9 +156,20 @@ class Scanplane(Measurement):
         self.center = center
         self.numpts = numpts
         self.plane = plane
+        if pyramid:
+            self._pyramid_keys = ['V']
         self.scanheight = scanheight
         self.direction = direction
         self.ROI = ROI
+        self.fly = fly
+        if fly:
+            self.raster = True  # serpentine path
+        self.reset_threshold = reset_threshold
+        self.resets = []  # lines after which the SQUID array was reset
+        self.hysteresis = np.nan  # forward/backward offset (piezo V)
+        self.drift = None  # drift estimates, see do(drift=True)
+        self.drift_rate = np.array([np.nan, np.nan])  # x, y (piezo V/s)
+        self._drift_opts = None
 
         self.V = AttrDict({
             chan: np.nan for chan in self._daq_inputs + ['piezo']
@@ -114,9 +200,14 @@ class Scanplane(Measurement):
         except:
             print('plane not loaded')
 
+        # Standard error of the mean and number of samples in each pixel
+        self.Vsem = AttrDict()
+        self.counts = np.full(self.X.shape, np.nan)
+
         for chan in self._daq_inputs:
             # Initialize one array per DAQ channel
             self.V[chan] = np.full(self.X.shape, np.nan)
+            self.Vsem[chan] = np.full(self.X.shape, np.nan)
             # If no conversion factor is given then directly record the
             # voltage by setting conversion = 1
             if chan not in self._conversions.keys():
@@ -125,7 +216,10 @@ class Scanplane(Measurement):
                 self._units[chan] = 'V'
 
 
-    def do(self, fast_axis='x', wait=None, **kwargs):
+    def do(self, fast_axis='x', wait=None, pipeline=False, max_fps=2,
+           queue_size=None, drift=False, drift_reference=None,
+           drift_correct=False, drift_chans=['cap', 'dc'], drift_window=20,
+           max_drift=5, **kwargs):
         '''
         Routine to perform a scan over a plane.
 
@@ -134,6 +228,30 @@ class Scanplane(Measurement):
             If 'y', take linecuts in the Y direction.
             wait: Time in seconds to wait at the beginning of a scan.
             If wait == None, will wait 3 * time const of lockin.
+            pipeline: If True, acquire, process (bin and save) and plot lines
+            in separate stages so that plotting and file I/O do not add to
+            the scan time. See _do_pipeline.
+            max_fps: Maximum number of plot redraws per second (pipeline).
+            queue_size: Maximum number of acquired lines waiting to be
+            processed (pipeline). None (default): no limit, so slow
+            processing never holds up acquisition. The queue is unbounded
+            by default because with a limit, acquisition waits with the
+            piezos parked at the end of the line while the queue is full
+            (see queue_wait). Memory is bounded instead by a warning when
+            more than queue_warning lines are waiting.
+            drift: If True, estimate the drift of the sample online by FFT
+            cross-correlation of each new line with earlier data on the
+            drift_chans channels. The drift rate is shown in the figure
+            title. See _update_drift.
+            drift_reference: An earlier Scanplane (or its V dictionary) of
+            the same area. Each line is then registered to the reference
+            in both directions, and the whole frame is registered to it at
+            the end of the scan. Without a reference, only the drift along
+            the fast axis between consecutive lines can be estimated.
+            drift_correct: If True, shift each new line (Vstart and Vend) by
+            the predicted drift. Implies drift=True.
+            drift_window: Number of recent lines used to fit the drift rate.
+            max_drift: Largest drift per line (pixels) searched for.
         '''
         self.fast_axis = fast_axis
 
@@ -170,124 +288,537 @@ class Scanplane(Measurement):
             Vcap_offset.append(
                 self.lockin_cap.convert_output(self.daq.inputs['cap'].V)
             )
-        Vcap_offset = np.mean(Vcap_offset)
-
-        # Loop over each line in the scan
-        for i in range(num_lines):
-
-            if not self.montana.check_status(): # returns False if problem
-                self.piezos.zero()
-                self.squidarray.zero()
-
-                tstart = time.time()
-                # play annoying sounds for 10 minutes
-                print ('Montana error! Will back off attocubes in 10 minutes \
-                       unless kernel interrupted')
-                while time.time()-tstart < 10*60:
-                    winsound.Beep(int(440*2**(1/2)),200) # play a tone
-                    winsound.Beep(440,200) # play a tone
-
-                self.atto.z.move(-1000)
-                raise Exception('Montana error!')
-
-            # If we detected a keyboard interrupt stop the scan here
-            # The DAQ is not in use at this point so ending the scan
-            # should be safe.
-            if self.interrupt:
-                break
-            k = 0
-            if self.raster:
-                if i % 2 == 0:  # if even
-                    # k keeps track of sweeping forward vs. backwards
-                    k = 0
-                else:  # if odd
-                    k = -1
-            # if not rastering, k=0, meaning always forward sweeps
-
-            # Starting and ending piezo voltages for the line
-            # for forward, starts at 0,i; backward: -1, i
-            if fast_axis == 'x':
-                Vstart = {'x': self.X[i, k],
-                          'y': self.Y[i, k],
-                          'z': self.Z[i, k]}
-                # for forward, ends at -1,i; backward: 0, i
-                Vend = {'x': self.X[i, -(k + 1)],
-                        'y': self.Y[i, -(k + 1)],
-                        'z': self.Z[i, -(k + 1)]}
-            elif fast_axis == 'y':
-                # for forward, starts at i,0; backward: i,-1
-                Vstart = {'x': self.X[k, i],
-                          'y': self.Y[k, i],
-                          'z': self.Z[k, i]}
-                # for forward, ends at i,-1; backward: i,0
-                Vend = {'x': self.X[-(k + 1), i],
-                        'y': self.Y[-(k + 1), i],
-                        'z': self.Z[-(k + 1), i]}
-
-            # Go to first point of scan
-            self.piezos.sweep(self.piezos.V, Vstart)
-            #self.squidarray.reset()
-            if wait is None:
-                wait = 3*self.lockin_squid.time_constant
-            time.sleep(wait)
+        self._Vcap_offset = np.mean(Vcap_offset)
+
+        if wait is None:
+            wait = 3*self.lockin_squid.time_constant
+
+        # Pixel edges along the fast axis are the same for every line
+        pixelizer = self._make_pixelizer()
+
+        self.line_times = np.full(num_lines, np.nan)
+        if drift or drift_correct or drift_reference is not None:
+            self._setup_drift(num_lines, drift_reference, drift_correct,
+                              drift_chans, drift_window, max_drift)
+
+        try:
+            if pipeline:
+                self._do_pipeline(num_lines, wait, pixelizer, max_fps,
+                                  queue_size)
+            else:
+                # Loop over each line in the scan
+                for i in range(num_lines):
+                    # If we detected a keyboard interrupt stop the scan here
+                    # The DAQ is not in use at this point so ending the scan
+                    # should be safe.
+                    if self.interrupt:
+                        break
+                    Vstart, Vline = self._acquire_line(i, num_lines, wait)
+                    self._process_line(i, num_lines, Vstart, Vline,
+                                       pixelizer)
+                    self.plot()
+            self.piezos.V = 0
+
+            if self._drift_opts is not None:
+                self._register_frame()
+        finally:
+            self._drift_opts = None  # don't save the reference
+
+
+    def _do_pipeline(self, num_lines, wait, pixelizer, max_fps, queue_size):
+        '''
+        Run the scan as a three-stage producer/consumer pipeline:
+            1. An acquisition thread sweeps the piezos line after line and
+               puts the converted lines on a queue.
+            2. A processing thread bins each line into pixels and saves it.
+            3. This (main) thread redraws the plots at most max_fps times
+               per second, since matplotlib must run on the main thread.
+        The plots only ever show the latest processed data, so a slow
+        display never holds up acquisition or processing. The acquisition
+        queue holds at most queue_size lines (None: any number). If
+        processing (binning, save_line) is slower than acquisition and the
+        queue is full, the next line waits, with the piezos parked at the
+        end of the line; the total time waited is stored in queue_wait.
+        Without a limit, a warning is printed once when more than
+        queue_warning lines are waiting, since they all stay in memory.
+        Exceptions in either thread stop the scan and are raised here.
+        '''
+        acquired = queue.Queue(maxsize=queue_size or 0)
+        errors = []
+        self._new_data = False
+        self.queue_wait = 0
+
+        def acquire():
+            warned = False
+            try:
+                for i in range(num_lines):
+                    if self.interrupt or errors:
+                        break
+                    Vstart, Vline = self._acquire_line(i, num_lines, wait)
+                    tput = time.time()
+                    acquired.put((i, Vstart, Vline))
+                    self.queue_wait += time.time() - tput
+                    backlog = acquired.qsize()
+                    if not queue_size and not warned \
+                            and backlog > self.queue_warning:
+                        print('Warning: %i acquired lines (%.0f MB) are '
+                              'waiting to be processed. Speed up save_line '
+                              'or set queue_size.' %(backlog, backlog *
+                              sum(np.size(v) for v in Vline.values()) * 8e-6))
+                        warned = True
+            except BaseException as e:
+                errors.append(e)
+            finally:
+                acquired.put(None)  # tell the processing thread we are done
+
+        def process():
+            try:
+                while True:
+                    item = acquired.get()
+                    if item is None:
+                        break
+                    if errors:  # keep draining so acquisition never blocks
+                        continue
+                    i, Vstart, Vline = item
+                    self._process_line(i, num_lines, Vstart, Vline, pixelizer)
+                    self._new_data = True
+            except BaseException as e:
+                errors.append(e)
+                # Drain the queue so the acquisition thread can finish
+                while acquired.get() is not None:
+                    pass
+
+        threads = [threading.Thread(target=acquire, name='scan acquisition'),
+                   threading.Thread(target=process, name='scan processing')]
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+        try:
+            last_draw = 0
+            while any(t.is_alive() for t in threads):
+                if self._new_data and time.time() - last_draw > 1/max_fps:
+                    self._new_data = False
+                    last_draw = time.time()
+                    self.plot()
+                time.sleep(0.01)
+        except KeyboardInterrupt:
+            # Let the acquisition thread finish the current line
+            self.interrupt = True
+            for t in threads:
+                t.join()
+            raise
+        for t in threads:
+            t.join()
+
+        self.plot()  # draw the final state
+        if errors:
+            raise errors[0]
+        if self.queue_wait > 1:
+            print('Acquisition waited %.1f s for line processing. Use a '
+                  'larger queue_size or speed up save_line.'
+                  %self.queue_wait)
+
+
+    def _acquire_line(self, i, num_lines, wait):
+        '''
+        Check the cryostat, sweep line i and convert the received data.
+        This is the only step of a line that talks to instruments.
+
+        Returns:
+            Vstart (dict): starting piezo voltages of the line
+            Vline (AttrDict): full piezo output along the fast axis ('piezo')
+                and converted data for each DAQ channel
+        '''
+        fast_axis = self.fast_axis
 
-            # Begin the sweep
-            output_data, received = self.piezos.sweep(Vstart, Vend,
-                                          chan_in=self._daq_inputs,
-                                          sweep_rate=self.scan_rate
-                                          )
-            # Flip the backwards sweeps
-            if k == -1:  # flip only the backwards sweeps
-                for d in output_data, received:
-                    for key, value in d.items():
-                        d[key] = value[::-1]  # flip the 1D array
+        check_montana(self)
 
+        k = 0
+        if self.raster:
+            if i % 2 == 0:  # if even
+                # k keeps track of sweeping forward vs. backwards
+                k = 0
+            else:  # if odd
+                k = -1
+        # if not rastering, k=0, meaning always forward sweeps
+
+        # Starting and ending piezo voltages for the line
+        # for forward, starts at 0,i; backward: -1, i
+        if fast_axis == 'x':
+            Vstart = {'x': self.X[i, k],
+                      'y': self.Y[i, k],
+                      'z': self.Z[i, k]}
+            # for forward, ends at -1,i; backward: 0, i
+            Vend = {'x': self.X[i, -(k + 1)],
+                    'y': self.Y[i, -(k + 1)],
+                    'z': self.Z[i, -(k + 1)]}
+        elif fast_axis == 'y':
+            # for forward, starts at i,0; backward: i,-1
+            Vstart = {'x': self.X[k, i],
+                      'y': self.Y[k, i],
+                      'z': self.Z[k, i]}
+            # for forward, ends at i,-1; backward: i,0
+            Vend = {'x': self.X[-(k + 1), i],
+                    'y': self.Y[-(k + 1), i],
+                    'z': self.Z[-(k + 1), i]}
+
+        # Shift the line by the predicted drift
+        offset = self._drift_offset(i)
+        if offset is not None:
+            for V in Vstart, Vend:
+                V['x'] += offset['x']
+                V['y'] += offset['y']
+                try:
+                    V['z'] = self.plane.plane(V['x'], V['y']) \
+                                - self.scanheight
+                except:
+                    pass
+
+        # Go to first point of scan
+        # In fly mode we stay at scan height and step directly to the
+        # start of the next line, following the surface.
+        if self.fly and i > 0:
+            self.plane.sweep_surface(self.piezos, self.piezos.V, Vstart,
+                                     self.scanheight)
+        else:
+            self.plane.move_to(self.piezos, Vstart)
+        #self.squidarray.reset()
+        if not self.fly or i == 0:
+            if self.fly:
+                self.squidarray.reset()
+            time.sleep(wait)
+
+        # Begin the sweep
+        tstart = time.time()
+        output_data, received = self.plane.sweep_surface(self.piezos,
+                                      Vstart, Vend, self.scanheight,
+                                      chan_in=self._daq_inputs,
+                                      sweep_rate=self.scan_rate
+                                      )
+        self.line_times[i] = (tstart + time.time()) / 2
+        # Flip the backwards sweeps
+        if k == -1:  # flip only the backwards sweeps
+            for d in output_data, received:
+                for key, value in d.items():
+                    d[key] = value[::-1]  # flip the 1D array
+
+        if self.fly:
+            # Only reset the SQUID array if the DC signal nears the rails
+            if np.nanmax(np.abs(received['dc'])) > self.reset_threshold:
+                self.squidarray.reset()
+                self.resets.append(i)
+        else:
             # Back off with the Z piezo before moving to the next line
             self.piezos.z.V = 0
             self.squidarray.reset()
 
-            # Interpolate to the number of lines
-            self.Vfull['piezo'] = output_data[fast_axis]
-            if fast_axis == 'x':
-                self.Vinterp['piezo'] = self.X[i, :]
-            elif fast_axis == 'y':
-                self.Vinterp['piezo'] = self.Y[:, i]
-
-            # Store this line's signals for Vdc, Vac x/y, and Cap
-            # Sometimes the daq doesn't return the right keys
-            # Using try/except to try to diagnose for the future.
-            for chan in self._daq_inputs:
-                try:
-                    self.Vfull[chan] = received[chan]
-                except Exception as e:
-                    print(received)
-                    raise e
-
-            # Convert from DAQ volts to lockin volts where applicable
-            for chan in ['acx', 'acy']:
-                self.Vfull[chan] = self.lockin_squid.convert_output(
-                    self.Vfull[chan])
-            self.Vfull['cap'] = self.lockin_cap.convert_output(
-                self.Vfull['cap']) - Vcap_offset
-
-            # Interpolate the data and store in the 2D arrays
-            for chan in self._daq_inputs:
-                if fast_axis == 'x':
-                    self.Vinterp[chan] = interp1d(
-                        self.Vfull['piezo'],
-                        self.Vfull[chan])(self.Vinterp['piezo']
-                                          )
-                    self.V[chan][i, :] = self.Vinterp[chan]
-                else:
-                    self.Vinterp[chan] = interp1d(
-                        self.Vfull['piezo'],
-                        self.Vfull[chan])(self.Vinterp['piezo']
-                                          )
-                    self.V[chan][:, i] = self.Vinterp[chan]
-
-            self.save_line(i, Vstart)
-            self.plot()
-        self.piezos.V = 0
+        # Full piezo output along the fast axis for this line
+        Vline = AttrDict()
+        Vline['piezo'] = output_data[fast_axis]
+        if offset is not None:
+            # Bin in the (drifting) coordinates of the sample
+            Vline['piezo'] = Vline['piezo'] - offset[fast_axis]
+
+        # Store this line's signals for Vdc, Vac x/y, and Cap
+        # Sometimes the daq doesn't return the right keys
+        # Using try/except to try to diagnose for the future.
+        for chan in self._daq_inputs:
+            try:
+                Vline[chan] = received[chan]
+            except Exception as e:
+                print(received)
+                raise e
+
+        # Convert from DAQ volts to lockin volts where applicable
+        for chan in ['acx', 'acy']:
+            Vline[chan] = self.lockin_squid.convert_output(Vline[chan])
+        Vline['cap'] = self.lockin_cap.convert_output(
+            Vline['cap']) - self._Vcap_offset
+
+        return Vstart, Vline
+
+
+    def _process_line(self, i, num_lines, Vstart, Vline, pixelizer):
+        '''
+        Bin an acquired line into pixels and save it.
+        Does not communicate with any instruments.
+        '''
+        self.Vfull = Vline
+
+        # Keep the full lines for hysteresis correction of fly scans
+        if self.fly:
+            self._store_fly_line(i, num_lines)
+
+        # Bin-average the data into pixels and store in the 2D arrays
+        self._pixelize_line(i, self.Vfull, pixelizer)
+
+        if self._drift_opts is not None:
+            self._update_drift(i)
+
+        self.save_line(i, Vstart)
+
+
+    def correct_hysteresis(self, chan='cap', apply=True):
+        '''
+        Estimate the offset between forward and backward lines of a fly scan
+        and shift the lines to correct for piezo backlash and hysteresis.
+
+        Each pair of consecutive (forward, backward) lines recorded versus
+        piezo output voltage is cross-correlated using the given channel.
+        The median offset is stored in self.hysteresis (piezo V); forward
+        lines are shifted by -hysteresis/2 and backward lines by
+        +hysteresis/2 before binning into pixels again.
+
+        Arguments:
+            chan: DAQ channel used to estimate the offset.
+            apply: If True, recompute self.V with the corrected positions.
+
+        Returns:
+            hysteresis (float): offset between forward and backward lines (V)
+        '''
+        if not hasattr(self, 'Vfly'):
+            raise Exception('Hysteresis correction requires a fly scan!')
+
+        offsets = []
+        num_lines = self.Vfly['piezo'].shape[0]
+        for i in range(0, num_lines - 1, 2):
+            piezo_f, piezo_b = self.Vfly['piezo'][i], self.Vfly['piezo'][i+1]
+            data_f, data_b = self.Vfly[chan][i], self.Vfly[chan][i+1]
+            if np.isnan(piezo_f).all() or np.isnan(piezo_b).all():
+                continue  # line not taken
+
+            # Resample both lines on a common uniform grid
+            lo = max(np.nanmin(piezo_f), np.nanmin(piezo_b))
+            hi = min(np.nanmax(piezo_f), np.nanmax(piezo_b))
+            n = max(len(piezo_f), len(piezo_b))
+            grid = np.linspace(lo, hi, n)
+            step = grid[1] - grid[0]
+            f = _resample(piezo_f, data_f, grid)
+            b = _resample(piezo_b, data_b, grid)
+
+            offsets.append(xcorr_lag(f, b) * step)
+
+        self.hysteresis = np.nanmedian(offsets) if offsets else np.nan
+        if apply and not np.isnan(self.hysteresis):
+            pixelizer = self._make_pixelizer()
+            for i in range(num_lines):
+                if np.isnan(self.Vfly['piezo'][i]).all():
+                    continue
+                sign = -1 if i % 2 == 0 else 1  # forward: -, backward: +
+                Vline = AttrDict({
+                    c: self.Vfly[c][i] for c in self._daq_inputs
+                })
+                Vline['piezo'] = self.Vfly['piezo'][i] \
+                                    + sign * self.hysteresis / 2
+                self._pixelize_line(i, Vline, pixelizer)
+            if self.fig is not None:
+                self.plot()
+
+        return self.hysteresis
+
+
+    def _make_pixelizer(self):
+        '''
+        Returns a Pixelizer for the pixel centers along the fast axis.
+        '''
+        if self.fast_axis == 'x':
+            return Pixelizer(self.X[0, :])
+        return Pixelizer(self.Y[:, 0])
+
+
+    def _pixelize_line(self, i, Vline, pixelizer):
+        '''
+        Bin-average the full line data in the dictionary Vline into the
+        pixels of line i and store in the 2D arrays. All channels are
+        binned in one pass. Vinterp is replaced in one step, so the plots
+        (drawn from another thread in pipeline mode) never mix two lines.
+        '''
+        Vinterp = AttrDict()
+        if self.fast_axis == 'x':
+            Vinterp['piezo'] = self.X[i, :]
+        elif self.fast_axis == 'y':
+            Vinterp['piezo'] = self.Y[:, i]
+
+        data = np.vstack([Vline[chan] for chan in self._daq_inputs])
+        mean, sem, counts = pixelizer.bin(Vline['piezo'], data)
+
+        if self.fast_axis == 'x':
+            index = (i, slice(None))
+        else:
+            index = (slice(None), i)
+        self.counts[index] = counts
+        for j, chan in enumerate(self._daq_inputs):
+            Vinterp[chan] = mean[j]
+            self.V[chan][index] = mean[j]
+            self.Vsem[chan][index] = sem[j]
+        self.Vinterp = Vinterp
+
+
+    def _store_fly_line(self, i, num_lines):
+        '''
+        Store the full (converted) data of line i in the 2D arrays self.Vfly.
+        Lines along a curved surface (see Planefit.sweep_surface) may have
+        slightly different numbers of points; shorter lines are padded
+        with NaN.
+        '''
+        n = len(self.Vfull['piezo'])
+        if not hasattr(self, 'Vfly') or self.Vfly['piezo'].shape[0] != num_lines:
+            self.Vfly = AttrDict({
+                chan: np.full((num_lines, n), np.nan)
+                for chan in self._daq_inputs + ['piezo']
+            })
+        elif n > self.Vfly['piezo'].shape[1]:
+            pad = n - self.Vfly['piezo'].shape[1]
+            for chan in self._daq_inputs + ['piezo']:
+                self.Vfly[chan] = np.pad(self.Vfly[chan], ((0, 0), (0, pad)),
+                                         'constant', constant_values=np.nan)
+        for chan in self._daq_inputs + ['piezo']:
+            self.Vfly[chan][i, :] = np.nan
+            self.Vfly[chan][i, :n] = self.Vfull[chan]
+
+
+    def _setup_drift(self, num_lines, reference, correct, chans, window,
+                     max_drift):
+        '''
+        Prepare the drift estimate for a scan of num_lines lines.
+        Estimated drifts are stored in self.drift (piezo V):
+            t: time of each line
+            x, y: total drift of each line
+            x_applied, y_applied: shift applied to each line (drift_correct)
+            frame: residual drift of the whole frame w.r.t. the reference
+        '''
+        ref = None
+        if reference is not None:
+            refV = getattr(reference, 'V', reference)
+            ref = AttrDict()
+            for chan in chans:
+                if np.shape(refV[chan]) != self.X.shape:
+                    raise Exception('Drift reference must have the same '
+                                    'shape as this scan!')
+                ref[chan] = self._as_lines(np.array(refV[chan], dtype=float))
+
+        self.drift = AttrDict({
+            key: np.full(num_lines, np.nan) for key in ['t', 'x', 'y']
+        })
+        self.drift['x_applied'] = np.zeros(num_lines)
+        self.drift['y_applied'] = np.zeros(num_lines)
+        self.drift['frame'] = np.array([np.nan, np.nan])
+        self.drift_rate = np.array([np.nan, np.nan])
+        self._drift_opts = AttrDict(reference=ref,
+                                    correct=correct,
+                                    chans=chans,
+                                    max_drift=max_drift,
+                                    estimator=DriftEstimator(window),
+                                    offset=AttrDict(x=0., y=0.))
+
+
+    def _as_lines(self, data):
+        '''
+        Returns the 2D array data with one scan line per row.
+        '''
+        return data if self.fast_axis == 'x' else data.T
+
+
+    def _drift_steps(self):
+        '''
+        Names of and pixel spacings (piezo V) along the fast and slow axes.
+        '''
+        fast, slow = ('x', 'y') if self.fast_axis == 'x' else ('y', 'x')
+        step = AttrDict(x=0., y=0.)
+        if self.X.shape[1] > 1:
+            step['x'] = self.X[0, 1] - self.X[0, 0]
+        if self.X.shape[0] > 1:
+            step['y'] = self.Y[1, 0] - self.Y[0, 0]
+        return fast, slow, step
+
+
+    def _drift_offset(self, i):
+        '''
+        Offset (piezo V) to add to line i to compensate for the predicted
+        drift, or None if not compensating.
+        '''
+        opts = self._drift_opts
+        if opts is None or not opts.correct:
+            return None
+        offset = opts.offset  # replaced (not modified) by _update_drift
+        self.drift['x_applied'][i] = offset['x']
+        self.drift['y_applied'][i] = offset['y']
+        return {'x': offset['x'], 'y': offset['y']}
+
+
+    def _update_drift(self, i):
+        '''
+        Estimate the drift of line i by FFT cross-correlation on the drift
+        channels, update the drift rate and the offset for the next lines.
+
+        With a reference frame, line i is correlated with the reference
+        lines near i, giving the drift along both axes. Otherwise, it is
+        correlated with the previous line swept in the same direction,
+        giving the change in drift along the fast axis only.
+        '''
+        opts = self._drift_opts
+        fast, slow, step = self._drift_steps()
+        lines = np.array([self._as_lines(self.V[chan])[i]
+                          for chan in opts.chans])
+        if np.isnan(lines).all():
+            return
+        applied = AttrDict(x=self.drift['x_applied'][i],
+                           y=self.drift['y_applied'][i])
+        total = AttrDict(x=np.nan, y=np.nan)
+
+        if opts.reference is not None:
+            num_lines = len(self.drift['t'])
+            w = int(np.ceil(opts.max_drift))
+            lo, hi = max(i - w, 0), min(i + w + 1, num_lines)
+            rows = np.array([opts.reference[chan][lo:hi]
+                             for chan in opts.chans])
+            shift, row = line_shift(lines, rows, max_shift=opts.max_drift)
+            total[fast] = applied[fast] + shift * step[fast]
+            total[slow] = applied[slow] + (i - lo - row) * step[slow]
+        else:
+            # Lines swept in the opposite direction are offset by hysteresis
+            j = i - 2 if self.raster else i - 1
+            if j < 0 or np.isnan(self.drift[fast][j]):
+                total[fast] = applied[fast]  # drift relative to first line
+            else:
+                prev = np.array([self._as_lines(self.V[chan])[j]
+                                 for chan in opts.chans])
+                shift, row = line_shift(lines, prev[:, None, :],
+                                        max_shift=opts.max_drift)
+                total[fast] = (self.drift[fast][j] + shift * step[fast]
+                               + applied[fast]
+                               - self.drift[fast + '_applied'][j])
+
+        self.drift['t'][i] = self.line_times[i]
+        self.drift['x'][i] = total['x']
+        self.drift['y'][i] = total['y']
+        opts.estimator.add(self.line_times[i], [total['x'], total['y']])
+        self.drift_rate = opts.estimator.rate
+
+        if opts.correct:
+            predicted = opts.estimator.predict(time.time())
+            opts.offset = AttrDict(x=predicted[0], y=predicted[1])
+
+
+    def _register_frame(self):
+        '''
+        Register the whole frame to the drift reference by phase correlation
+        and store the residual drift in self.drift['frame'] (piezo V).
+        '''
+        opts = self._drift_opts
+        if opts.reference is None:
+            return
+        fast, slow, step = self._drift_steps()
+        frame = np.array([self._as_lines(self.V[chan]) for chan in opts.chans])
+        ref = np.array([opts.reference[chan] for chan in opts.chans])
+        shift, peak = phase_correlation(frame, ref)
+        drift = AttrDict()
+        drift[slow] = shift[0] * step[slow]
+        drift[fast] = shift[1] * step[fast]
+        self.drift['frame'] = np.array([drift['x'], drift['y']])
+        print('Frame drift w.r.t. reference: x %.3g V, y %.3g V' %(
+            drift['x'], drift['y']))
 
 
     def plot_update(self):
@@ -297,6 +828,13 @@ class Scanplane(Measurement):
         # Update the line plot as well.
         self.plot_line()
 
+        # Show the live drift estimate
+        if getattr(self, 'drift', None) is not None:
+            rate = np.array(self.drift_rate) * 60  # V/min
+            self.fig.suptitle('Drift: x %.3g um/min, y %.3g um/min' %(
+                rate[0] * conversions.Vx_to_um,
+                rate[1] * conversions.Vy_to_um), size=10)
+
         # Iterate over the color plots and update data with new line
         for chan in self._daq_inputs:
             # Convert None in data to NaN
@@ -328,46 +866,23 @@ class Scanplane(Measurement):
             height = 10
             width = height*aspect + 4  # pad for colorbars/axis labels
 
-        # Make axis dicts, with daq input channels as keys.
+        # Plot the DC signal, capactitance and AC signal on 2D colorplots.
+        # self.V[chan] as initialized is just a 2D array of nans.
         self.fig = plt.figure(figsize=(width,height))
+        setup_scan_images(self, self.fig,
+                          [(num_row, num_col, i+1) for i in range(numplots)])
+
+        # Make axis dicts, with daq input channels as keys.
         self.fig_cuts = plt.figure(figsize=(6,8))
-        self.ax = AttrDict()
         self.ax_cuts = AttrDict()
         for i, chan in enumerate(self._daq_inputs):
-            # Populate axes in the figure.
-            self.ax[chan] = self.fig.add_subplot(num_row, num_col, i+1)
             self.ax_cuts[chan] = self.fig_cuts.add_subplot(
                                                 len(self._daq_inputs), 1, i+1)
 
-        # Determine colormaps and labels for each channel.
-        cmaps = AttrDict(dc='RdBu', cap='afmhot', acx='magma', acy='magma')
-        clabels = AttrDict(
-            dc = 'DC Flux ($\Phi_0$)',
-            cap = 'Capacitance (fF)',
-            acx = 'AC X ($\Phi_0$)',
-            acy = 'AC Y ($\Phi_0$)',
-        )
-
-        self.im = AttrDict()
         self.lines_full = AttrDict()
         self.lines_interp = AttrDict()
 
         for chan in self._daq_inputs:
-            ax = self.ax[chan]
-
-            # Plot the DC signal, capactitance and AC signal on 2D colorplots
-            # Plot masked data on the appropriate axis with imshow
-            # self.V[chan] as initialized is just a 2D array of nans.
-            image = ax.imshow(self.V[chan], cmap=cmaps[chan], origin="lower",
-                              extent = extents(self.X, self.Y))
-            self.im[chan] = image
-            self.add_colorbar(ax, label=clabels[chan])
-
-            # Label the axes - including a timestamp
-            ax.set_xlabel("X Position (V)")
-            ax.set_ylabel("Y Position (V)")
-            title = ax.set_title(self.timestamp, size=10, y=1.02)
-
             # Plot the last linecut for DC, AC and capacitance signals
             ax = self.ax_cuts[chan]
 
@@ -375,7 +890,7 @@ class Scanplane(Measurement):
             # Take the line object - not the list containing the line
             self.lines_full[chan] = ax.plot(np.nan, np.nan, '-')[0]
             self.lines_interp[chan] = ax.plot(np.nan, np.nan, 'ok', ms=3)[0]
-            ax.set_ylabel(clabels[chan])
+            ax.set_ylabel(scan_clabels[chan])
 
             # Scientific notation for <10^-2, >10^2
             ax.yaxis.get_major_formatter().set_powerlimits((-2,2))
@@ -411,20 +926,22 @@ class Scanplane(Measurement):
         '''
         Update the data in the linecut plot.
         '''
+        # The processing thread replaces these between lines
+        Vfull, Vinterp = self.Vfull, self.Vinterp
         for chan in self._daq_inputs:
             ax = self.ax_cuts[chan]
             l_full = self.lines_full[chan]
             l_interp = self.lines_interp[chan]
 
             # Update X and Y data for the "full data"
-            l_full.set_xdata(self.Vfull['piezo'] *
+            l_full.set_xdata(Vfull['piezo'] *
                                             self._conversions[self.fast_axis])
-            l_full.set_ydata(self.Vfull[chan] *
+            l_full.set_ydata(Vfull[chan] *
                                             self._conversions[chan])
-            # Update X and Y data for the interpolated data
-            l_interp.set_xdata(self.Vinterp['piezo'] *
+            # Update X and Y data for the pixel-averaged data
+            l_interp.set_xdata(Vinterp['piezo'] *
                                             self._conversions[self.fast_axis])
-            l_interp.set_ydata(self.Vinterp[chan] *
+            l_interp.set_ydata(Vinterp[chan] *
                                             self._conversions[chan])
             # Rescale axes for newly plotted data
             ax.relim()
@@ -447,3 +964,15 @@ class Scanplane(Measurement):
 
 class Line(Measurement):
     subdirectory = 'lines'
+
+
+def _resample(x, y, grid):
+    '''
+    Linearly interpolate y(x) onto grid, removing the mean.
+    x does not need to be sorted. Points where x is NaN are ignored.
+    '''
+    good = ~np.isnan(x)
+    x, y = x[good], y[good]
+    order = np.argsort(x)
+    y = np.interp(grid, x[order], y[order])
+    return y - np.mean(y)
@@ -1,5 +1,7 @@
-import numpy as np
+import numpy as np, h5py
 from numpy.linalg import lstsq
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from scipy import signal
 from .planefit import Planefit
 import time, os
 from datetime import datetime
@@ -13,6 +15,8 @@ from .measurement import Measurement
 from ..Utilities import conversions
 from ..Measurements.spectrum import SQUIDSpectrum
 from ..Utilities.utilities import AttrDict
+from ..Utilities.spectral import log_bin_index, band_rms, SpectralEngine, \
+                                 LogBinnedSpectrum
 
 class Scanspectra(Measurement):
     _daq_inputs = ['dc'] # DAQ channel labels expected by this class
@@ -24,13 +28,52 @@ class Scanspectra(Measurement):
 
     V = np.array([])
     psdAve = np.array([])
+    stream = False
 
     def __init__(self, instruments = {}, plane = None, span=[800,800],
                         center=[0,0], numpts=[20,20], scanheight=15,
-                        monitor_time=1, sample_rate=10000, num_averages=1):
+                        monitor_time=1, sample_rate=10000, num_averages=1,
+                        stream=False, nperseg=None, window='hann',
+                        bands=[[1, 10], [10, 100], [100, 1000]],
+                        bins_per_decade=None, keep_traces=False,
+                        num_workers=4):
+        '''
+        Take a spectrum at each point of a grid.
+
+        stream: If True, reduce the spectra as the scan goes (see
+            _do_stream). Only the following are kept:
+            - Vn_bands: (Ny, Nx, num_bands) RMS spectral density (V/rtHz)
+              in each of the given bands
+            - the spectrum at each point (V/rtHz), written to a
+              preallocated (Ny, Nx, Nf) dataset 'Vn' in a separate HDF5
+              file (self.spectra_filename) as soon as it is computed.
+              Spectra are log-binned if bins_per_decade is given, and then
+              also kept in spectra, a LogBinnedSpectrum with the
+              (Ny, Nx, num_bins) PSDs, saved with the scan.
+            - the raw time traces in the same file, if keep_traces.
+        nperseg: length of each segment for Welch's method. None: 1/8 of a
+            time trace.
+        window: window for Welch's method.
+        num_workers: number of threads computing spectra while the piezos
+            move to the next point.
+        '''
         super().__init__(instruments=instruments)
         self.instruments = instruments
 
+        self.stream = stream
+        self.nperseg = nperseg
+        self.window = window
+        self.bands = bands
+        self.bins_per_decade = bins_per_decade
+        self.keep_traces = keep_traces
+        self.num_workers = num_workers
+        self.conversion = 1
+        try:
+            self.conversion = conversions.Vsquid_to_phi0[
+                                            self.squidarray.sensitivity]
+        except:
+            pass
+
         # Define variables specified in init
         self.monitor_time = monitor_time
         self.sample_rate = sample_rate
@@ -60,11 +103,15 @@ class Scanspectra(Measurement):
             self.piezos.y.check_lim(self.Y[i,:])
             self.piezos.z.check_lim(self.Z[i,:])
 
+        if self.stream:
+            return self._do_stream(**kwargs)
+
         # Move to each point on the grid and take a spectrum
         for i in range(self.X.shape[0]):
             for j in range(self.Y.shape[1]):
                 print(self.X[i,j], self.Y[i,j])
-                self.piezos.V = {'x': self.X[i,j], 'y': self.Y[i,j], 'z': self.Z[i,j]}
+                self.plane.move_to(self.piezos, {'x': self.X[i,j],
+                                    'y': self.Y[i,j], 'z': self.Z[i,j]})
                 self.squidarray.reset()
                 time.sleep(0.5)
                 # Take the spectrum
@@ -80,12 +127,199 @@ class Scanspectra(Measurement):
         self.f = spectrum.f
         self.t = spectrum.t
 
+    def _do_stream(self, plot=True, **kwargs):
+        '''
+        Scan with spectra reduced on the fly. At each point, the time traces
+        are handed to a pool of worker threads that compute the Welch PSD
+        and reduce it while the piezos move on, so memory use does not grow
+        with the number of points.
+        '''
+        N = int(round(self.monitor_time * self.sample_rate))
+        nperseg = min(self.nperseg or N // 8, N)
+        f = np.fft.rfftfreq(nperseg, 1 / self.sample_rate)
+        # One FFT thread each; the pool already runs in parallel
+        engine = SpectralEngine(self.sample_rate, self.window, workers=1)
+        engine.get_window(nperseg)
+        Ny, Nx = self.X.shape
+        if self.bins_per_decade is not None:
+            self.f, idx, self.f_counts = log_bin_index(f,
+                                                       self.bins_per_decade)
+            self.spectra = LogBinnedSpectrum(self.f,
+                                    np.full((Ny, Nx, len(self.f)), np.nan),
+                                    self.bins_per_decade,
+                                    counts=self.f_counts)
+        else:
+            self.f = f
+        self.t = np.arange(N) / self.sample_rate
+
+        self.Vn_bands = np.full((Ny, Nx, len(self.bands)), np.nan)
+
+        if hasattr(self, 'preamp'):
+            gain = self.preamp.gain
+        else:
+            gain = 1
+
+        localpath, remotepath = self._make_paths(None)
+        self.spectra_filename = localpath + '_spectra.h5'
+        with h5py.File(self.spectra_filename, 'w') as fh:
+            fh.create_dataset('f', data=self.f)
+            Vn = fh.create_dataset('Vn', (Ny, Nx, len(self.f)),
+                                   dtype=np.dtype('float64'),
+                                   chunks=(1, 1, len(self.f)),
+                                   fillvalue=np.nan)
+            if self.keep_traces:
+                traces_dset = fh.create_dataset('V',
+                                    (Ny, Nx, self.num_averages, N),
+                                    dtype=np.dtype('float64'),
+                                    chunks=(1, 1, 1, N),
+                                    fillvalue=np.nan)
+
+            pending = set()
+            with ThreadPoolExecutor(self.num_workers) as pool:
+                for i in range(Ny):
+                    if self.interrupt:
+                        break
+                    for j in range(Nx):
+                        if self.interrupt:
+                            break
+                        self.plane.move_to(self.piezos, {'x': self.X[i,j],
+                                    'y': self.Y[i,j], 'z': self.Z[i,j]})
+                        self.squidarray.reset()
+                        time.sleep(0.5)
+
+                        traces = np.empty((self.num_averages, N))
+                        for k in range(self.num_averages):
+                            traces[k] = self._get_trace(N) / gain
+                        if self.keep_traces:
+                            traces_dset[i, j] = traces
+
+                        # The spectrum is computed while we move on
+                        pending.add(pool.submit(self._reduce, i, j, traces,
+                                                engine, nperseg))
+
+                        # Write finished spectra; don't let them pile up
+                        block = len(pending) > 2 * self.num_workers
+                        done, pending = wait(pending, timeout=None if block
+                                             else 0,
+                                             return_when=FIRST_COMPLETED)
+                        for future in done:
+                            self._write_spectrum(Vn, *future.result())
+                        if done:
+                            self.plot(plot=plot)
+
+                # Finish the remaining spectra
+                for future in wait(pending)[0]:
+                    self._write_spectrum(Vn, *future.result())
+
+        self.piezos.V = 0
+        self.plot(plot=plot)
+
+
+    def _get_trace(self, N, retries=2):
+        '''
+        Monitor the dc channel for N samples. A little more than N samples
+        are requested; a short read is retried, and if it is still short
+        the missing samples are NaN (the trace is then left out of the
+        spectrum, see _reduce).
+        '''
+        for attempt in range(retries + 1):
+            received = self.daq.monitor('dc', (N + 2) / self.sample_rate,
+                                        sample_rate=self.sample_rate)
+            V = np.asarray(received['dc'], dtype=float)
+            if len(V) >= N:
+                return V[:N]
+        print('Warning: DAQ returned %i of %i samples; trace ignored.'
+              %(len(V), N))
+        trace = np.full(N, np.nan)
+        trace[:len(V)] = V
+        return trace
+
+
+    def _reduce(self, i, j, traces, engine, nperseg):
+        '''
+        Welch PSD of the time traces taken at point (i, j), averaged over
+        the complete traces (computed by the SpectralEngine engine in one batch).
+        Stores the band RMS values and returns (i, j, Vn), the spectral
+        density, log-binned if bins_per_decade is given.
+        Runs in a worker thread.
+        '''
+        traces = traces[~np.isnan(traces).any(axis=1)]  # incomplete reads
+        if len(traces) == 0:
+            return i, j, np.full(len(self.f), np.nan)
+        f, psd = engine.welch(traces, nperseg)
+        psd = np.mean(psd, axis=0)
+        self.Vn_bands[i, j] = band_rms(f, psd, self.bands)
+        if self.bins_per_decade is not None:
+            psd = engine.log_binned(f, psd, self.bins_per_decade).psd
+            self.spectra.psd[i, j] = psd
+        return i, j, np.sqrt(psd)
+
+
+    def _write_spectrum(self, dset, i, j, Vn):
+        '''
+        Write the spectrum of point (i, j) to the dataset.
+        '''
+        dset[i, j, :] = Vn
+
+
+    def load_spectra(self):
+        '''
+        Returns the frequencies and the (Ny, Nx, Nf) spectral densities
+        (V/rtHz) of a streamed scan.
+        '''
+        with h5py.File(self.spectra_filename, 'r') as fh:
+            return fh['f'][:], fh['Vn'][:]
+
+
+    def save(self, filename=None, **kwargs):
+        '''
+        Save, and copy the file of streamed spectra to the data server.
+        '''
+        super().save(filename, **kwargs)
+        if self.stream and hasattr(self, 'spectra_filename'):
+            localpath, remotepath = self._make_paths(filename)
+            if remotepath is not None:
+                self._copy_to_remote(localpath + '_spectra',
+                                     remotepath + '_spectra')
+
+
     def setup_preamp(self):
         self.preamp.dc_coupling()
         self.preamp.diff_input(False)
         self.preamp.filter_mode('low',12)
 
-    def plot(self):
+    def setup_plots(self):
+        '''
+        One map per frequency band (streaming mode).
+        '''
+        if not self.stream:
+            return super().setup_plots()
+        self.fig = plt.figure(figsize=(5 * len(self.bands), 5))
+        self.ax = []
+        self.im = []
+        extent = [self.X.min(), self.X.max(), self.Y.min(), self.Y.max()]
+        for k, (fmin, fmax) in enumerate(self.bands):
+            ax = self.fig.add_subplot(1, len(self.bands), k + 1)
+            im = ax.imshow(np.full(self.X.shape, np.nan), origin='lower',
+                           extent=extent)
+            self.add_colorbar(ax, label=r'$\mathrm{\phi_0/\sqrt{Hz}}$')
+            ax.set_title('%g-%g Hz' %(fmin, fmax), size=10)
+            ax.set_xlabel('X Position (V)')
+            ax.set_ylabel('Y Position (V)')
+            self.ax.append(ax)
+            self.im.append(im)
+        self.fig.tight_layout()
+
+    def plot_update(self):
+        '''
+        Update the band maps (streaming mode).
+        '''
+        for k, im in enumerate(self.im):
+            self.update_image(im, self.Vn_bands[:, :, k] * self.conversion)
+
+    def plot(self, **kwargs):
+        if self.stream:
+            return Measurement.plot(self, **kwargs)
         self.fig, self.ax = plt.subplots(figsize=(6,6))
         freq_avg = np.mean(self.psdAve, axis=2)
         extent = [self.X.min(), self.X.max(), self.Y.min(), self.Y.max()]
@@ -1,10 +1,13 @@
 import matplotlib.pyplot as plt, os, re, numpy as np, time
+from concurrent.futures import ThreadPoolExecutor
 from scipy import signal
 from .measurement import Measurement
 from ..Utilities.utilities import AttrDict
+from ..Utilities.save import scratch_array
 from ..Utilities import conversions
+from ..Utilities.spectral import PSDAccumulator, fit_one_over_f, \
+                                 LogBinnedSpectrum
 from scipy.optimize import curve_fit
-from scipy.stats import linregress as lr
 
 class DaqSpectrum(Measurement):
     '''
@@ -21,6 +24,13 @@ class DaqSpectrum(Measurement):
     Vn = 1
     units = 'V'
     conversion = 1
+    method = 'periodogram'
+    window = 'blackmanharris'
+    nperseg = None
+    noverlap = None
+    keep_traces = None
+    decimate = 1
+    scratch = None
 
     def __init__(
             self,
@@ -28,7 +38,14 @@ class DaqSpectrum(Measurement):
             measure_time=0.5,
             measure_freq=256000,
             averages=30,
-            preamp_gain=1):
+            preamp_gain=1,
+            method='periodogram',
+            window='blackmanharris',
+            nperseg=None,
+            noverlap=None,
+            keep_traces=None,
+            decimate=1,
+            scratch=None):
         '''
         Create a DaqSpectrum object
 
@@ -39,10 +56,24 @@ class DaqSpectrum(Measurement):
         measure_freq (int?): frequency that the DAQ measures the output channel
         averages (int): number of time traces averaged before computing the FFT
         preamp_gain (float): gain factor from preamp
+        method (str): 'periodogram' (one PSD per time trace) or 'welch'
+        window (str): window for the PSD of each trace (or segment)
+        nperseg, noverlap (int): segment length and overlap for Welch's method
+            (scipy.signal.welch defaults if None)
+        keep_traces (int): number of time traces kept (the last ones).
+            None keeps all of them, 0 none.
+        decimate (int): kept time traces are decimated by this factor
+            (with an anti-aliasing filter). The PSD uses the full traces.
+        scratch (str): where the kept time traces are stored as they arrive:
+            None (memory), 'memmap' (memory-mapped temporary file) or 'hdf5'
+            (temporary HDF5 file), see Utilities.save.scratch_array.
+            Use a file for many long traces at high sample rates.
         '''
         super().__init__(instruments=instruments)
 
-        for arg in ['measure_time', 'measure_freq', 'averages', 'preamp_gain']:
+        for arg in ['measure_time', 'measure_freq', 'averages', 'preamp_gain',
+                    'method', 'window', 'nperseg', 'noverlap', 'keep_traces',
+                    'decimate', 'scratch']:
             setattr(self, arg, eval(arg))
 
         self.timetraces_t = [None]*averages
@@ -73,27 +104,15 @@ class DaqSpectrum(Measurement):
         f = self.f[argmin:argmax]
         Vn = self.Vn[argmin:argmax]
 
-        for i in range(len(filters)):
-            freq0 = filters[i]
-            freq = freq0
-            j=1
-            while freq < f[-1]:
-                # harmonics
-                freq = freq0 * j
-                j += 1
-
-                where, = np.where(abs(f-freq) > filters_bw[i]/2)  # find indices where frequency is outside bandwidth of filter center frequency
-                f = f[where]
-                Vn = Vn[where]
-
         # popt, pcov = curve_fit(one_over_f, f, Vn, p0=[1e-5,.5], bounds=([-np.inf, .4], [np.inf, .6]))
         # return popt
-        m,b, _, _, _ = lr(np.log(f), np.log(Vn))
+        A, alpha = fit_one_over_f(f, Vn, filters=filters,
+                                  filters_bw=filters_bw)
 
         if plot and self.ax is not None:
-            self.ax['loglog'].loglog(np.exp(b)*self.f**(m))
+            self.ax['loglog'].loglog(A*self.f**(-alpha))
 
-        return np.exp(b), -m
+        return A, alpha
 
     def get_average(self, fmin=0, fmax=None):
         '''
@@ -124,37 +143,69 @@ class DaqSpectrum(Measurement):
     def get_spectrum(self):
         '''
         Collect time traces from the DAQ and compute the FFT.
+        The spectrum of each trace is added to a running average in a worker
+        thread while the next trace is acquired, so the total time is close
+        to averages * measure_time. Only the last keep_traces time traces
+        are kept (see __init__), written in place into arrays allocated
+        when the first trace arrives (see scratch).
+
+        Also sets psd_std, the standard deviation of the PSDs of the traces
+        in each frequency bin, and Vmean, the mean voltage.
 
         Returns:
         Vn (np.ndarray): Square root of the power spectral density
         '''
-        Nfft = self.get_Nfft()
-
-        psdAve = np.zeros(int(Nfft))
-
-        for i in range(self.averages):
-            t, V = self.get_time_trace()
-
-            # Divide by gain
-            if hasattr(self, 'preamp'):
-                gain = self.preamp.gain
-            else:
-                gain = self.preamp_gain
-            V /= gain
-
-            self.timetraces_t[i] = t
-            self.timetraces_V[i] = V
-            self.f, psd = signal.periodogram(V, self.measure_freq,
-                                             'blackmanharris')
-            psdAve = psdAve + psd
-
-        self.timetraces_t = np.array(self.timetraces_t)
-        self.timetraces_V = np.array(self.timetraces_V)
-
-        # Normalize by the number of averages
-        psdAve = psdAve / self.averages
+        acc = PSDAccumulator(self.measure_freq, self.method, self.window,
+                             self.nperseg, self.noverlap)
+        num_keep = self.averages if self.keep_traces is None \
+                   else min(self.keep_traces, self.averages)
+        self.timetraces_t = np.zeros((0, 0))
+        self.timetraces_V = np.zeros((0, 0))
+        Vsum = 0
+
+        # Divide by gain
+        if hasattr(self, 'preamp'):
+            gain = self.preamp.gain
+        else:
+            gain = self.preamp_gain
+
+        future = None
+        with ThreadPoolExecutor(1) as pool:
+            for i in range(self.averages):
+                t, V = self.get_time_trace()
+                V = V / gain
+                Vsum += V.mean()
+
+                if num_keep:
+                    # Ring of the last num_keep traces
+                    if self.decimate > 1:
+                        t = t[::self.decimate]
+                        Vkeep = signal.decimate(V, self.decimate)
+                    else:
+                        Vkeep = V
+                    if i == 0:
+                        self.timetraces_t = scratch_array(
+                            (num_keep, len(t)), self.scratch)
+                        self.timetraces_V = scratch_array(
+                            (num_keep, len(Vkeep)), self.scratch)
+                    # Last num_keep traces, oldest first
+                    row = (i - self.averages) % num_keep
+                    self.timetraces_t[row] = t
+                    self.timetraces_V[row] = Vkeep
+
+                # Wait for the spectrum of the previous trace
+                if future is not None:
+                    future.result()
+                future = pool.submit(acc.add, V)
+
+            if future is not None:
+                future.result()
+
+        self.f = acc.f
+        self.psd_std = acc.std
+        self.Vmean = Vsum / self.averages
         # Convert spectrum to V/sqrt(Hz)
-        return np.sqrt(psdAve)
+        return np.sqrt(acc.mean)
 
     def get_std(self, fmin=0, fmax=None):
         '''
@@ -191,6 +242,13 @@ class DaqSpectrum(Measurement):
             obj.Vn = obj.psdAve  # legacy loading after variable name change
         return obj
 
+    def log_binned(self, bins_per_decade=10):
+        '''
+        The spectrum as a LogBinnedSpectrum (in units of self.units)
+        '''
+        return LogBinnedSpectrum(self.f, (self.Vn * self.conversion)**2,
+                                 bins_per_decade, self.units)
+
     def plot(self):
         '''
         Plot the power spectral density on a loglog and semilog scale
@@ -229,31 +287,26 @@ class DaqSpectrum(Measurement):
 
     def welch_from_timetraces(self, window='hanning', nperseg=30*2**7):
         '''
-        Compute the PSD using Welch's method (post data-taking)
-        kwargs for `scipy.signal.welch`
+        Compute the PSD using Welch's method (post data-taking) from the
+        time traces that were kept (see keep_traces and decimate).
+        window and nperseg as for `scipy.signal.welch`
 
         Returns:
         f (np.ndarray): Array of frequency values
         Vn (np.ndarray): Square root of the power spectral density
         '''
-        N = len(self.timetraces_V[0])
-        psdAve = None
-
-        for i in range(self.averages):
-            t = self.timetraces_t[i]
-            V = self.timetraces_V[i]
+        if len(self.timetraces_V) == 0 or self.timetraces_V[0] is None:
+            raise Exception('No time traces were kept!')
 
-            f, psd = signal.welch(V, self.measure_freq, window=window,
-                nperseg=nperseg)
-            if psdAve is None:
-                psdAve = psd
-            else:
-                psdAve = psdAve + psd
+        # Batches of traces; scratch arrays are not read in all at once
+        acc = PSDAccumulator(self.measure_freq / self.decimate, 'welch',
+                             window, nperseg)
+        batch = 8
+        for i in range(0, len(self.timetraces_V), batch):
+            acc.add(np.asarray(self.timetraces_V[i:i+batch]))
 
-        # Normalize by the number of averages
-        psdAve = psdAve / self.averages
         # Convert spectrum to V/sqrt(Hz)
-        return f, np.sqrt(psdAve)
+        return acc.f, np.sqrt(acc.mean)
 
 
 class ZurichSpectrum(DaqSpectrum):
@@ -269,7 +322,8 @@ class ZurichSpectrum(DaqSpectrum):
             averages=30,
             input_ch = 0,
             preamp_gain=1,
-            force_autorange=True):
+            force_autorange=True,
+            **kwargs):
         '''
         Create a ZurichSpectrum object
 
@@ -281,8 +335,10 @@ class ZurichSpectrum(DaqSpectrum):
         preamp_gain - gain of preamp used in measurement
         force_autorange - force autorange the Zurich before measurement (if input range too high)
             By default, the Zurich *will* autorange if overloading regardless of this parameter.
+        kwargs: passed to DaqSpectrum (e.g. method, keep_traces)
         '''
-        super().__init__(instruments, None, measure_freq, averages, preamp_gain)
+        super().__init__(instruments, None, measure_freq, averages, preamp_gain,
+                         **kwargs)
 
         if hasattr(self, 'zurich'):
             if measure_freq not in self.zurich.freq_opts:
@@ -327,3 +383,87 @@ class SQUIDSpectrum(DaqSpectrum):
         super().__init__(*args, **kwargs)
         self.units = '\phi_0'
         self.conversion = conversions.Vsquid_to_phi0[self.squidarray.sensitivity]
+
+
+class SR760Spectrum(DaqSpectrum):
+    '''
+    Use the SR760 spectrum analyzer to take a spectrum. The instrument
+    averages (averages spectra), so f, Vn, plot, fit_one_over_f, log_binned
+    etc. work as for DaqSpectrum, but no time traces are kept.
+    '''
+    instrument_list = ['sr760']  # 'preamp' optional
+
+    def __init__(
+            self,
+            instruments={},
+            averages=30,
+            preamp_gain=1,
+            trace=0,
+            timeout=None):
+        '''
+        Create a SR760Spectrum object
+
+        Args:
+        instruments (dict): Instrument dictionary
+        averages (int): number of spectra averaged by the SR760
+        preamp_gain (float): gain factor from preamp
+        trace (int): SR760 trace to read
+        timeout (float): s to wait for averaging to complete (None: forever)
+        '''
+        super().__init__(instruments, None, None, averages, preamp_gain,
+                         keep_traces=0)
+        self.trace = trace
+        self.timeout = timeout
+
+    def get_Nfft(self):
+        '''
+        Number of frequency bins of the SR760.
+        '''
+        return self.sr760._NUM_BINS
+
+    def get_spectrum(self):
+        '''
+        Set up the SR760 for PSD averaging, restart averaging and read the
+        spectrum when it is complete.
+
+        Returns:
+        Vn (np.ndarray): Square root of the power spectral density
+        '''
+        self.sr760.setup_psd(self.trace)
+        self.sr760.set_averaging(self.averages)
+        f, V = self.sr760.acquire(self.trace, self.timeout)
+        return self._set_spectrum(f, V)
+
+    def _set_spectrum(self, f, V):
+        '''
+        Store a spectrum read from the SR760 (divided by the gain).
+        '''
+        if hasattr(self, 'preamp'):
+            gain = self.preamp.gain
+        else:
+            gain = self.preamp_gain
+        self.f = f
+        self.psd_std = np.full(len(f), np.nan)  # not available
+        self.Vmean = np.nan
+        self.Vn = V / gain
+        return self.Vn
+
+    def spectra(self, num=None, plot=False, save=False):
+        '''
+        Generator of num spectra (None: never stops): the SR760 restarts
+        averaging after each spectrum. Each spectrum is a new SR760Spectrum
+        with the settings of this one (plotted and saved if requested).
+        '''
+        self.setup_preamp()
+        self.sr760.setup_psd(self.trace)
+        self.sr760.set_averaging(self.averages)
+        for f, V in self.sr760.spectra(num, self.trace, self.timeout):
+            spectrum = SR760Spectrum(self.instruments, self.averages,
+                                     self.preamp_gain, self.trace,
+                                     self.timeout)
+            spectrum._set_spectrum(f, V)
+            if plot:
+                spectrum.plot()
+            if save:
+                spectrum.save()
+            yield spectrum
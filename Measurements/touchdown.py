@@ -1,8 +1,8 @@
-from scipy.optimize import curve_fit
 import time, os, matplotlib, matplotlib.pyplot as plt, numpy as np
 from .measurement import Measurement
 from ..Utilities import conversions
-from ..Utilities.utilities import AttrDict
+from ..Utilities.utilities import AttrDict, Pixelizer
+from ..Utilities.touchdown_history import TouchdownHistory
 
 _Z_PIEZO_STEP = 4  # V piezo
 _Z_PIEZO_STEP_SLOW = 4  # V piezo
@@ -34,6 +34,275 @@ def piecewise_linear(x, x0, y0, m1, m2):
                          lambda x: m2*x + y0 - m2*x0])
 
 
+def fit_piecewise_linear(x, y):
+    '''
+    Least squares fit of piecewise_linear to y(x), exact and without
+    initial parameters. Every breakpoint is tried at once using cumulative
+    sums, so the cost is O(n) per curve:
+    - breakpoints at each x[j] (a line plus a hinge at x[j])
+    - breakpoints between x[k] and x[k+1], where the best continuous fit
+      is two independent line fits to the points on either side, provided
+      the lines intersect between x[k] and x[k+1].
+    The fit with the smallest sum of squared residuals is returned.
+
+    NaN values of y are ignored. y may be a stack of curves with shape
+    (..., n); x is then either shared (shape (n,)) or has the same shape
+    as y. x does not need to be sorted.
+
+    Returns:
+    p (array): best fit parameters x0, y0, m1 and m2, shape (..., 4)
+    err (array): one standard deviation errors in the parameters, as from
+        curve_fit. NaN if the curve could not be fit.
+    '''
+    y = np.asarray(y, dtype=float)
+    x = np.broadcast_to(np.asarray(x, dtype=float), y.shape)
+    order = np.argsort(x, axis=-1)
+    x = np.take_along_axis(x, order, axis=-1)
+    y = np.take_along_axis(y, order, axis=-1)
+
+    w = (~np.isnan(y) & ~np.isnan(x)).astype(float)
+    x = np.where(w > 0, x, np.nan_to_num(x))
+    y = np.where(w > 0, y, 0)
+    # Center and scale x and y for well conditioned sums
+    num = np.maximum(np.sum(w, axis=-1, keepdims=True), 1)
+    xm = np.sum(w * x, axis=-1, keepdims=True) / num
+    xs = np.max(w * np.abs(x - xm), axis=-1, keepdims=True)
+    ym = np.sum(w * y, axis=-1, keepdims=True) / num
+    ys = np.max(w * np.abs(y - ym), axis=-1, keepdims=True)
+    xs[xs == 0] = 1
+    ys[ys == 0] = 1
+    u = (x - xm) / xs
+    v = w * (y - ym) / ys
+
+    # Sums over points i <= k (L) and i > k (R) for every k
+    sums = [np.cumsum(q, axis=-1)
+            for q in (w, w * u, w * u ** 2, v, u * v, v ** 2)]
+    L = sums
+    R = [q[..., -1:] - q for q in sums]
+    n, Su, Suu, Sv, Suv, Svv = [q[..., -1:] for q in sums]
+
+    # Line plus a hinge at u[j]: regressors 1, u, h = max(0, u - u[j])
+    nR, SuR, SuuR, SvR, SuvR = R[:5]
+    Sh = SuR - u * nR
+    Suh = SuuR - u * SuR
+    Shh = SuuR - 2 * u * SuR + u ** 2 * nR
+    Shv = SuvR - u * SvR
+    A = np.stack([np.stack([n + 0 * u, Su + 0 * u, Sh], -1),
+                  np.stack([Su + 0 * u, Suu + 0 * u, Suh], -1),
+                  np.stack([Sh, Suh, Shh], -1)], -2)
+    b = np.stack([Sv + 0 * u, Suv + 0 * u, Shv], -1)
+    good = (L[0] >= 2) & (nR >= 1)
+    A[~good] = np.eye(3)
+    coef = np.linalg.solve(A, b[..., None])[..., 0]
+    sse_hinge = np.where(good, Svv - np.sum(coef * b, axis=-1), np.inf)
+    # x0, y0, m1, m2 of the hinge fits
+    hinge = np.stack([u, coef[..., 0] + coef[..., 1] * u,
+                      coef[..., 1], coef[..., 1] + coef[..., 2]], -1)
+
+    # Two independent lines on either side of the gap after point k
+    def line(n, Su, Suu, Sv, Suv, Svv):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            m = (n * Suv - Su * Sv) / (n * Suu - Su ** 2)
+            c = (Sv - m * Su) / n
+            return m, c, Svv - c * Sv - m * Suv
+    m1, c1, sse1 = line(*L)
+    m2, c2, sse2 = line(*R)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        u0 = (c2 - c1) / (m1 - m2)
+    u_next = np.concatenate([u[..., 1:], u[..., -1:]], axis=-1)
+    good = (L[0] >= 2) & (R[0] >= 2) & (u0 >= u) & (u0 <= u_next)
+    sse_free = np.where(good, sse1 + sse2, np.inf)
+    free = np.stack([u0, c1 + m1 * u0, m1, m2], -1)
+
+    # Best of all candidates
+    sse = np.concatenate([sse_hinge, sse_free], axis=-1)
+    cand = np.concatenate([hinge, free], axis=-2)
+    best = np.argmin(sse, axis=-1)
+    p = np.take_along_axis(cand, best[..., None, None], axis=-2)[..., 0, :]
+    fail = ~np.isfinite(np.take_along_axis(sse, best[..., None], -1)[..., 0])
+
+    # Back to the units of x and y
+    xm, xs, ym, ys = xm[..., 0], xs[..., 0], ym[..., 0], ys[..., 0]
+    p = np.stack([p[..., 0] * xs + xm, p[..., 1] * ys + ym,
+                  p[..., 2] * ys / xs, p[..., 3] * ys / xs], -1)
+    p[fail] = np.nan
+
+    # Errors from the Jacobian of piecewise_linear, as in curve_fit
+    x0, y0, m1, m2 = [p[..., k, None] for k in range(4)]
+    left = x < x0
+    dx = x - x0
+    J = np.stack([-np.where(left, m1, m2), np.ones(x.shape),
+                  np.where(left, dx, 0), np.where(left, 0, dx)], -1)
+    J *= w[..., None]
+    resid = w * (y - np.where(left, y0 + m1 * dx, y0 + m2 * dx))
+    dof = np.sum(w, axis=-1) - 4
+    with np.errstate(invalid='ignore', divide='ignore'):
+        s2 = np.sum(resid ** 2, axis=-1) / dof
+    JJ = np.einsum('...ni,...nj->...ij', J, J)
+    ok = ~fail & (dof > 0) & (np.abs(np.linalg.det(np.where(
+        np.isfinite(JJ), JJ, 0))) > 0)
+    JJ[~ok] = np.eye(4)
+    cov = np.linalg.inv(JJ) * np.where(ok, s2, np.nan)[..., None, None]
+    err = np.sqrt(np.abs(np.diagonal(cov, axis1=-2, axis2=-1)))
+    return p, err
+
+
+class TouchdownDetector(object):
+    '''
+    Online detector for the increase in slope of the capacitance at
+    touchdown, for use on a continuous stream of (V, C) samples sorted by V.
+
+    Each time new samples arrive, the last window samples are fit with a
+    line plus a hinge, C = a + b*V + c*max(0, V - Vb), for every candidate
+    breakpoint Vb at once using cumulative sums (O(window)). The test
+    statistic is the reduction of the sum of squared residuals by the hinge,
+    in units of the residual variance, divided by the correlation length of
+    the residuals (in samples; the lockin output is low-pass filtered). This
+    is roughly chi-squared distributed without a touchdown.
+
+    Once the statistic suggests a touchdown (suspicious), the start of the
+    fit is anchored before the estimated breakpoint instead of sliding, so
+    a slow rise is not lost when the breakpoint leaves the window.
+
+    A touchdown is detected when the statistic exceeds threshold, the slope
+    increases (c > 0) and the capacitance has risen by at least min_rise
+    (fF) above the line at the end of the data, or the data extend more
+    than max_overshoot (V) past the estimated breakpoint.
+        >> d = TouchdownDetector(max_overshoot=10)
+        >> i = d.update(V, C)  # for each new chunk; None until detected
+    '''
+    def __init__(self, min_samples=100, window=1000, threshold=50,
+                 min_rise=_CAPACITANCE_THRESHOLD, max_overshoot=None):
+        '''
+        min_samples: number of samples needed before testing.
+        window: number of most recent samples used in the fit, so that slow
+            curvature of the capacitance far from the sample is ignored.
+        threshold: detection threshold for the test statistic.
+        min_rise: minimum rise above the baseline (fF) for a touchdown.
+        max_overshoot: distance (V) past the estimated breakpoint after which
+            a significant breakpoint is a touchdown even if the rise is less
+            than min_rise. None: no limit.
+        '''
+        self.min_samples = min_samples
+        self.window = window
+        self.threshold = threshold
+        self.min_rise = min_rise
+        self.max_overshoot = max_overshoot
+        self._V = np.zeros(4 * window)  # grown by doubling
+        self._C = np.zeros(4 * window)
+        self.n = 0
+        self.statistic = 0
+        self.corr_length = 1
+        self.breakpoint = None  # index of the estimated breakpoint
+        self._anchor = None  # start of the fit once suspicious
+
+
+    @property
+    def V(self):
+        return self._V[:self.n]
+
+
+    @property
+    def C(self):
+        return self._C[:self.n]
+
+
+    def _hinge_fit(self, x, y):
+        '''
+        Fit y = a + b*x + c*max(0, x - x[j]) for every j.
+        Returns the index of the best breakpoint, the statistic, c and the
+        rise of the hinge at the end of the data.
+        '''
+        n = len(x)
+        x = x - x.mean()  # better conditioned sums
+        # Residual of the straight line fit
+        b = np.sum(x * (y - y.mean())) / np.sum(x ** 2)
+        e = y - y.mean() - b * x
+
+        # Sums over i > j (suffix sums) for every j
+        def suffix(v):
+            return np.concatenate([np.cumsum(v[::-1])[::-1][1:], [0]])
+        cnt, Sx, Sxx = suffix(np.ones(n)), suffix(x), suffix(x ** 2)
+        Se, Sxe = suffix(e), suffix(x * e)
+
+        # Hinge regressor h_j = max(0, x - x_j) projected out of (1, x)
+        he = Sxe - x * Se
+        hh = Sxx - 2 * x * Sx + x ** 2 * cnt
+        h1 = Sx - x * cnt
+        hx = Sxx - x * Sx
+        hh_perp = hh - h1 ** 2 / n - hx ** 2 / np.sum(x ** 2)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            reduction = he ** 2 / hh_perp
+        reduction[:2] = 0
+        reduction[n - 3:] = 0  # need a few points after the breakpoint
+        reduction[~np.isfinite(reduction)] = 0
+        j = np.argmax(reduction)
+        c = he[j] / hh_perp[j] if hh_perp[j] > 0 else 0
+
+        # Residual variance and correlation length of the best hinge fit
+        h = np.maximum(0, x - x[j])
+        A = np.vstack([np.ones(n), x, h]).T
+        r = y - A @ np.linalg.lstsq(A, y, rcond=None)[0]
+        sigma2 = max(np.mean(r ** 2), 1e-24)
+        ac = np.correlate(r, r, 'full')[n - 1:n - 1 + n // 4] \
+                / (sigma2 * n)
+        negative = np.where(ac <= 0)[0]
+        if len(negative):
+            ac = ac[:negative[0]]
+        self.corr_length = max(1, 2 * np.sum(ac) - 1)
+
+        statistic = reduction[j] / sigma2 / self.corr_length
+        return j, statistic, c, c * (x[-1] - x[j])
+
+
+    def update(self, V, C):
+        '''
+        Add new samples. Returns the index (into all samples so far) of the
+        estimated touchdown, or None if no touchdown detected yet.
+        '''
+        V, C = np.ravel(V), np.ravel(C)
+        n = self.n + len(V)
+        if n > len(self._V):
+            size = max(n, 2 * len(self._V))
+            self._V = np.concatenate([self._V, np.zeros(size - len(self._V))])
+            self._C = np.concatenate([self._C, np.zeros(size - len(self._C))])
+        self._V[self.n:n] = V
+        self._C[self.n:n] = C
+        self.n = n
+        if n < self.min_samples:
+            return None
+
+        if self._anchor is None:
+            first = max(0, n - self.window)
+        else:
+            first = self._anchor
+        j, self.statistic, c, rise = self._hinge_fit(self._V[first:n],
+                                                     self._C[first:n])
+        self.breakpoint = first + j
+
+        if self._anchor is None:
+            if self.suspicious:  # keep baseline before the breakpoint
+                self._anchor = max(0, self.breakpoint - self.window // 2)
+        elif not self.suspicious and n - self._anchor > 4 * self.window:
+            self._anchor = None  # false alarm; slide again
+
+        overshoot = self._V[n - 1] - self._V[self.breakpoint]
+        if self.statistic > self.threshold and c > 0 \
+                and (rise > self.min_rise or (self.max_overshoot is not None
+                     and overshoot >= self.max_overshoot)):
+            return self.breakpoint
+        return None
+
+
+    @property
+    def suspicious(self):
+        '''
+        True if the statistic is rising, i.e. a touchdown may be close.
+        '''
+        return self.statistic > self.threshold / 4
+
+
 class Touchdown(Measurement):
     _daq_inputs = ['cap', 'capx', 'capy', 'theta']
     instrument_list = ['lockin_cap', 'atto', 'piezos', 'daq']
@@ -48,10 +317,14 @@ class Touchdown(Measurement):
     start_offset = 0
 
     baseline = 0
+    continuous = False
+    record_history = True  # add good touchdowns to the TouchdownHistory
 
     subdirectory = 'touchdowns'
 
-    def __init__(self, instruments={}, disable_atto=False, Vz_max=None):
+    def __init__(self, instruments={}, disable_atto=False, Vz_max=None,
+                 continuous=False, sweep_rate=10, meas_rate=None,
+                 max_overshoot=10, lag_tc=1):
         '''
         Approach the sample to the SQUID while recording the capacitance
         of the cantelever in a lockin measurement to detect touchdown.
@@ -60,6 +333,17 @@ class Touchdown(Measurement):
         instruments -- dictionary containing instruments for the touchdown.
         disable_atto -- if set to True the z attocube will not move.
         Vz_max -- the maximum voltage that can be applied to the Z piezo.
+        continuous -- if True, sweep the Z piezo continuously while the DAQ
+            records all channels, and detect the touchdown on the stream
+            (see do_sweep_continuous) instead of stepping and waiting.
+        sweep_rate -- Z piezo sweep rate in continuous mode (V/s).
+        meas_rate -- DAQ sampling rate in continuous mode. None: default
+            for the sweep rate (see Piezos.sweep).
+        max_overshoot -- approximate largest distance (V) the Z piezo
+            moves past the touchdown in continuous mode. Sets the length of
+            each piece of the sweep.
+        lag_tc -- delay of the lockin output in units of its time constant.
+            Used to correct the piezo voltage in continuous mode.
 
         Required instruments:
         daq, lockin_cap, atto, piezos
@@ -82,6 +366,12 @@ class Touchdown(Measurement):
             else:
                 self.Vz_max = 200  # just for the sake of having something
 
+        self.continuous = continuous
+        self.sweep_rate = sweep_rate
+        self.meas_rate = meas_rate
+        self.max_overshoot = max_overshoot
+        self.lag_tc = lag_tc
+
         self._init_arrays()
         self.disable_atto = disable_atto
         self.error_flag = False
@@ -299,7 +589,7 @@ q: Quit' %(self.atto.z.pos, self.attoshift))
         self.lockin_cap.ac_coupling()
         # self.lockin_cap.auto_phase
 
-    def do(self, start=None, plot=True, **kwargs):
+    def do(self, start=None, plot=True, window=None, **kwargs):
         '''
         Does the touchdown.
         Timestamp is determined at the beginning of this function.
@@ -307,18 +597,31 @@ q: Quit' %(self.atto.z.pos, self.attoshift))
 
         Args:
         start (float) -- Starting position (in voltage) of Z piezo.
+        window (float) -- If given, start is a prediction (e.g. from a
+            plane) that lies window V below the expected touchdown. If no
+            touchdown is found above start, or it is found right at start
+            (the sample may have been touching already), the sweep is
+            repeated starting window, then 2*window, 4*window... V lower,
+            down to -Vz_max, before the attocube is moved.
+
+        Variables stored:
+        start (float) -- start of the sweep that found the touchdown
+        approach (float) -- total distance swept by the Z piezo (V)
         '''
 
         self.Vtd = None
         # If the surface location is unknown, sweep all the way down
         if start is None:
             start = -self.Vz_max
+        self.approach = 0
 
         # Loop that does sweeps of z piezo
         # Z atto is moved up between iterations
         # Loop breaks when true touchdown detected.
         while not self.touchdown:
             # Specify a starting voltage for the Z piezo.
+            self.start = start
+            self.Vtd = None
             self.piezos.z.V = start
 
             # Wait for capacitance to settle, then
@@ -327,19 +630,43 @@ q: Quit' %(self.atto.z.pos, self.attoshift))
 
             # Get a baseline measurement of the variance
             self.check_balance()
-            self.get_baseline()
+            if not self.continuous:  # the detector fits its own baseline
+                self.get_baseline()
 
             # Reinitialize arrays
             self._init_arrays()
 
             # Inner loop to sweep z-piezo
-            self.do_sweep(start)
+            if self.continuous:
+                self.do_sweep_continuous(start)
+            else:
+                self.do_sweep(start)
+            self.approach += self.piezos.z.V - start
+
+            # Widen the window below a predicted start
+            if window is not None and start > -self.Vz_max:
+                too_close = self.touchdown and \
+                    self.Vtd < start + 2 * self.z_piezo_step
+                if self.Vtd in (None, -1) or too_close:
+                    self.touchdown = False
+                    self.error_flag = False
+                    start = max(start - window, -self.Vz_max)
+                    print('No touchdown found above %.1f V, '
+                          'retrying from %.1f V' %(self.start, start))
+                    window *= 2
+                    continue
 
             # Move the z attocube
             # Either we're too far away for a touchdown or Vtd not centered
             self._move_attocube()
             start = -self.Vz_max # start far away next time
 
+        if self.record_history and not self.error_flag:
+            try:
+                TouchdownHistory().add_touchdown(self)
+            except Exception as e:
+                print('Could not add touchdown to history: %s' %e)
+
         self.piezos.z.V = 0  # bring the piezo back to zero
 
 
@@ -370,28 +697,139 @@ q: Quit' %(self.atto.z.pos, self.attoshift))
             self.touchdown = self.check_touchdown()
 
             if self.touchdown:
-                # Extract the touchdown voltage.
-                self.Vtd = self.get_td_v()
+                if not self._finish_touchdown():
+                    continue
+                break
 
-                # If the fit is not "good", flag the touchdown.
-                if self.err[0] > 10.:
-                    self.error_flag = True
 
-                # Added 11/1/2016 to try to handle exceptions in calculating
-                # td voltage
-                if self.Vtd == -1:
-                    self.touchdown = False
-                    continue
+    def _finish_touchdown(self):
+        '''
+        Helper function for do_sweep and do_sweep_continuous:
+        Fit the touchdown voltage once a touchdown is detected, flag a bad
+        fit and, if allowed, determine how to move the attocube to center
+        the touchdown.
+
+        Returns False if the touchdown voltage could not be determined.
+        '''
+        # Extract the touchdown voltage.
+        self.Vtd = self.get_td_v()
+
+        # If the fit is not "good", flag the touchdown.
+        if self.err[0] > 10.:
+            self.error_flag = True
+
+        # Added 11/1/2016 to try to handle exceptions in calculating
+        # td voltage
+        if self.Vtd == -1:
+            self.touchdown = False
+            return False
 
-                self.plot_td()
+        self.plot_td()
 
-                # Don't want to move attos during planescan or bad fit
-                if not self.disable_atto and not self.error_flag:
-                    # Check if touchdown near center of z piezo +V range
-                    self._determine_attoshift_to_center()
-                    start = -self.Vz_max # start far away next time
+        # Don't want to move attos during planescan or bad fit
+        if not self.disable_atto and not self.error_flag:
+            # Check if touchdown near center of z piezo +V range
+            self._determine_attoshift_to_center()
+        return True
+
+
+    def do_sweep_continuous(self, start):
+        '''
+        Sweep the Z piezo continuously from start, recording cap, capx,
+        capy and theta with hardware-timed DAQ acquisition, and stop as
+        soon as a TouchdownDetector finds the touchdown in the stream.
+
+        The sweep is done in pieces of max_overshoot/2 V (a quarter of that
+        once the detector sees the capacitance start to rise), and a
+        significant breakpoint counts as the touchdown once the piezo is
+        max_overshoot past it, so the piezo moves at most about
+        max_overshoot past the touchdown even if the capacitance rises
+        slowly. The full stream is kept in self.stream (preallocated, grown
+        by doubling); each piece is also added to running averages on the
+        usual voltage grid (self.V, self.C, ...) for plotting.
+
+        Args:
+        start (float) -- Starting position (in voltage) of Z piezo.
+        '''
+        # The lockin output lags behind the piezo
+        Vlag = self.sweep_rate * self.lag_tc * self.lockin_cap.time_constant
+        # The data lag Vlag behind the piezo, which stops max_overshoot past
+        # the breakpoint
+        detector = TouchdownDetector(
+                    max_overshoot=max(self.max_overshoot - Vlag, 0))
+        pixelizer = Pixelizer(self.V)
+        keys = ['V', 'C', 'Cx', 'Cy', 'theta']
+        self.stream = AttrDict({key: np.zeros(0) for key in keys})
+        n = 0
+        # Running sums for the averages on the voltage grid
+        sums = np.zeros((4, len(self.V)))
+        counts = np.zeros(len(self.V))
+
+        chunk = self.max_overshoot / 2
+        V0 = start
+        while V0 < self.Vz_max:
+            if self.interrupt:
                 break
 
+            step = chunk / 4 if detector.suspicious else chunk
+            V1 = min(V0 + step, self.Vz_max)
+            if detector.suspicious:
+                # Go no further than max_overshoot past the breakpoint
+                Vstop = self.stream['V'][detector.breakpoint] \
+                        + self.max_overshoot
+                if Vstop > V0:
+                    V1 = min(V1, Vstop)
+            output_data, received = self.piezos.sweep({'z': V0}, {'z': V1},
+                                                chan_in=self._daq_inputs,
+                                                sweep_rate=self.sweep_rate,
+                                                meas_rate=self.meas_rate)
+            V0 = V1
+
+            Cap = self.lockin_cap.convert_output(received['cap']) \
+                    * conversions.V_to_C
+            if self.C0 is None:
+                self.C0 = np.mean(Cap[:10])  # Sets the offset datum
+            new = AttrDict(V=output_data['z'] - Vlag,
+                           C=Cap - self.C0,
+                           Cx=received['capx'],
+                           Cy=received['capy'],
+                           theta=received['theta'])
+            m = n + len(new['V'])
+            if m > len(self.stream['V']):  # grow by doubling
+                size = max(m, 2 * len(self.stream['V']))
+                for key in keys:
+                    grown = np.zeros(size)
+                    grown[:n] = self.stream[key][:n]
+                    self.stream[key] = grown
+            for key in keys:
+                self.stream[key][n:m] = new[key]
+            n = m
+
+            # Add the piece to the averages on the voltage grid
+            data = np.vstack([new[key] for key in keys[1:]])
+            mean, sem, num = pixelizer.bin(new['V'], data)
+            sums += np.nan_to_num(mean * num)
+            counts += num
+            with np.errstate(invalid='ignore', divide='ignore'):
+                self.C, self.Cx, self.Cy, self.theta = sums / counts
+
+            self.plot()
+
+            itd = detector.update(new['V'], new['C'])
+            if itd is not None:
+                for key in keys:
+                    self.stream[key] = self.stream[key][:n]
+                self.touchdown = True
+                self.stream['itd'] = itd  # index of detected touchdown
+                # Overshoot beyond the detected touchdown (V)
+                self.overshoot = V1 - self.stream['V'][itd]
+                if self._finish_touchdown():
+                    break
+                self.touchdown = False
+
+        for key in keys:
+            self.stream[key] = self.stream[key][:n]
+
 
     def get_baseline(self):
         '''
@@ -416,29 +854,25 @@ q: Quit' %(self.atto.z.pos, self.attoshift))
 
         Fit a continuous piecewise linear function to the capacitance trace. The
         point where the function transitions between the two lines is recorded
-        as the touchdown voltage.
+        as the touchdown voltage. The fit is exact and needs no initial
+        parameters (see fit_piecewise_linear).
 
         Variables stored:
         p (array): Best fit parameters x0, y0, m1 and m2 (see piecewise_linear)
         err (array): Error in fitting parameters
 
         Returns
-        Vtd: touchdown voltage
+        Vtd: touchdown voltage, -1 if the fit failed
         '''
-        C = self.C[~np.isnan(self.C)]
-        V = self.V[~np.isnan(self.C)]
-        # Try to fit with no initial parameters
-        self.p, e = curve_fit(piecewise_linear, V, C)
-        if e[0,0] == np.inf:
-            Cp = np.gradient(C)
-            Cpp = np.gradient(Cp)
-            i = np.nanargmax(Cpp)  # spike in second derivative = slope change
-            p0 = [self.V[i], 0, 0, 0]  # x0, y0, m1, m2
-            self.p, e = curve_fit(piecewise_linear, V, C, p0=p0)
-            if e[0,0] == np.inf:
-                print('Could not fit touchdown!')
-        # Calculate one standard deviation errors in the fit parameters
-        self.err = np.sqrt(np.abs(np.diag(e)))
+        if self.continuous:
+            # Fit all samples of the stream rather than the binned data
+            V, C = self.stream['V'], self.stream['C']
+        else:
+            V, C = self.V, self.C
+        self.p, self.err = fit_piecewise_linear(V, C)
+        if np.isnan(self.p[0]):
+            print('Could not fit touchdown!')
+            return -1
         return self.p[0]
 
 
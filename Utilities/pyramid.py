@@ -0,0 +1,224 @@
+'''
+Multi-resolution (mipmap) storage of large 2D arrays in HDF5, and a viewer
+that loads only the tiles and level needed for the current zoom.
+
+A pyramid is an HDF5 group containing datasets '0', '1', '2', ...
+Level 0 is the full array and each following level is downsampled by 2 in
+both directions (NaN-aware average of 2x2 blocks). Every level is chunked in
+tiles of tile x tile pixels, so reading a region only touches the chunks
+that overlap it.
+
+Savers write pyramids for the keys listed in their _pyramid_keys attribute
+to the group '#pyramid' of their HDF5 file (see Saver._save_hdf5).
+'''
+import numpy as np, h5py, os, json
+import matplotlib.pyplot as plt
+
+from . import conversions
+
+PYRAMID_GROUP = '#pyramid'
+
+
+def downsample(data):
+    '''
+    Downsample a 2D array by 2 in each direction by averaging 2x2 blocks,
+    ignoring NaNs. Odd dimensions are padded with NaN.
+    '''
+    ny, nx = data.shape
+    padded = np.full((ny + ny % 2, nx + nx % 2), np.nan)
+    padded[:ny, :nx] = data
+    blocks = padded.reshape(padded.shape[0]//2, 2, padded.shape[1]//2, 2)
+    counts = np.sum(~np.isnan(blocks), axis=(1, 3))
+    sums = np.nansum(blocks, axis=(1, 3))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sums / counts  # NaN where all four pixels are NaN
+
+
+def write_pyramid(group, name, data, tile=256):
+    '''
+    Write a pyramid of the 2D array data to a new subgroup of the given
+    h5py group. Levels are added until a level fits within one tile.
+
+    Arguments:
+    group (h5py.Group): group to write to
+    name (str): name of the pyramid group
+    data (np.ndarray): 2D array
+    tile (int): size of the (square) chunks in pixels
+    '''
+    data = np.asarray(data, dtype=np.float64)
+    g = group.create_group(name)
+    g.attrs['tile'] = tile
+    level = 0
+    while True:
+        chunks = (min(tile, data.shape[0]), min(tile, data.shape[1]))
+        d = g.create_dataset(str(level), data.shape, dtype=np.float64,
+                             chunks=chunks, compression='gzip',
+                             fillvalue=np.nan)
+        d[...] = data
+        if max(data.shape) <= tile:
+            break
+        data = downsample(data)
+        level += 1
+    g.attrs['levels'] = level + 1
+    return g
+
+
+def read_region(pyramid, level, rows, cols):
+    '''
+    Read the region [rows[0]:rows[1], cols[0]:cols[1]] (in level-0 pixels)
+    of the given level of a pyramid. Only the chunks overlapping the region
+    are read from disk.
+
+    Returns the data and the (rows, cols) of the region actually read, in
+    level-0 pixels.
+    '''
+    d = pyramid[str(level)]
+    f = 2 ** level
+    r0 = int(np.clip(np.floor(rows[0] / f), 0, d.shape[0]))
+    r1 = int(np.clip(np.ceil(rows[1] / f), r0, d.shape[0]))
+    c0 = int(np.clip(np.floor(cols[0] / f), 0, d.shape[1]))
+    c1 = int(np.clip(np.ceil(cols[1] / f), c0, d.shape[1]))
+    return d[r0:r1, c0:c1], (r0 * f, r1 * f), (c0 * f, c1 * f)
+
+
+class PyramidViewer(object):
+    '''
+    Interactive viewer for one or more pyramids (e.g. a mosaic of scans).
+    Each time the view is panned or zoomed, each source is redrawn using the
+    coarsest level that still gives about one data pixel per screen pixel,
+    reading only the tiles inside the view.
+
+    Example:
+        sources = scan_sources(['2018-01-01_120000_Scanplane',
+                                '2018-01-01_130000_Scanplane'], chan='dc')
+        viewer = PyramidViewer(sources)
+    '''
+    def __init__(self, sources, ax=None, cmap='RdBu', **kwargs):
+        '''
+        sources: list of dictionaries with keys
+            'filename': path to the .h5 file
+            'path': path to the pyramid group within the file
+            'extent': [xmin, xmax, ymin, ymax] of the full array
+        ax: matplotlib axes to draw on. If None, makes a new figure.
+        Additional kwargs are passed to imshow.
+        '''
+        self.sources = sources
+        if ax is None:
+            self.fig, self.ax = plt.subplots()
+        else:
+            self.ax = ax
+            self.fig = ax.figure
+        self.cmap = cmap
+        self.kwargs = kwargs
+        self._files = [h5py.File(s['filename'], 'r') for s in sources]
+        self._images = [None] * len(sources)
+
+        # Show the full area covered by all sources
+        extents = np.array([s['extent'] for s in sources])
+        self.ax.set_xlim(extents[:, 0].min(), extents[:, 1].max())
+        self.ax.set_ylim(extents[:, 2].min(), extents[:, 3].max())
+
+        self.update()
+        self.ax.callbacks.connect('xlim_changed', self.update)
+        self.ax.callbacks.connect('ylim_changed', self.update)
+
+
+    def close(self):
+        '''
+        Close all files.
+        '''
+        for f in self._files:
+            f.close()
+
+
+    def update(self, *args):
+        '''
+        Redraw every source for the current view limits.
+        '''
+        xlim = sorted(self.ax.get_xlim())
+        ylim = sorted(self.ax.get_ylim())
+        # Size of the axes in screen pixels
+        bbox = self.ax.get_window_extent()
+        screen_px = max(bbox.width, 1), max(bbox.height, 1)
+
+        for n, (s, f) in enumerate(zip(self.sources, self._files)):
+            pyramid = f[s['path']]
+            shape = pyramid['0'].shape
+            xmin, xmax, ymin, ymax = s['extent']
+            dx = (xmax - xmin) / shape[1]
+            dy = (ymax - ymin) / shape[0]
+
+            # Visible region in level-0 pixels (origin lower)
+            cols = ((xlim[0] - xmin) / dx, (xlim[1] - xmin) / dx)
+            rows = ((ylim[0] - ymin) / dy, (ylim[1] - ymin) / dy)
+            if cols[1] <= 0 or rows[1] <= 0 or cols[0] >= shape[1] \
+                    or rows[0] >= shape[0]:
+                if self._images[n] is not None:
+                    self._images[n].set_visible(False)
+                continue
+
+            # Coarsest level with at least one data pixel per screen pixel
+            data_px = max((cols[1] - cols[0]) / screen_px[0],
+                          (rows[1] - rows[0]) / screen_px[1])
+            level = int(np.clip(np.floor(np.log2(max(data_px, 1))), 0,
+                                pyramid.attrs['levels'] - 1))
+
+            data, (r0, r1), (c0, c1) = read_region(pyramid, level, rows, cols)
+            extent = [xmin + c0 * dx, xmin + min(c1, shape[1]) * dx,
+                      ymin + r0 * dy, ymin + min(r1, shape[0]) * dy]
+            data = np.ma.masked_where(np.isnan(data), data)
+
+            im = self._images[n]
+            if im is None:
+                self._images[n] = self.ax.imshow(data, extent=extent,
+                                                 origin='lower',
+                                                 cmap=self.cmap,
+                                                 aspect='auto',
+                                                 **self.kwargs)
+            else:
+                im.set_data(data)
+                im.set_extent(extent)
+                im.set_visible(True)
+
+        self.fig.canvas.draw_idle()
+
+
+def scan_sources(filenames, chan='dc', key='V'):
+    '''
+    Build PyramidViewer sources from saved scans (e.g. Scanplanes saved with
+    pyramid=True), placing each scan using the attocube position saved with
+    it, so that scans taken after moving the attocubes line up.
+    Extents are in (approximate) um.
+
+    Arguments:
+    filenames (list): paths of saved scans (with or without extension)
+    chan (str): channel to view
+    key (str): attribute the pyramid was saved from
+    '''
+    from .save import get_json_value  # save imports this module
+
+    sources = []
+    for filename in filenames:
+        filename = os.path.splitext(filename)[0]
+        # Only read the JSON; the data stay on disk.
+        with open(filename + '.json', encoding='utf-8') as f:
+            d = json.load(f)
+
+        x0, y0 = 0, 0
+        try:
+            x0 = get_json_value(d, 'atto', 'x', 'position')  # um
+            y0 = get_json_value(d, 'atto', 'y', 'position')
+        except (KeyError, TypeError):
+            print('No attocube position in %s. Using (0, 0).' %filename)
+
+        center = get_json_value(d, 'center')
+        span = get_json_value(d, 'span')
+        xmin = x0 + (center[0] - span[0] / 2) * conversions.Vx_to_um
+        xmax = x0 + (center[0] + span[0] / 2) * conversions.Vx_to_um
+        ymin = y0 + (center[1] - span[1] / 2) * conversions.Vy_to_um
+        ymax = y0 + (center[1] + span[1] / 2) * conversions.Vy_to_um
+
+        sources.append({'filename': filename + '.h5',
+                        'path': '%s/%s/%s' %(PYRAMID_GROUP, key, chan),
+                        'extent': [xmin, xmax, ymin, ymax]})
+    return sources
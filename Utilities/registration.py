@@ -0,0 +1,234 @@
+'''
+FFT-based registration of lines and images, used for tracking drift.
+
+Shift convention: a shift d of a with respect to b means a[n] = b[n - d],
+i.e. features in b appear at larger indices in a when d > 0.
+'''
+import numpy as np
+
+
+def _prepare(data, window=None):
+    '''
+    Remove the mean, replace NaNs (missing pixels) by zero and normalize
+    by the standard deviation, so channels with different units can be
+    combined.
+    '''
+    data = np.array(data, dtype=float)
+    data = data - np.nanmean(data)
+    data[np.isnan(data)] = 0
+    std = np.std(data)
+    if std > 0:
+        data /= std
+    if window is not None:
+        data *= window
+    return data
+
+
+def _parabolic(y0, y1, y2):
+    '''
+    Subpixel offset of the peak of a parabola through three points
+    at -1, 0, 1.
+    '''
+    denom = y0 - 2 * y1 + y2
+    if denom == 0:
+        return 0
+    return 0.5 * (y0 - y2) / denom
+
+
+def xcorr_lag(a, b):
+    '''
+    Lag (in samples, with subpixel parabolic refinement) by which a is
+    shifted with respect to b, found by FFT cross-correlation.
+    '''
+    n = len(a)
+    nfft = 2 ** int(np.ceil(np.log2(2 * n)))  # zero pad to avoid wrapping
+    xc = np.fft.irfft(np.fft.rfft(a, nfft) * np.conj(np.fft.rfft(b, nfft)),
+                      nfft)
+    xc = np.roll(xc, n)[:2 * n]  # lags from -n to n-1
+    k = np.argmax(xc)
+    lag = k - n
+    if 0 < k < len(xc) - 1:  # parabolic interpolation around the peak
+        lag += _parabolic(xc[k-1], xc[k], xc[k+1])
+    return lag
+
+
+def line_shift(lines, ref_rows, max_shift=None):
+    '''
+    Find where a line best matches a few rows of a reference image.
+    All rows are cross-correlated with the line at once using FFTs, and the
+    correlations of all channels are summed.
+
+    Arguments:
+    lines (array): (num_channels, n) current line, one row per channel
+    ref_rows (array): (num_channels, num_rows, n) reference rows
+    max_shift (int): largest lag along the line to consider (samples).
+        None: any lag.
+
+    Returns:
+    shift (float): shift of the line along its length with respect to the
+        best matching reference row (samples, subpixel)
+    row (float): index of the best matching reference row (subpixel)
+    '''
+    lines = np.atleast_2d(lines)
+    ref_rows = np.array(ref_rows, dtype=float)
+    if ref_rows.ndim == 2:
+        ref_rows = ref_rows[None, :, :]
+    n = lines.shape[-1]
+    nfft = 2 ** int(np.ceil(np.log2(2 * n)))
+
+    xc = 0
+    for line, rows in zip(lines, ref_rows):
+        a = np.fft.rfft(_prepare(line), nfft)
+        B = np.fft.rfft(np.array([_prepare(r) for r in rows]), nfft, axis=-1)
+        xc = xc + np.fft.irfft(a[None, :] * np.conj(B), nfft, axis=-1)
+    xc = np.roll(xc, n, axis=-1)[:, :2 * n]  # lags from -n to n-1
+
+    if max_shift is not None:
+        max_shift = int(max_shift)
+        xc[:, :max(n - max_shift, 0)] = -np.inf
+        xc[:, n + max_shift + 1:] = -np.inf
+
+    row, k = np.unravel_index(np.argmax(xc), xc.shape)
+    shift = k - n
+    if 0 < k < xc.shape[1] - 1 and np.all(np.isfinite(xc[row, k-1:k+2])):
+        shift += _parabolic(*xc[row, k-1:k+2])
+    r = float(row)
+    if 0 < row < xc.shape[0] - 1:
+        r += _parabolic(*xc[row-1:row+2, k])
+    return shift, r
+
+
+def _upsampled_dft(data, size, factor, offsets):
+    '''
+    Inverse DFT of data evaluated only on a size x size region of a grid
+    upsampled by factor, starting at offsets (in upsampled pixels).
+    Computed by matrix multiplication, which is much cheaper than zero
+    padding the whole array.
+    '''
+    for n, offset in zip(data.shape[::-1], offsets[::-1]):
+        kernel = (np.arange(size) - offset)[:, None] \
+                    * np.fft.fftfreq(n, factor)[None, :]
+        kernel = np.exp(2j * np.pi * kernel)
+        data = np.tensordot(kernel, data, axes=(1, -1))
+    return data
+
+
+def phase_correlation(a, b, upsample=20, whiten=0.5):
+    '''
+    Subpixel shift of image a with respect to image b by phase correlation.
+    Images may be single 2D arrays or (num_channels, ny, nx) stacks, in which
+    case the cross-power spectra of all channels are summed. NaNs (e.g. in
+    an unfinished scan) are ignored.
+
+    The integer peak is refined to 1/upsample pixels by evaluating the
+    upsampled correlation in a small region around the peak only
+    (Guizar-Sicairos et al., Opt. Lett. 33, 156 (2008)).
+
+    whiten sets how the cross-power spectrum is normalized: 1 is pure phase
+    correlation, 0 plain cross-correlation. Pure phase correlation weights
+    all frequencies equally, including noisy high frequencies, which makes
+    it unreliable for small, smooth scan images; 0.5 is a robust compromise.
+
+    Returns:
+    shift (array): (shift along axis 0, shift along axis 1) in pixels
+    peak (float): height of the correlation peak, relative to the height
+        for identical images; close to 0 if the images are unrelated.
+    '''
+    a = np.array(a, dtype=float)
+    b = np.array(b, dtype=float)
+    if a.ndim == 2:
+        a, b = a[None], b[None]
+    ny, nx = a.shape[-2:]
+    window = np.outer(np.hanning(ny), np.hanning(nx))  # reduce edge effects
+
+    R = 0
+    for ai, bi in zip(a, b):
+        R = R + np.fft.fft2(_prepare(ai, window)) \
+                * np.conj(np.fft.fft2(_prepare(bi, window)))
+    R /= np.abs(R) ** whiten + 1e-15
+    r = np.real(np.fft.ifft2(R))
+    norm = np.sum(np.abs(R)) / (ny * nx)  # peak height for identical images
+
+    iy, ix = np.unravel_index(np.argmax(r), r.shape)
+    peak = r[iy, ix] / norm
+    # Shifts larger than half the image are negative
+    shift = np.array([iy - ny if iy > ny // 2 else iy,
+                      ix - nx if ix > nx // 2 else ix], dtype=float)
+
+    if upsample > 1:
+        size = int(np.ceil(upsample * 1.5))
+        center = np.fix(size / 2)
+        offsets = center - shift * upsample
+        cc = np.real(_upsampled_dft(R, size, upsample, offsets))
+        k = np.unravel_index(np.argmax(cc), cc.shape)
+        shift += (np.array(k) - center) / upsample
+        peak = cc[k] / (ny * nx) / norm
+    return shift, peak
+
+
+class DriftEstimator(object):
+    '''
+    Keeps a history of measured drifts (e.g. in piezo V) with timestamps,
+    fits a drift rate and predicts the drift at a later time.
+        >> d = DriftEstimator(window=20)
+        >> d.add(time.time(), [dx, dy])
+        >> d.rate  # [x rate, y rate] per second
+        >> d.predict(time.time())
+    '''
+    def __init__(self, window=20):
+        '''
+        window: number of most recent measurements used in the fit.
+        '''
+        self.window = window
+        self.t = []
+        self.drift = []
+
+
+    def add(self, t, drift):
+        '''
+        Add a drift measurement made at time t. NaN components are allowed
+        (e.g. a direction that could not be measured).
+        '''
+        self.t.append(t)
+        self.drift.append(np.array(drift, dtype=float))
+        self.t = self.t[-self.window:]
+        self.drift = self.drift[-self.window:]
+
+
+    def _fit(self):
+        '''
+        Linear fit of each drift component vs time.
+        Returns slopes and intercepts (NaN if not enough data).
+        '''
+        t = np.array(self.t)
+        d = np.array(self.drift)
+        slope = np.full(d.shape[1], np.nan)
+        intercept = np.full(d.shape[1], np.nan)
+        for j in range(d.shape[1]):
+            good = ~np.isnan(d[:, j])
+            if good.sum() >= 3:
+                slope[j], intercept[j] = np.polyfit(t[good] - t[0],
+                                                    d[good, j], 1)
+            elif good.sum() > 0:
+                slope[j], intercept[j] = 0, d[good, j][-1]
+        return slope, intercept
+
+
+    @property
+    def rate(self):
+        '''
+        Fitted drift rate per second.
+        '''
+        if len(self.t) == 0:
+            return np.array([np.nan, np.nan])
+        return self._fit()[0]
+
+
+    def predict(self, t):
+        '''
+        Predicted drift at time t. Components without data are 0.
+        '''
+        if len(self.t) == 0:
+            return np.zeros(2)
+        slope, intercept = self._fit()
+        return np.nan_to_num(intercept + slope * (t - self.t[0]))
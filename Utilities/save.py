@@ -2,9 +2,9 @@ from jsonpickle.ext import numpy as jspnp
 import json, os, jsonpickle as jsp, numpy as np, subprocess, numpy
 from datetime import datetime as dt
 jspnp.register_handlers() # what is purpose of this line?
-import h5py, glob, matplotlib, platform, hashlib, shutil, socket
+import h5py, glob, matplotlib, platform, hashlib, shutil, socket, tempfile
 import matplotlib.pyplot as plt
-from . import utilities
+from . import utilities, pyramid
 import Nowack_Lab # Necessary for saving as Nowack_Lab-defined types
 
 '''
@@ -25,6 +25,8 @@ as necessary) and populate the numpy arrays.
 class Saver(object):
     subdirectory = ''  # Formerly "appendedpath".
         # Name of subdirectory off the main data directory where data is saved.
+    _pyramid_keys = []  # Attributes (2D arrays or dicts of 2D arrays) also
+        # saved as multi-resolution tiled pyramids. See Utilities/pyramid.py
 
     def __init__(self):
         super().__init__()  # To deal with multiple inheritance mro
@@ -43,8 +45,8 @@ class Saver(object):
             keys = list(d.keys())  # make list to avoid dictionary changing size
 
             for k in keys:
-                # Don't save numpy arrays to JSON
-                if type(d[k]) is np.ndarray:
+                # Don't save numpy arrays (or scratch arrays) to JSON
+                if _is_array(d[k]):
                     d[k] = None
 
                 # Don't save matplotlib objects to JSON
@@ -145,6 +147,10 @@ class Saver(object):
                 Walk through dictionary and populate with h5 data.
                 '''
                 for key in f.keys():
+                    # Skip extra copies of the data (e.g. pyramids)
+                    if key[0] == '#':
+                        continue
+
                     # Dictionary or object
                     if f.get(key, getclass=True) is h5py._hl.group.Group:
                         if key[0] == '!': # it's an object
@@ -333,13 +339,13 @@ class Saver(object):
                     key = str(key)  # Some may be ints; convert to str
                     key = key.replace('/','-')  ## HACK: Zurich dict keys have / and will create unwanted groups in the base of the tree
 
-                    if type(value) is np.ndarray:
+                    if _is_array(value):
                         # Save the numpy array as a dataset
                         d = group.create_dataset(key, value.shape,
                             compression = 'gzip', compression_opts=9,
                             dtype=np.dtype('float64'))
                         d.set_fill_value = np.nan
-                        d[...] = value
+                        _copy_array(value, d)
 
                     # If a dictionary
                     elif isinstance(value, dict):
@@ -355,6 +361,19 @@ class Saver(object):
 
             walk(self.__dict__, f)
 
+            # Multi-resolution tiled copies for fast browsing
+            if self._pyramid_keys:
+                pgroup = f.create_group(pyramid.PYRAMID_GROUP)
+                for key in self._pyramid_keys:
+                    value = getattr(self, key, None)
+                    if isinstance(value, dict):
+                        group = pgroup.create_group(key)
+                        for k, v in value.items():
+                            if type(v) is np.ndarray and v.ndim == 2:
+                                pyramid.write_pyramid(group, str(k), v)
+                    elif type(value) is np.ndarray and value.ndim == 2:
+                        pyramid.write_pyramid(pgroup, key, value)
+
 
     def _save_json(self, filename):
         '''
@@ -447,6 +466,25 @@ def get_data_paths(experiment='', kind=''):
     return paths
 
 
+def get_json_value(d, *keys):
+    '''
+    Gets a value from the raw JSON dictionary of a saved object without
+    loading the object (and its instruments). Objects are saved by
+    jsonpickle as {"py/object": ..., "py/state": {...}}; the "py/state"
+    levels are skipped.
+        >> with open(filename + '.json') as f:
+        >>     d = json.load(f)
+        >> get_json_value(d, 'atto', 'x', 'position')
+
+    Raises KeyError (or TypeError) if the value is not in the file.
+    '''
+    for key in keys:
+        if isinstance(d, dict) and 'py/state' in d:
+            d = d['py/state']
+        d = d[key]
+    return d
+
+
 def get_experiment_data_dir():
     '''
     Returns the current experiment data directory. (Not the full path)
@@ -561,6 +599,56 @@ def set_experiment_data_dir(description=''):
         f.write(now_fmt + '_' + description)
 
 
+def scratch_array(shape, kind=None, directory=None):
+    '''
+    Preallocated float array (filled with NaN) for data too large to keep
+    in memory, e.g. time traces. Rows can be written as they arrive
+    (a[i] = V) and the array is saved by Saver like a numpy array.
+
+    kind:
+    - None: a numpy array in memory
+    - 'memmap': a numpy memmap of a temporary file
+    - 'hdf5': a dataset (chunked by row) in a temporary HDF5 file
+    directory: directory of the temporary file (None: system default).
+        The file is deleted when the array is no longer used.
+    '''
+    if kind is None:
+        return np.full(shape, np.nan)
+    if kind == 'memmap':
+        a = np.memmap(tempfile.TemporaryFile(dir=directory), dtype='float64',
+                      mode='w+', shape=tuple(shape))
+        a[...] = np.nan
+        return a
+    if kind == 'hdf5':
+        f = h5py.File(tempfile.TemporaryFile(dir=directory), 'w')
+        chunks = (1,) + tuple(shape[1:]) if len(shape) > 1 else None
+        return f.create_dataset('scratch', shape, dtype='float64',
+                                chunks=chunks, fillvalue=np.nan)
+    raise Exception('Scratch array kind must be None, memmap or hdf5!')
+
+
+def _is_array(value):
+    '''
+    True for arrays saved to HDF5: numpy arrays (including memmaps) and
+    HDF5 datasets (see scratch_array).
+    '''
+    return isinstance(value, (np.ndarray, h5py.Dataset))
+
+
+def _copy_array(source, dest, max_bytes=2**26):
+    '''
+    Copy an array or HDF5 dataset into an HDF5 dataset, in blocks of rows
+    of at most max_bytes, so that scratch arrays are not read into memory
+    all at once.
+    '''
+    if source.ndim == 0 or source.size * 8 <= max_bytes:
+        dest[...] = source[...]
+        return
+    step = max(1, int(max_bytes // (8 * np.prod(source.shape[1:]))))
+    for i in range(0, source.shape[0], step):
+        dest[i:i+step] = source[i:i+step]
+
+
 def _md5(filename):
     '''
     Calculates an MD5 checksum for the given file
@@ -0,0 +1,465 @@
+'''
+Tools for computing and reducing power spectral densities (PSDs).
+All functions work on single spectra or on stacks of spectra with frequency
+along the last axis.
+'''
+import numpy as np, time, matplotlib.pyplot as plt
+from scipy import signal
+from .utilities import AttrDict, welford_update
+from .save import Saver
+try:
+    from scipy import fft as _fft  # multithreaded FFTs (scipy >= 1.4)
+    _fft_kwargs = lambda workers: {'workers': workers}
+except ImportError:
+    _fft = np.fft
+    _fft_kwargs = lambda workers: {}
+
+# Window names that were removed from scipy.signal
+_WINDOW_ALIASES = {'hanning': 'hann'}
+
+
+def log_bin_index(f, bins_per_decade=10):
+    '''
+    Logarithmically spaced bin of each frequency f. The zero frequency is
+    dropped, and bins that contain no frequencies are removed.
+
+    Returns:
+    fbin (array): center of each bin (geometric mean of its frequencies)
+    idx (array): bin of each frequency (-1 for dropped frequencies)
+    counts (array): number of frequencies in each bin
+    '''
+    f = np.asarray(f, dtype=float)
+    good = f > 0
+    logf = np.log10(f[good])
+    first = np.floor(logf.min() * bins_per_decade)
+    last = np.ceil(logf.max() * bins_per_decade)
+    edges = np.arange(first, last + 1) / bins_per_decade
+    idx = np.clip(np.searchsorted(edges, logf, side='right') - 1, 0,
+                  len(edges) - 2)
+
+    counts = np.bincount(idx, minlength=len(edges) - 1)
+    used = counts > 0
+    # Renumber the bins that contain frequencies
+    new_idx = np.cumsum(used)[idx] - 1
+    counts = counts[used]
+
+    fbin = 10 ** (np.bincount(new_idx, weights=logf) / counts)
+    idx = np.full(len(f), -1)
+    idx[good] = new_idx
+    return fbin, idx, counts
+
+
+def log_bin_matrix(f, bins_per_decade=10):
+    '''
+    Matrix that averages a spectrum sampled at frequencies f into
+    logarithmically spaced bins. See log_bin_index.
+
+    Returns:
+    fbin (array): center of each bin (geometric mean of its frequencies)
+    M (array): (len(f), num_bins) averaging matrix: binned = psd @ M
+    counts (array): number of frequencies in each bin
+    '''
+    fbin, idx, counts = log_bin_index(f, bins_per_decade)
+    good = idx >= 0
+    M = np.zeros((len(idx), len(counts)))
+    M[np.where(good)[0], idx[good]] = 1 / counts[idx[good]]
+    return fbin, M, counts
+
+
+def _bin_mean(psd, idx, counts):
+    '''
+    Mean of psd (along the last axis) in each bin, given the bin idx of
+    each frequency (see log_bin_index). Bins of sorted frequencies are
+    contiguous, so this is a single reduceat.
+    '''
+    psd = np.asarray(psd, dtype=float)
+    good = np.where(idx >= 0)[0]
+    order = good[np.argsort(idx[good], kind='stable')]
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    return np.add.reduceat(psd[..., order], starts, axis=-1) / counts
+
+
+def log_bin(f, psd, bins_per_decade=10):
+    '''
+    Average the PSD (or a stack of PSDs) into logarithmically spaced
+    frequency bins. See log_bin_index.
+
+    Returns:
+    fbin (array): center of each bin
+    psd_binned (array): mean PSD in each bin
+    counts (array): number of frequencies averaged in each bin
+    '''
+    fbin, idx, counts = log_bin_index(f, bins_per_decade)
+    return fbin, _bin_mean(psd, idx, counts), counts
+
+
+def band_rms(f, psd, bands):
+    '''
+    RMS spectral density (sqrt of the mean PSD) in each frequency band.
+
+    Arguments:
+    f (array): frequencies
+    psd (array): PSD or stack of PSDs (frequency along the last axis)
+    bands (list): [[fmin, fmax], ...] in Hz
+
+    Returns:
+    (array): shape psd.shape[:-1] + (len(bands),)
+    '''
+    f = np.asarray(f)
+    psd = np.asarray(psd)
+    out = np.full(psd.shape[:-1] + (len(bands),), np.nan)
+    for k, (fmin, fmax) in enumerate(bands):
+        where = (f >= fmin) & (f <= fmax) & (f > 0)
+        if where.any():
+            out[..., k] = np.sqrt(np.mean(psd[..., where], axis=-1))
+    return out
+
+
+class SpectralEngine(object):
+    '''
+    Power spectral densities of stacks of time traces, computed with one
+    batched real FFT (multithreaded with scipy.fft) instead of one
+    scipy.signal call per trace. Windows and their normalization are cached.
+    Results are the same as scipy.signal.periodogram and scipy.signal.welch
+    (one-sided density, constant detrend).
+        >> engine = SpectralEngine(fs, window='hann')
+        >> f, psd = engine.periodogram(traces)  # traces: (num_traces, N)
+        >> f, psd = engine.welch(traces, nperseg=4096)
+    '''
+    def __init__(self, fs, window='hann', workers=-1):
+        '''
+        fs: sample rate (Hz)
+        window: name of the window (see scipy.signal.get_window)
+        workers: number of threads for the FFTs (-1: all cores)
+        '''
+        self.fs = fs
+        self.window = _WINDOW_ALIASES.get(window, window)
+        self.workers = workers
+        self._windows = {}
+        self._bins = {}
+
+
+    def get_window(self, n):
+        '''
+        Window of length n and the density scale 1 / (fs * sum(window**2)).
+        '''
+        if n not in self._windows:
+            win = signal.get_window(self.window, n)
+            self._windows[n] = win, 1 / (self.fs * np.sum(win ** 2))
+        return self._windows[n]
+
+
+    def _psd(self, segments):
+        '''
+        One-sided PSD of each segment (along the last axis).
+        '''
+        n = segments.shape[-1]
+        win, scale = self.get_window(n)
+        segments = segments - segments.mean(axis=-1, keepdims=True)
+        spec = _fft.rfft(segments * win, axis=-1, **_fft_kwargs(self.workers))
+        psd = (spec.real ** 2 + spec.imag ** 2) * scale
+        # Fold the negative frequencies (not DC, nor Nyquist for even n)
+        psd[..., 1:n - n // 2] *= 2
+        return np.fft.rfftfreq(n, 1 / self.fs), psd
+
+
+    def periodogram(self, V):
+        '''
+        Periodogram of a time trace or of each trace of a stack (time along
+        the last axis). Returns f, psd.
+        '''
+        return self._psd(np.asarray(V, dtype=float))
+
+
+    def welch(self, V, nperseg=None, noverlap=None):
+        '''
+        Welch PSD (mean over overlapping segments) of a time trace or of
+        each trace of a stack (time along the last axis). Returns f, psd.
+
+        nperseg: segment length. None: 256 as in scipy.signal.welch.
+        noverlap: overlap of the segments. None: nperseg // 2.
+        '''
+        V = np.asarray(V, dtype=float)
+        n = V.shape[-1]
+        nperseg = min(256 if nperseg is None else int(nperseg), n)
+        if noverlap is None:
+            noverlap = nperseg // 2
+        step = nperseg - noverlap
+        num_segments = (n - noverlap) // step
+        segments = np.lib.stride_tricks.as_strided(V,
+                        shape=V.shape[:-1] + (num_segments, nperseg),
+                        strides=V.strides[:-1] + (step * V.strides[-1],
+                                                  V.strides[-1]),
+                        writeable=False)
+        f, psd = self._psd(segments)
+        return f, psd.mean(axis=-2)
+
+
+    def log_binned(self, f, psd, bins_per_decade=10, units='V'):
+        '''
+        LogBinnedSpectrum of a PSD (or a stack of PSDs) sampled at the
+        frequencies f. The binning of each set of frequencies is cached.
+        '''
+        key = (len(f), f[-1], bins_per_decade)
+        if key not in self._bins:
+            self._bins[key] = log_bin_index(f, bins_per_decade)
+        fbin, idx, counts = self._bins[key]
+        return LogBinnedSpectrum(fbin, _bin_mean(psd, idx, counts),
+                                 bins_per_decade, units, counts)
+
+
+def benchmark(num_traces=30, n=128000, fs=256000, nperseg=30*2**7,
+              repeat=3):
+    '''
+    Compare the SpectralEngine with a loop of scipy.signal calls (as
+    DaqSpectrum did before) on a stack of random time traces. Prints and
+    returns the times (s) of the fastest of repeat runs.
+    '''
+    V = np.random.randn(num_traces, n)
+    engine = SpectralEngine(fs, 'blackmanharris')
+    welch_engine = SpectralEngine(fs, 'hann')
+
+    def best(func):
+        times = []
+        for i in range(repeat):
+            tstart = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - tstart)
+        return min(times)
+
+    times = AttrDict(
+        periodogram_loop = best(lambda: [signal.periodogram(v, fs,
+                                        'blackmanharris') for v in V]),
+        periodogram_engine = best(lambda: engine.periodogram(V)),
+        welch_loop = best(lambda: [signal.welch(v, fs, 'hann',
+                                        nperseg=nperseg) for v in V]),
+        welch_engine = best(lambda: welch_engine.welch(V, nperseg)),
+    )
+    for method in ['periodogram', 'welch']:
+        loop, batch = times[method + '_loop'], times[method + '_engine']
+        print('%s of %i x %i traces: loop %.3f s, engine %.3f s (%.1fx)' %(
+              method, num_traces, n, loop, batch, loop / batch))
+    return times
+
+
+def harmonic_mask(f, filters=[60], filters_bw=[10]):
+    '''
+    Mask that removes all harmonics of the given frequencies (e.g. mains
+    pickup), computed for all harmonics of all filters at once.
+
+    Arguments:
+    f (array): frequencies
+    filters (list): fundamental frequencies (Hz)
+    filters_bw (list): full bandwidth (Hz) removed around each harmonic of
+        the corresponding fundamental
+
+    Returns:
+    (array): True for frequencies farther than filters_bw/2 from every
+        harmonic (fundamental included, zero frequency excluded)
+    '''
+    f = np.asarray(f, dtype=float)[..., None]
+    filters = np.asarray(filters, dtype=float)
+    if filters.size == 0:
+        return np.ones(f.shape[:-1], dtype=bool)
+    # Nearest harmonic of each filter
+    harmonic = np.maximum(np.round(f / filters), 1) * filters
+    near = np.abs(f - harmonic) <= np.asarray(filters_bw, dtype=float) / 2
+    return ~near.any(axis=-1)
+
+
+def fit_one_over_f(f, Vn, fmin=0, fmax=None, filters=[60], filters_bw=[10]):
+    '''
+    Fit A/f^alpha to a spectral density or to every spectrum of a stack
+    (frequency along the last axis) at once, by a linear fit of the log-log
+    spectrum over [fmin, fmax] with the harmonics of filters removed (see
+    harmonic_mask). NaN and nonpositive values are left out.
+
+    Returns:
+    A, alpha (arrays of shape Vn.shape[:-1]; floats for one spectrum)
+    '''
+    f = np.asarray(f, dtype=float)
+    Vn = np.asarray(Vn, dtype=float)
+    if fmax is None:
+        fmax = f.max()
+    use = (f > 0) & (f >= fmin) & (f <= fmax) \
+          & harmonic_mask(f, filters, filters_bw)
+    f, Vn = f[use], Vn[..., use]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        w = np.isfinite(Vn) & (Vn > 0)
+        x = np.log(f)
+        y = np.where(w, np.log(np.where(w, Vn, 1)), 0)
+        n = w.sum(axis=-1)
+        xm = np.sum(w * x, axis=-1) / n
+        ym = np.sum(y, axis=-1) / n
+        dx = w * (x - xm[..., None])
+        slope = np.sum(dx * (y - ym[..., None]), axis=-1) \
+                / np.sum(dx ** 2, axis=-1)
+    A = np.exp(ym - slope * xm)
+    alpha = -slope
+    if A.ndim == 0:
+        return float(A), float(alpha)
+    return A, alpha
+
+
+class PSDAccumulator(object):
+    '''
+    Averages the power spectral densities of time traces as they come in,
+    without keeping the traces. The mean and variance of the PSD in each
+    frequency bin are kept with Welford's algorithm (see welford_update in
+    utilities).
+        >> acc = PSDAccumulator(fs, method='welch', nperseg=4096)
+        >> for V in traces:
+        >>     acc.add(V)
+        >> acc.f, acc.mean, acc.std
+    '''
+    def __init__(self, fs, method='periodogram', window='blackmanharris',
+                 nperseg=None, noverlap=None):
+        '''
+        fs: sample rate (Hz)
+        method: 'periodogram' (one PSD per trace) or 'welch' (average of
+            overlapping segments of each trace)
+        window: window applied to each trace or segment
+        nperseg, noverlap: segment length and overlap for Welch's method
+            (scipy.signal.welch defaults if None)
+        '''
+        if method not in ['periodogram', 'welch']:
+            raise Exception('Method must be periodogram or welch!')
+        self.engine = SpectralEngine(fs, window)
+        self.method = method
+        self.nperseg = nperseg
+        self.noverlap = noverlap
+        self.f = None
+        self.count = 0
+        self.mean = 0
+        self.M2 = 0
+
+
+    def psd(self, V):
+        '''
+        PSD of a time trace (or a stack of traces along the first axis)
+        with the accumulator's method. Returns f, psd.
+        '''
+        if self.method == 'welch':
+            return self.engine.welch(V, self.nperseg, self.noverlap)
+        return self.engine.periodogram(V)
+
+
+    def add(self, V):
+        '''
+        Add a time trace (or a stack of traces along the first axis, whose
+        PSDs are computed in one batch).
+        '''
+        self.f, psd = self.psd(V)
+        self.add_psd(psd)
+
+
+    def add_psd(self, psd):
+        '''
+        Add an already computed PSD (or a stack of PSDs).
+        '''
+        psd = np.asarray(psd, dtype=float)
+        if self.count == 0:
+            self._counts = np.zeros(psd.shape[-1])
+            self.mean = np.zeros(psd.shape[-1])
+            self.M2 = np.zeros(psd.shape[-1])
+        for p in np.reshape(psd, (-1, psd.shape[-1])):
+            welford_update(self._counts, self.mean, self.M2, p)
+            self.count += 1
+
+
+    @property
+    def var(self):
+        '''
+        Variance of the PSDs in each frequency bin (NaN in bins with fewer
+        than two values; welford_update skips NaN values).
+        '''
+        if self.count == 0:
+            return np.full(np.shape(self.mean), np.nan)
+        var = np.full(np.shape(self.mean), np.nan)
+        ok = self._counts > 1
+        var[ok] = self.M2[ok] / (self._counts[ok] - 1)
+        return var
+
+
+    @property
+    def std(self):
+        '''
+        Standard deviation of the PSDs in each frequency bin.
+        '''
+        return np.sqrt(self.var)
+
+
+class LogBinnedSpectrum(Saver):
+    '''
+    Power spectral density (or a stack of them, frequency along the last
+    axis) averaged into logarithmically spaced frequency bins, with the
+    number of frequencies averaged in each bin. Much smaller than the full
+    spectrum (e.g. 64k frequencies become ~100 bins at 20 bins per decade).
+    Saved like any Saver, also as an attribute of a measurement.
+        >> s = LogBinnedSpectrum(f, psd, bins_per_decade=20)
+        >> s.f, s.psd, s.counts, s.Vn
+        >> s.plot()
+    '''
+    f = np.array([])
+    psd = np.array([])
+    counts = np.array([])
+    bins_per_decade = 10
+    units = 'V'
+
+    def __init__(self, f=None, psd=None, bins_per_decade=10, units='V',
+                 counts=None):
+        '''
+        f, psd: frequencies and PSD (or stack of PSDs) to bin.
+        bins_per_decade: number of bins per decade of frequency
+        units: units of the spectral density (e.g. V)
+        counts: if given, f and psd are already binned and counts is the
+            number of frequencies in each bin.
+        '''
+        super().__init__()
+        self.bins_per_decade = bins_per_decade
+        self.units = units
+        if counts is not None:
+            self.f, self.psd = np.asarray(f), np.asarray(psd)
+            self.counts = np.asarray(counts)
+        elif f is not None:
+            self.f, self.psd, self.counts = log_bin(f, psd, bins_per_decade)
+
+
+    @property
+    def Vn(self):
+        '''
+        Spectral density (sqrt of the PSD) in each bin.
+        '''
+        return np.sqrt(self.psd)
+
+
+    def band_rms(self, bands):
+        '''
+        RMS spectral density in each frequency band ([[fmin, fmax], ...],
+        Hz), weighting each bin whose center lies in the band by its number
+        of frequencies. Shape psd.shape[:-1] + (len(bands),).
+        '''
+        out = np.full(self.psd.shape[:-1] + (len(bands),), np.nan)
+        for k, (fmin, fmax) in enumerate(bands):
+            where = (self.f >= fmin) & (self.f <= fmax)
+            if where.any():
+                w = self.counts[where]
+                out[..., k] = np.sqrt(self.psd[..., where] @ w / w.sum())
+        return out
+
+
+    def plot(self, ax=None, conversion=1, **kwargs):
+        '''
+        Plot the spectral density (every spectrum of a stack) on a loglog
+        scale, multiplied by conversion. kwargs are passed to loglog.
+        Returns the axes.
+        '''
+        if ax is None:
+            fig, ax = plt.subplots()
+            ax.set_xlabel('Frequency (Hz)')
+            ax.set_ylabel(r'Spectral Density ($\mathrm{%s/\sqrt{Hz}}$)'
+                          %self.units)
+        Vn = np.reshape(self.Vn, (-1, len(self.f))).T
+        ax.loglog(self.f, Vn * conversion, **kwargs)
+        return ax
@@ -0,0 +1,215 @@
+'''
+Fitting of sample surfaces z(x, y) (e.g. touchdown voltages) with planes,
+quadratics or thin-plate splines, optionally robust to outliers.
+
+Every model is written as a plane a*x + b*y + c plus a correction, so that
+the offset c can be updated by a single touchdown (see Planefit.update_c).
+'''
+import numpy as np
+from .utilities import AttrDict
+
+MODELS = ['plane', 'quadratic', 'tps']
+ROBUST = [None, 'huber', 'ransac']
+
+
+def _design(x, y, model):
+    '''
+    Design matrix of a polynomial surface: columns x, y, 1 for a plane,
+    and x**2, x*y, y**2 in addition for a quadratic.
+    '''
+    cols = [x, y, np.ones(x.shape)]
+    if model == 'quadratic':
+        cols += [x ** 2, x * y, y ** 2]
+    return np.stack(cols, axis=-1)
+
+
+def _robust_scale(r):
+    '''
+    Standard deviation estimated from the median absolute deviation.
+    '''
+    s = 1.4826 * np.median(np.abs(r - np.median(r)))
+    if s == 0:
+        s = np.std(r)
+    return s if s > 0 else 1e-12
+
+
+def fit_poly(x, y, z, model='plane', weights=None):
+    '''
+    (Weighted) least squares fit of a plane or quadratic surface.
+    Returns the coefficients (see _design).
+    '''
+    A = _design(x, y, model)
+    if weights is not None:
+        w = np.sqrt(weights)
+        A, z = A * w[:, None], z * w
+    return np.linalg.lstsq(A, z, rcond=None)[0]
+
+
+def huber(x, y, z, model='plane', k=1.345, iterations=20):
+    '''
+    Huber-robust fit by iteratively reweighted least squares. Points with
+    residuals larger than k robust standard deviations are down-weighted.
+
+    Returns:
+    coeffs (array): coefficients of the fit
+    weights (array): final weight of each point (1 for inliers)
+    '''
+    weights = np.ones(len(z))
+    for i in range(iterations):
+        coeffs = fit_poly(x, y, z, model, weights)
+        r = z - _design(x, y, model) @ coeffs
+        s = _robust_scale(r)
+        new = np.minimum(1, k * s / np.maximum(np.abs(r), 1e-300))
+        if np.allclose(new, weights, atol=1e-6):
+            break
+        weights = new
+    return coeffs, weights
+
+
+def ransac(x, y, z, model='plane', threshold=None, iterations=200,
+           seed=0):
+    '''
+    RANSAC fit: fit many minimal random subsets of the points and keep the
+    fit that agrees with the most points (within threshold), then refit
+    those points with least squares.
+
+    threshold: largest residual of an inlier. Default: 2.5 times the
+        robust standard deviation of the residuals of a least squares fit.
+
+    Returns:
+    coeffs (array): coefficients of the fit to the inliers
+    inliers (array): 1 for inliers, 0 for outliers
+    '''
+    A = _design(x, y, model)
+    num = A.shape[1]
+    if threshold is None:
+        r = z - A @ fit_poly(x, y, z, model)
+        threshold = 2.5 * _robust_scale(r)
+    if len(z) <= num:
+        return fit_poly(x, y, z, model), np.ones(len(z))
+
+    rng = np.random.RandomState(seed)
+    best, best_count, best_sse = None, -1, np.inf
+    for i in range(iterations):
+        sample = rng.choice(len(z), num, replace=False)
+        if np.linalg.matrix_rank(A[sample]) < num:
+            continue
+        coeffs = np.linalg.solve(A[sample], z[sample])
+        r = np.abs(z - A @ coeffs)
+        inliers = r < threshold
+        count, sse = inliers.sum(), np.sum(r[inliers] ** 2)
+        if count > best_count or (count == best_count and sse < best_sse):
+            best, best_count, best_sse = inliers, count, sse
+    if best is None or best.sum() < num:
+        return fit_poly(x, y, z, model), np.ones(len(z))
+    coeffs = fit_poly(x[best], y[best], z[best], model)
+    return coeffs, best.astype(float)
+
+
+def tps_kernel(x, y, centers):
+    '''
+    Thin-plate spline radial basis r**2 log(r) between points (x, y)
+    (any shape) and centers (N, 2). Returns shape x.shape + (N,).
+    '''
+    dx = x[..., None] - centers[:, 0]
+    dy = y[..., None] - centers[:, 1]
+    r2 = dx ** 2 + dy ** 2
+    with np.errstate(invalid='ignore', divide='ignore'):
+        K = 0.5 * r2 * np.log(r2)
+    K[r2 == 0] = 0
+    return K
+
+
+def fit_tps(x, y, z, smoothing=0, weights=None):
+    '''
+    Fit a thin-plate spline z = a*x + b*y + c + sum_i w_i phi(|p - p_i|)
+    with the data points as centers.
+
+    smoothing: 0 interpolates the points exactly; larger values approach a
+        plane fit. In units of the kernel (V**2 log V).
+    weights: relative weight of each point (e.g. from a robust fit);
+        points with zero weight are left out.
+
+    Returns:
+    (a, b, c), centers (N, 2), w (N,)
+    '''
+    if weights is not None:
+        keep = weights > 0
+        x, y, z, weights = x[keep], y[keep], z[keep], weights[keep]
+    n = len(z)
+    centers = np.stack([x, y], axis=-1)
+    K = tps_kernel(x, y, centers)
+    if smoothing:
+        lam = np.full(n, float(smoothing))
+        if weights is not None:
+            lam = lam / weights
+        K = K + np.diag(lam)
+    P = _design(x, y, 'plane')
+    M = np.zeros((n + 3, n + 3))
+    M[:n, :n] = K
+    M[:n, n:] = P
+    M[n:, :n] = P.T
+    sol = np.linalg.lstsq(M, np.concatenate([z, np.zeros(3)]), rcond=None)[0]
+    return sol[n:], centers, sol[:n]
+
+
+def fit_surface(x, y, z, model='plane', robust=None, smoothing=0):
+    '''
+    Fit a surface to scattered points, ignoring NaNs.
+
+    model: 'plane', 'quadratic' or 'tps' (thin-plate spline)
+    robust: None (least squares), 'huber' or 'ransac'. For 'tps', outliers
+        are found with a robust quadratic fit and left out of the spline
+        (Huber weights below 0.5, i.e. residuals above ~2.7 standard
+        deviations).
+    smoothing: smoothing of the thin-plate spline (see fit_tps)
+
+    Returns an AttrDict with:
+    abc (array): a, b, c of the plane part
+    quad (array): d, e, f of the quadratic part d*x**2 + e*x*y + f*y**2
+    centers, w (arrays): centers and weights of the thin-plate spline
+    weights (array): weight of each point in the fit (NaN for NaN points)
+    '''
+    if model not in MODELS:
+        raise Exception('Surface model must be one of %s!' %MODELS)
+    if robust not in ROBUST:
+        raise Exception('Robust fit must be one of %s!' %ROBUST)
+    x, y, z = [np.asarray(v, dtype=float).ravel() for v in (x, y, z)]
+    good = ~np.isnan(z)
+    xg, yg, zg = x[good], y[good], z[good]
+
+    poly = 'plane' if model == 'plane' else 'quadratic'
+    if robust == 'huber':
+        coeffs, w = huber(xg, yg, zg, poly)
+    elif robust == 'ransac':
+        coeffs, w = ransac(xg, yg, zg, poly)
+    else:
+        coeffs, w = fit_poly(xg, yg, zg, poly), np.ones(len(zg))
+
+    result = AttrDict(quad=np.zeros(3), centers=np.zeros((0, 2)),
+                      w=np.zeros(0))
+    if model == 'tps':
+        w = np.where(w < 0.5, 0, w)
+        abc, result['centers'], result['w'] = fit_tps(xg, yg, zg, smoothing,
+                                                      w)
+    else:
+        abc = coeffs[:3]
+        if model == 'quadratic':
+            result['quad'] = coeffs[3:]
+    result['abc'] = np.asarray(abc)
+    result['weights'] = np.full(len(z), np.nan)
+    result['weights'][good] = w
+    return result
+
+
+def correction(x, y, quad, centers, w):
+    '''
+    Part of a fit surface beyond the plane a*x + b*y + c, evaluated at x, y
+    (arrays of any shape).
+    '''
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    d, e, f = quad
+    z = d * x ** 2 + e * x * y + f * y ** 2
+    if len(w):
+        z = z + tps_kernel(x, y, np.asarray(centers)) @ np.asarray(w)
+    return z
@@ -0,0 +1,234 @@
+'''
+History of touchdowns in an experiment, with a spatial index for looking up
+the expected touchdown voltage at a position.
+
+Touchdowns are stored in touchdown_history.h5 in the experiment directory,
+one row per touchdown (see COLUMNS). Positions combine the attocube
+position and the X/Y piezo voltage into um on the sample. The touchdown
+voltage is stored as a surface height atto_z + Vtd * Vz_to_um (um), which
+does not change when the z attocube is moved, so predictions can be made
+for the current attocube position.
+    >> h = TouchdownHistory()
+    >> Vtd, err, n = h.query(Vx, Vy, atto=[x, y, z])
+'''
+import numpy as np, h5py, os, json, time
+from datetime import datetime as dt
+from scipy.spatial import cKDTree
+
+from . import conversions
+from .save import get_local_data_path, get_experiment_data_dir, \
+                  get_data_paths, get_json_value
+
+COLUMNS = ['time', 'atto_x', 'atto_y', 'atto_z', 'Vx', 'Vy', 'Vtd', 'err']
+
+
+def history_path():
+    '''
+    Path of the touchdown history of the current experiment.
+    '''
+    return os.path.join(get_local_data_path(), get_experiment_data_dir(),
+                        'touchdown_history.h5')
+
+
+def atto_position(atto):
+    '''
+    Current position [x, y, z] (um) of the attocubes.
+    '''
+    return [atto.x.pos, atto.y.pos, atto.z.pos]
+
+
+class TouchdownHistory(object):
+    '''
+    Stores touchdowns and looks up the expected touchdown voltage at a
+    position from the nearest past touchdowns (k-d tree, so a query takes
+    tens of microseconds regardless of the number of touchdowns).
+    '''
+    def __init__(self, filename=None):
+        '''
+        filename: HDF5 file of the history. None: the current experiment's.
+        '''
+        if filename is None:
+            filename = history_path()
+        self.filename = filename
+        self.entries = np.zeros((0, len(COLUMNS)))
+        if os.path.exists(filename):
+            with h5py.File(filename, 'r') as f:
+                self.entries = np.array(f['entries'])
+        self._tree = None
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    def _column(self, name):
+        return self.entries[:, COLUMNS.index(name)]
+
+
+    @staticmethod
+    def _xy(atto_x, atto_y, Vx, Vy):
+        '''
+        Position on the sample (um).
+        '''
+        return np.stack([np.asarray(atto_x) + np.asarray(Vx) * conversions.Vx_to_um,
+                         np.asarray(atto_y) + np.asarray(Vy) * conversions.Vy_to_um],
+                        axis=-1)
+
+
+    @property
+    def xy(self):
+        '''
+        Positions of all touchdowns on the sample (um).
+        '''
+        return self._xy(self._column('atto_x'), self._column('atto_y'),
+                        self._column('Vx'), self._column('Vy'))
+
+
+    @property
+    def height(self):
+        '''
+        Surface height of all touchdowns (um), independent of the z
+        attocube position.
+        '''
+        return self._column('atto_z') \
+                + self._column('Vtd') * conversions.Vz_to_um
+
+
+    def add(self, Vtd, Vx, Vy, atto=[0, 0, 0], err=np.nan, t=None,
+            save=True):
+        '''
+        Add a touchdown.
+
+        Arguments:
+        Vtd: touchdown voltage
+        Vx, Vy: X and Y piezo voltages of the touchdown
+        atto: attocube position [x, y, z] (um), see atto_position
+        err: error of the touchdown voltage
+        t: time of the touchdown (s since epoch). None: now
+        save: if True, append the touchdown to the file
+        '''
+        if t is None:
+            t = time.time()
+        row = np.array([[t, atto[0], atto[1], atto[2], Vx, Vy, Vtd, err]],
+                       dtype=float)
+        self.entries = np.vstack([self.entries, row])
+        self._tree = None
+        if save:
+            self._append(row)
+
+
+    def add_touchdown(self, td, save=True):
+        '''
+        Add a finished Touchdown, reading the piezo and attocube positions
+        from its instruments.
+        '''
+        self.add(td.Vtd, td.piezos.x.V, td.piezos.y.V,
+                 atto=atto_position(td.atto), err=td.err[0], save=save)
+
+
+    def _append(self, rows):
+        '''
+        Append rows to the file, creating it if needed.
+        '''
+        dirname = os.path.dirname(self.filename)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        with h5py.File(self.filename, 'a') as f:
+            if 'entries' not in f:
+                d = f.create_dataset('entries', (0, len(COLUMNS)),
+                                     maxshape=(None, len(COLUMNS)),
+                                     dtype='float64', chunks=True)
+                d.attrs['columns'] = ','.join(COLUMNS)
+            d = f['entries']
+            n = d.shape[0]
+            d.resize(n + len(rows), axis=0)
+            d[n:] = rows
+
+
+    def rebuild(self, experiment=''):
+        '''
+        Replace the history with all touchdowns saved in an experiment
+        directory (current experiment if none given). Only the JSON files
+        are read. Touchdowns that failed or were flagged are skipped.
+        '''
+        rows = []
+        for filename in get_data_paths(experiment, 'Touchdown'):
+            with open(filename, encoding='utf-8') as f:
+                d = json.load(f)
+            try:
+                if get_json_value(d, 'error_flag') \
+                        or not get_json_value(d, 'touchdown'):
+                    continue
+                Vtd = get_json_value(d, 'Vtd')
+                t = dt.strptime(get_json_value(d, 'timestamp'),
+                                '%Y-%m-%d %I:%M:%S %p').timestamp()
+                Vx = get_json_value(d, 'piezos', 'x', 'V')
+                Vy = get_json_value(d, 'piezos', 'y', 'V')
+                atto = [get_json_value(d, 'atto', a, 'position')
+                        for a in 'xyz']
+            except (KeyError, TypeError, ValueError):
+                continue
+            if Vtd is None or Vtd == -1:
+                continue
+            rows.append([t] + atto + [Vx, Vy, Vtd, np.nan])
+
+        self.entries = np.array(rows, dtype=float).reshape(-1, len(COLUMNS))
+        self._tree = None
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+        if len(rows):
+            self._append(self.entries)
+        print('Touchdown history rebuilt with %i touchdowns.' %len(rows))
+
+
+    def query(self, Vx, Vy, atto=[0, 0, 0], k=6, radius=None, max_age=None):
+        '''
+        Expected touchdown voltage at piezo voltages Vx, Vy and attocube
+        position atto [x, y, z] (um).
+
+        Uses the k nearest past touchdowns within radius (um on the sample)
+        and not older than max_age (s). With three or more of them, a plane
+        is fit to their surface heights (weighted by inverse distance);
+        otherwise they are averaged.
+
+        Returns:
+        Vtd (float): expected touchdown voltage (NaN if no touchdowns)
+        err (float): spread of the touchdowns around the estimate (V)
+        n (int): number of touchdowns used
+        '''
+        if len(self.entries) == 0:
+            return np.nan, np.nan, 0
+        if self._tree is None:
+            self._points = self.xy
+            self._heights = self.height
+            self._times = self._column('time')
+            self._tree = cKDTree(self._points)
+
+        p = self._xy(atto[0], atto[1], Vx, Vy)
+        k = min(k, len(self.entries))
+        bound = np.inf if radius is None else radius
+        dist, idx = self._tree.query(p, k=k, distance_upper_bound=bound)
+        dist, idx = np.atleast_1d(dist), np.atleast_1d(idx)
+        keep = np.isfinite(dist)
+        if max_age is not None:
+            keep &= time.time() - self._times[
+                        np.minimum(idx, len(self.entries) - 1)] < max_age
+        dist, idx = dist[keep], idx[keep]
+        n = len(idx)
+        if n == 0:
+            return np.nan, np.nan, 0
+
+        h = self._heights[idx]
+        w = 1 / (dist + 1e-3)
+        xy = self._points[idx] - p
+        A = np.column_stack([xy, np.ones(n)])
+        if n >= 3 and np.linalg.matrix_rank(A) == 3:
+            sw = np.sqrt(w)
+            coeffs = np.linalg.lstsq(A * sw[:, None], h * sw, rcond=None)[0]
+            height = coeffs[2]  # plane evaluated at p
+            resid = h - A @ coeffs
+        else:
+            height = np.sum(w * h) / np.sum(w)
+            resid = h - height
+        err = np.sqrt(np.mean(resid ** 2)) / conversions.Vz_to_um
+        return (height - atto[2]) / conversions.Vz_to_um, err, n
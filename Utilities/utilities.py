@@ -21,6 +21,111 @@ class AttrDict(dict):
         self.__dict__ = self
 
 
+class Pixelizer(object):
+    '''
+    Bin-averages data sampled at arbitrary coordinates into pixels centered
+    at given coordinates. Bin edges are computed once, halfway between pixel
+    centers, so the same Pixelizer can be reused for every line of a scan.
+        >> p = Pixelizer(np.linspace(-100, 100, 20))
+        >> mean, sem, counts = p.bin(Vpiezo, np.vstack([Vdc, Vcap]))
+    '''
+    def __init__(self, centers):
+        '''
+        centers: 1D array of pixel centers. May be ascending or descending.
+        '''
+        centers = np.asarray(centers, dtype=float)
+        self.centers = centers
+        self.num_bins = len(centers)
+        self._order = np.argsort(centers)
+
+        c = centers[self._order]
+        if len(c) > 1:
+            mid = (c[1:] + c[:-1]) / 2
+            self.edges = np.concatenate([[c[0] - (mid[0] - c[0])],
+                                         mid,
+                                         [c[-1] + (c[-1] - mid[-1])]])
+        else:
+            self.edges = np.array([-np.inf, np.inf])
+
+
+    def bin(self, x, data):
+        '''
+        Bin all channels of data by coordinate x in a single pass.
+        Samples outside the outer bin edges are ignored.
+
+        Arguments:
+        x (array): 1D array of sample coordinates (N,)
+        data (array): sampled data, shape (N,) or (num_channels, N)
+
+        Returns:
+        mean (array): mean of the samples in each pixel
+        sem (array): standard error of the mean in each pixel
+        counts (array): number of samples in each pixel (num_bins,)
+        mean and sem have shape (num_bins,) or (num_channels, num_bins).
+        Pixels without samples are NaN.
+        '''
+        data = np.asarray(data, dtype=float)
+        one_channel = data.ndim == 1
+        data = np.atleast_2d(data)
+        num_chan = data.shape[0]
+        nb = self.num_bins
+
+        # Index of the (sorted) bin each sample falls into
+        idx = np.searchsorted(self.edges, x, side='right') - 1
+        valid = (idx >= 0) & (idx < nb)
+        idx = idx[valid]
+        data = data[:, valid]
+
+        counts = np.bincount(idx, minlength=nb).astype(float)
+
+        # Flattened indices so every channel is summed in one bincount.
+        # Subtract the channel means to keep the variance accurate.
+        offset = np.mean(data, axis=1, keepdims=True) if data.size else 0
+        d = data - offset
+        flat_idx = (np.arange(num_chan)[:, None] * nb + idx[None, :]).ravel()
+        sums = np.bincount(flat_idx, weights=d.ravel(),
+                           minlength=num_chan * nb).reshape(num_chan, nb)
+        sumsq = np.bincount(flat_idx, weights=(d**2).ravel(),
+                            minlength=num_chan * nb).reshape(num_chan, nb)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = sums / counts
+            var = (sumsq - sums * mean) / (counts - 1)
+            sem = np.sqrt(np.clip(var, 0, None) / counts)
+        mean = mean + offset
+
+        # Back to the order of the given centers
+        inv = np.empty(nb, dtype=int)
+        inv[self._order] = np.arange(nb)
+        mean, sem, counts = mean[:, inv], sem[:, inv], counts[inv]
+
+        if one_channel:
+            return mean[0], sem[0], counts
+        return mean, sem, counts
+
+
+def welford_update(count, mean, M2, x):
+    '''
+    Add a new sample x to running (Welford) accumulators of the mean and
+    variance, elementwise and in place. NaNs in x are skipped, so each
+    element keeps its own count. Memory use does not grow with the number
+    of samples.
+        >> count, mean, M2 = np.zeros(shape), np.zeros(shape), np.zeros(shape)
+        >> welford_update(count, mean, M2, x)  # for each new x
+        >> var = M2 / (count - 1)
+
+    Arguments:
+    count, mean, M2 (arrays): accumulators, all of the same shape as x
+    x (array): new sample
+    '''
+    x = np.asarray(x, dtype=float)
+    good = ~np.isnan(x)
+    count[good] += 1
+    delta = x[good] - mean[good]
+    mean[good] += delta / count[good]
+    M2[good] += delta * (x[good] - mean[good])
+
+
 def fit_plane(x,y,z):
     '''
     Calculates plane parameters a, b, and c for 2D data.
@@ -53,6 +158,178 @@ def fit_plane(x,y,z):
     return lstsq(A[~np.isnan(Z)], Z[~np.isnan(Z)])[0] # a,b,c
 
 
+class PlaneEstimator(object):
+    '''
+    Recursive least squares fit of a plane z = ax + by + c. Each new point
+    is a rank-1 update of the normal equations, so adding a point and
+    getting the parameters and their covariance is O(1), independent of the
+    number of points. Gives the same plane as fit_plane.
+        >> e = PlaneEstimator()
+        >> e.add(x, y, z)
+        >> a, b, c = e.params
+        >> e.std  # standard errors of a, b, c
+    '''
+    def __init__(self):
+        self.n = 0
+        self._AtA = np.zeros((3, 3))
+        self._Atz = np.zeros(3)
+        self._ztz = 0
+
+
+    def add(self, x, y, z):
+        '''
+        Add a point. NaN (e.g. failed touchdown) points are skipped.
+        '''
+        if np.isnan(z):
+            return
+        v = np.array([x, y, 1], dtype=float)
+        self._AtA += np.outer(v, v)
+        self._Atz += v * z
+        self._ztz += z ** 2
+        self.n += 1
+
+
+    @property
+    def params(self):
+        '''
+        Plane parameters a, b, c. Minimum norm solution if the points do
+        not determine a plane yet.
+        '''
+        return lstsq(self._AtA, self._Atz, rcond=None)[0]
+
+
+    @property
+    def cov(self):
+        '''
+        Covariance matrix of a, b and c, with the noise estimated from the
+        residuals. Infinite until there are more than 3 points that
+        determine a plane.
+        '''
+        if self.n <= 3 or not self.determined:
+            return np.full((3, 3), np.inf)
+        p = self.params
+        sse = max(self._ztz - p @ self._Atz, 0)
+        return np.linalg.inv(self._AtA) * sse / (self.n - 3)
+
+
+    @property
+    def determined(self):
+        '''
+        True once the points determine a plane (three not on a line).
+        '''
+        return np.linalg.matrix_rank(self._AtA) == 3
+
+
+    @property
+    def rms(self):
+        '''
+        Root mean square residual of the points from the plane.
+        '''
+        if self.n == 0:
+            return np.nan
+        sse = max(self._ztz - self.params @ self._Atz, 0)
+        return np.sqrt(sse / self.n)
+
+
+    @property
+    def std(self):
+        '''
+        Standard errors of a, b and c.
+        '''
+        return np.sqrt(np.diag(self.cov))
+
+
+    def predict(self, x, y):
+        '''
+        Plane evaluated at x, y and its standard error.
+        '''
+        x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+        a, b, c = self.params
+        v = np.stack([x, y, np.ones(x.shape)], axis=-1)
+        cov = self.cov
+        if np.isinf(cov).any():
+            err = np.full(x.shape, np.inf)
+        else:
+            err = np.sqrt(np.einsum('...i,ij,...j->...', v, cov, v))
+        return a * x + b * y + c, err
+
+
+class RingBuffer(object):
+    '''
+    Fixed-size buffer of samples with several fields (e.g. t, x, y) that
+    keeps the most recent size samples, so memory does not grow when
+    streaming. Samples that were not read yet are returned by read();
+    if more than size samples arrive between reads, the oldest are lost
+    (counted in dropped).
+        >> b = RingBuffer(2**20, ['t', 'x', 'y'])
+        >> b.extend(t=t, x=x, y=y)
+        >> new = b.read()  # AttrDict of arrays
+    '''
+    def __init__(self, size, fields):
+        self.size = int(size)
+        self.fields = list(fields)
+        self._data = np.zeros((len(self.fields), self.size))
+        self.total = 0  # number of samples ever added
+        self._read = 0  # number of samples ever read
+        self.dropped = 0
+
+
+    def __len__(self):
+        return min(self.total, self.size)
+
+
+    @property
+    def unread(self):
+        '''
+        Number of samples not read yet.
+        '''
+        return self.total - self._read
+
+
+    def extend(self, **columns):
+        '''
+        Add samples: one array (all of the same length) per field.
+        '''
+        new = np.array([np.asarray(columns[k], dtype=float).ravel()
+                        for k in self.fields])
+        n = new.shape[1]
+        keep = new[:, -self.size:]  # older samples would be overwritten
+        first = self.total + n - keep.shape[1]
+        self._data[:, (first + np.arange(keep.shape[1])) % self.size] = keep
+        self.total += n
+        if self.unread > self.size:
+            self.dropped += self.unread - self.size
+            self._read = self.total - self.size
+
+
+    def _get(self, start, stop):
+        '''
+        Samples with absolute indices start to stop, as an AttrDict.
+        '''
+        idx = np.arange(start, stop) % self.size
+        return AttrDict({k: self._data[j, idx].copy()
+                         for j, k in enumerate(self.fields)})
+
+
+    def last(self, n=None):
+        '''
+        The last n samples (all kept samples if None), oldest first,
+        without marking them as read.
+        '''
+        n = len(self) if n is None else min(n, len(self))
+        return self._get(self.total - n, self.total)
+
+
+    def read(self, n=None):
+        '''
+        Return the (first n) unread samples and mark them as read.
+        '''
+        n = self.unread if n is None else min(n, self.unread)
+        out = self._get(self._read, self._read + n)
+        self._read += n
+        return out
+
+
 def get_browser_height():
     '''
     THIS DOESN'T WORK RELIABLY